@@ -0,0 +1,192 @@
+#!/opt/paragun/ENV/bin/pypy3
+"""
+Collapses the metrics index written by the parser processes into one line
+per token, host and app, in the format PulseUpdateView accepts:
+    
+    token<TAB>host<TAB>app<TAB>count<TAB>bytes
+
+This replaces `datamash -s -W --group 1,2,3 count 4 sum 5`. Instead of
+sorting the whole index, lines are streamed and summed into a hash table, so
+memory grows with the number of distinct keys rather than the number of
+events. If the table outgrows --max-keys, it is sorted and spilled to a
+temporary file; the spilled runs are merged back together at the end.
+
+Usage:
+    
+    rsysaggregate.py /var/log/paragun/metrics/index > /var/log/paragun/metrics/aggregate
+
+"""
+from heapq import merge
+from itertools import groupby
+
+import argparse
+import logging
+import sys
+import tempfile
+import unittest
+
+
+def spill(table, directory=None):
+    """
+    Writes a sorted run of partial aggregates to a temporary file.
+    
+    Args:
+        table (dict): {(token, host, app): [count, bytes]}
+    
+    Kwargs:
+        directory (str): Where to create the file. Defaults to the system
+            temp directory.
+    
+    Returns:
+        run (file): Temporary file positioned at the start of the run.
+    
+    """
+    run = tempfile.TemporaryFile(mode='w+b', dir=directory)
+    for key in sorted(table):
+        count, total = table[key]
+        run.write(b'\t'.join(key + (b'%d' % count, b'%d' % total)) + b'\n')
+    run.seek(0)
+    return run
+
+
+def read_run(run):
+    """
+    Reads back a run written by spill().
+    
+    """
+    for line in run:
+        token, host, app, count, total = line.split()
+        yield (token, host, app), int(count), int(total)
+
+
+def aggregate(lines, max_keys=None, directory=None, *args, **kwargs):
+    """
+    Sums event counts and bytes per (token, host, app).
+    
+    rsysparse.py appends one line per key with its running totals, so the
+    fourth field is summed rather than counted as datamash did; for lines
+    written per event it is always 1 and the result is the same.
+    
+    Fields are split on runs of whitespace, like `datamash -W`. Lines with
+    fewer than five fields, or whose count/bytes are not integers, are
+    skipped and logged.
+    
+    Args:
+        lines (iterable): Lines of the metrics index, as bytes.
+    
+    Kwargs:
+        max_keys (int): Spill to disk once this many keys are held in
+            memory. Unbounded if not set.
+        directory (str): Where to write spilled runs.
+    
+    Returns:
+        rows (generator): (token, host, app, count, bytes) tuples sorted by
+            key, with token/host/app as bytes.
+    
+    """
+    logger = logging.getLogger(__name__)
+    
+    table = {}
+    runs = []
+    skipped = 0
+    
+    for line in lines:
+        fields = line.split()
+        try:
+            key = (fields[0], fields[1], fields[2])
+            count = int(fields[3])
+            total = int(fields[4])
+        except (IndexError, ValueError):
+            if line.strip(): skipped += 1
+            continue
+        
+        entry = table.get(key)
+        if entry is None:
+            table[key] = [count, total]
+            if max_keys and len(table) >= max_keys:
+                runs.append(spill(table, directory))
+                table = {}
+        else:
+            entry[0] += count
+            entry[1] += total
+    
+    if skipped:
+        logger.warning('Skipped %s malformed metrics lines.' % skipped)
+    
+    if not runs:
+        for key in sorted(table):
+            count, total = table[key]
+            yield key + (count, total)
+        return
+    
+    # Merge the spilled runs with whatever is still in memory
+    try:
+        current = ((key, count, total) for key, (count, total) in sorted(table.items()))
+        streams = [read_run(x) for x in runs] + [current]
+        for key, group in groupby(merge(*streams, key=lambda x: x[0]), key=lambda x: x[0]):
+            count = total = 0
+            for _, c, t in group:
+                count += c
+                total += t
+            yield key + (count, total)
+    finally:
+        for run in runs: run.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('index', nargs='?', default='-', help='Metrics index to aggregate; - for stdin.')
+    parser.add_argument('-o', '--output', default='-', help='Where to write the aggregate; - for stdout.')
+    parser.add_argument('--max-keys', type=int, default=1000000, help='Distinct keys to hold in memory before spilling to disk.')
+    parser.add_argument('--tmpdir', default=None, help='Directory for spilled runs.')
+    args = parser.parse_args(argv)
+    
+    logging.basicConfig(format='%(asctime)s [%(levelname)-8s] %(filename)s: %(message)s', level=logging.INFO)
+    
+    source = sys.stdin.buffer if args.index == '-' else open(args.index, 'rb')
+    output = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+    
+    try:
+        for row in aggregate(source, max_keys=args.max_keys, directory=args.tmpdir):
+            output.write(b'\t'.join(row[:3] + (b'%d' % row[3], b'%d' % row[4])) + b'\n')
+    finally:
+        if source is not sys.stdin.buffer: source.close()
+        if output is not sys.stdout.buffer: output.close()
+        else: output.flush()
+
+
+if __name__ == '__main__':
+    main()
+
+"""
+For testing
+
+python -m unittest rsysaggregate.py
+
+"""
+class RsysaggregateTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.lines = [
+            b'aaaa\t\t10.0.0.1\t\tsshd\t\t1\t\t120\n',
+            b'bbbb\t\t10.0.0.2\t\tnginx\t\t1\t\t300\n',
+            b'aaaa\t\t10.0.0.1\t\tsshd\t\t1\t\t80\n',
+            b'aaaa\t\t10.0.0.1\t\tcron\t\t1\t\t50\n',
+            b'\n',
+            b'bbbb\t\t10.0.0.2\t\t1\t\t300\n',
+            b'cccc\t\t10.0.0.3\t\tsshd\t\t12\t\t1500\n',
+        ]
+    
+    def test_aggregate(self):
+        expected = [
+            (b'aaaa', b'10.0.0.1', b'cron', 1, 50),
+            (b'aaaa', b'10.0.0.1', b'sshd', 2, 200),
+            (b'bbbb', b'10.0.0.2', b'nginx', 1, 300),
+            (b'cccc', b'10.0.0.3', b'sshd', 12, 1500),
+        ]
+        self.assertEqual(list(aggregate(self.lines)), expected)
+    
+    def test_spill(self):
+        "Spilling to disk must not change the result."
+        lines = self.lines * 50
+        self.assertEqual(list(aggregate(lines, max_keys=2)), list(aggregate(lines)))
@@ -1,7 +1,8 @@
 #!/opt/paragun/ENV/bin/pypy3
+from collections import deque
 from maxminddb.const import MODE_AUTO, MODE_MMAP, MODE_MMAP_EXT, MODE_FILE, MODE_MEMORY, MODE_FD
 from netaddr import IPAddress, IPNetwork, ipv6_verbose, ipv6_compact
-from time import time
+from time import gmtime, strftime, time
 
 import ast
 import geoip2.database
@@ -10,24 +11,355 @@ import logging
 import os
 import pyasn
 import re
+import signal
+import socket
 import sys
+import threading
 import unittest
 
+# Only needed for the IPv4 GeoIP index (see GeoIndex), which is optional
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Paths and intervals can be overridden from the environment, so the script
+# can be run outside of a deployed node (see benchmarks/mmexternal.py)
 logging.basicConfig(
-    filename='/var/log/paragun/rsysparse.log', 
+    filename=os.environ.get('RSYSPARSE_LOG', '/var/log/paragun/rsysparse.log'), 
     format='%(asctime)s [%(levelname)-8s] %(filename)s.%(funcName)s:%(lineno)d %(message)s', 
     filemode='a+', 
     level=logging.INFO
 )
+logger = logging.getLogger(__name__)
+
+# Whether debug messages are wanted; checked before building any in the
+# per-event path. Refreshed by onInit()
+debug = logger.isEnabledFor(logging.DEBUG)
 
 start_time = time()
 
 # How often to reload the parser tree, in minutes
-refresh_interval = 15
+refresh_interval = float(os.environ.get('RSYSPARSE_REFRESH', 15))
+parsers_path = os.environ.get('RSYSPARSE_PARSERS', '/var/log/paragun/lookups/parsers.json')
+geoip_path = os.environ.get('RSYSPARSE_GEOIP', '/usr/share/GeoIP')
+
+# How often to flush event counts to the metrics index, in seconds
+metrics_interval = 60
+metrics_path = os.environ.get('RSYSPARSE_METRICS', '/var/log/paragun/metrics/index')
+
+# Event counts come from rsyslog's own dyn_stats counters (see rsysstats.py),
+# so by default the parser only reports bytes
+metrics_counts = False
+
+# Per token/host/app event counter; created by onInit()
+metrics = None
+
+# On-demand profiling (see Profiler); `kill -USR2` or touching the trigger
+# file in this directory profiles for profile_duration seconds
+profile_path = os.environ.get('RSYSPARSE_PROFILE_DIR', '/var/log/paragun')
+profile_duration = 30
+profiler = None
+
+# Parser tree; (re)created by onInit()
+engine = None
 
-mm_isp_db = geoip2.database.Reader('/usr/share/GeoIP/latest-isp')
-mm_city_db = geoip2.database.Reader('/usr/share/GeoIP/latest-city')
-asn_db = pyasn.pyasn('/usr/share/GeoIP/latest-asn')
+# Where replies to rsyslog go. When run by rsyslog, sys.stdout is replaced
+# with a StrayOutput so nothing but replies can reach the protocol stream
+output = sys.stdout
+
+# GeoIP/ASN database handles; opened by open_databases()
+mm_isp_db = None
+mm_city_db = None
+asn_db = None
+
+# IPv4 interval index answering GeoIP/ASN lookups from memory (see GeoIndex);
+# loaded by open_index() from its sidecar file, which `rsysparse.py
+# --build-index` writes. Set RSYSPARSE_GEOIP_INDEX_BUILD=1 to have onInit()
+# build it when the sidecar is missing or older than the databases
+geoip_index_path = os.environ.get('RSYSPARSE_GEOIP_INDEX', os.path.join(geoip_path, 'latest-index.npz'))
+geoip_index_build = os.environ.get('RSYSPARSE_GEOIP_INDEX_BUILD') == '1'
+geo_index = None
+
+class ErrorReporter(object):
+    """
+    Rate-limited error logging for the per-event path, so a bad parser or
+    database can't turn every event into a traceback in rsysparse.log.
+    
+    The first error of each kind (where it happened and its exception type)
+    in an interval is logged with its traceback; the rest are only counted,
+    and the counts are logged once the interval is over. Every error, logged
+    or not, is also kept in a ring buffer of the most recent ones, which
+    dump() writes out on SIGUSR1.
+    
+    """
+    def __init__(self, interval=60, size=1000, *args, **kwargs):
+        self.interval = interval
+        self.recent = deque(maxlen=size)
+        self.counts = {}
+        self.suppressed = {}
+        self.since = time()
+    
+    def report(self, where, error, detail=None):
+        """
+        Args:
+            where (str): Where the error happened, e.g. 'Parser.parse'.
+            error (Exception): The error.
+        
+        Kwargs:
+            detail (str): Context to log with it, such as the field.
+        
+        """
+        now = time()
+        key = (where, type(error).__name__)
+        message = str(error) if detail is None else '%s (%s)' % (error, detail)
+        self.recent.append((now, where, key[1], message))
+        self.counts[key] = self.counts.get(key, 0) + 1
+        
+        if key in self.suppressed:
+            self.suppressed[key] += 1
+        else:
+            self.suppressed[key] = 0
+            logger.error('%s: %s' % (where, message), exc_info=error)
+        
+        if now - self.since >= self.interval:
+            self.flush(now)
+    
+    def flush(self, now=None):
+        """
+        Logs how many errors of each kind were suppressed, and starts a new
+        interval.
+        
+        """
+        now = now or time()
+        for (where, kind), count in sorted(self.suppressed.items()):
+            if count: logger.warning('%s more %s errors in %s in the last %ds.' % (count, kind, where, now - self.since))
+        self.suppressed = {}
+        self.since = now
+    
+    def dump(self, *args):
+        """
+        Writes the buffered errors to the log. Takes (and ignores) signal
+        handler arguments.
+        
+        """
+        logger.warning('Last %s of %s errors since start:' % (len(self.recent), sum(self.counts.values())))
+        for ts, where, kind, message in list(self.recent):
+            logger.warning('%s %s %s: %s' % (strftime('%Y-%m-%dT%H:%M:%SZ', gmtime(ts)), where, kind, message))
+
+
+errors = ErrorReporter()
+
+
+class Profiler(object):
+    """
+    Sampling profiler that can be switched on inside a running process, with
+    `kill -USR2` (if install() was called) or by touching a trigger file.
+    
+    While active, a CPU-time interval timer (SIGPROF) interrupts the main
+    thread every `interval` seconds and records its stack; after `duration`
+    seconds the timer is stopped and two files are written to `path`:
+    
+    * profile-<name>-<pid>-<time>.folded: collapsed stacks, one
+      "outermost;...;innermost count" line per stack, for flamegraph.pl or
+      speedscope.
+    * profile-<name>-<pid>-<time>.parsers.tsv: samples (and estimated CPU
+      seconds) spent in each service/field parser, GeoIP lookups included.
+    
+    When inactive no timer or handler is installed; the only cost is poll(),
+    which looks at the trigger file at most once a second.
+    
+    """
+    def __init__(self, name, path, interval=0.005, duration=30, *args, **kwargs):
+        """
+        Args:
+            name (str): Process name used in the output file names.
+            path (str): Directory for the output and the trigger file.
+        
+        Kwargs:
+            interval (float): CPU seconds between samples.
+            duration (float): Seconds to profile for, unless the trigger
+                file holds another number.
+        
+        """
+        self.name = name
+        self.path = path
+        self.interval = interval
+        self.duration = duration
+        self.trigger = os.path.join(path, 'profile.trigger')
+        self.active = False
+        self.checked = 0
+        
+        # A trigger file left over from before we started is not a request
+        try: self.triggered = os.stat(self.trigger).st_mtime
+        except OSError: self.triggered = 0
+    
+    def install(self):
+        signal.signal(signal.SIGUSR2, self.start)
+    
+    def poll(self, now=None):
+        """
+        Starts profiling if the trigger file has been touched since it was
+        last seen. Every process polling the same file profiles once, for as
+        many seconds as the file holds (or the default if it is empty).
+        
+        """
+        now = now or time()
+        if now - self.checked < 1: return
+        self.checked = now
+        
+        try: mtime = os.stat(self.trigger).st_mtime
+        except OSError: return
+        if mtime <= self.triggered: return
+        self.triggered = mtime
+        
+        try:
+            with open(self.trigger) as f:
+                duration = float(f.read().strip() or self.duration)
+        except (OSError, ValueError):
+            duration = self.duration
+        self.start(duration=duration)
+    
+    def start(self, *args, **kwargs):
+        """
+        Starts sampling. Also a signal handler, so takes (and ignores) signal
+        handler arguments.
+        
+        Kwargs:
+            duration (float): Seconds to profile for.
+        
+        """
+        if self.active: return
+        self.stacks = {}
+        self.parsers = {}
+        self.samples = 0
+        self.started = time()
+        self.until = self.started + kwargs.get('duration', self.duration)
+        self.active = True
+        
+        logger.info('Profiling for %ss.' % round(self.until - self.started, 1))
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+    
+    def sample(self, signum, frame):
+        self.samples += 1
+        stack = []
+        parser = service = None
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s)' % (code.co_name, os.path.basename(code.co_filename)))
+            if code.co_name == 'parse':
+                owner = frame.f_locals.get('self')
+                if parser is None and isinstance(owner, Parser): parser = owner.field
+                elif service is None and isinstance(owner, ParsingEngine): service = frame.f_locals.get('service')
+            frame = frame.f_back
+        
+        key = ';'.join(reversed(stack))
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+        if parser is not None:
+            key = (service or '-', parser)
+            self.parsers[key] = self.parsers.get(key, 0) + 1
+        
+        if time() >= self.until: self.stop()
+    
+    def stop(self):
+        """
+        Stops sampling and writes out the results.
+        
+        Returns:
+            paths (tuple): The collapsed stacks and per-parser files, or None
+                if the profiler was not active.
+        
+        """
+        if not self.active: return None
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        self.active = False
+        
+        try:
+            return self.write()
+        except OSError as e:
+            logger.error('Could not write profile: %s' % e)
+            return None
+    
+    def write(self):
+        prefix = os.path.join(self.path, 'profile-%s-%s-%s' % (self.name, os.getpid(), strftime('%Y%m%dT%H%M%S', gmtime(self.started))))
+        
+        with open(prefix + '.folded', 'w') as f:
+            for stack, count in sorted(self.stacks.items(), key=lambda x: -x[1]):
+                f.write('%s %s\n' % (stack, count))
+        
+        with open(prefix + '.parsers.tsv', 'w') as f:
+            f.write('service\tfield\tsamples\tcpu_seconds\tshare\n')
+            for (service, field), count in sorted(self.parsers.items(), key=lambda x: -x[1]):
+                f.write('%s\t%s\t%s\t%.3f\t%.4f\n' % (service, field, count, count * self.interval, count / self.samples))
+        
+        logger.info('Wrote %s samples over %ss to %s.folded and %s.parsers.tsv.' % (self.samples, round(time() - self.started, 1), prefix, prefix))
+        return prefix + '.folded', prefix + '.parsers.tsv'
+
+
+class StrayOutput(object):
+    """
+    Stands in for sys.stdout while running under rsyslog. rsyslog reads one
+    reply line per event from stdout, so a stray print() (from this script or
+    a library) would be taken as the reply to the next event and shift every
+    reply after it; anything written here goes to the log instead.
+    
+    """
+    def write(self, data):
+        if data.strip(): logger.warning('Stray output: %r' % data)
+        return len(data)
+    
+    def flush(self):
+        pass
+
+# Start of the local variable tree ($!) in mmexternal's fulljson input
+local_vars = re.compile(r'"\$!"\s*:\s*')
+json_decoder = json.JSONDecoder()
+
+def local_properties(blob):
+    """
+    Decodes only the `$!` object of a fulljson message from rsyslog.
+    
+    mmexternal can't be given a template; fulljson is the only input that
+    carries local variables, and most of it is the message itself (twice,
+    as msg and rawmsg) plus properties the parser never reads. Rather than
+    decoding all of it, this finds `"$!":` and decodes from there to the
+    end of that object. Inside JSON strings quotes are always escaped, so
+    the key can't be matched inside a message.
+    
+    Args:
+        blob (str): One line of fulljson input.
+    
+    Returns:
+        properties (dict): The local variables; empty if there are none.
+    
+    """
+    match = local_vars.search(blob)
+    if not match: return {}
+    try:
+        return json_decoder.raw_decode(blob, match.end())[0]
+    except ValueError:
+        return json.loads(blob).get('$!', {})
+
+
+def boolean(value):
+    """
+    Casts a boolean field, read from a regex match, key=value text or JSON.
+    
+    Returns:
+        value (bool): True for true/yes/on/1 and False for false/no/off/0,
+            in any case.
+    
+    Raises:
+        ValueError: For anything else.
+    
+    """
+    if isinstance(value, bool): return value
+    text = str(value).strip().lower()
+    if text in ('true', 'yes', 'on', '1'): return True
+    if text in ('false', 'no', 'off', '0'): return False
+    raise ValueError('%r is not a boolean' % (value,))
 
 class Parser(object):
     
@@ -38,63 +370,78 @@ class Parser(object):
         
         self.parsers = tuple(re.compile(x) for x in kwargs['parsers'])
         
+        # Whether values are lists or objects rather than scalars
+        self.container = self.type in ('list', 'dict')
+        
+        # The default, match-all validator is never run
         validator_regex = kwargs.pop('validator')
-        self.validator = re.compile('^%s$' % validator_regex)
+        self.validator = re.compile('^%s$' % validator_regex) if validator_regex != '(.*)' else None
     
     def parse(self, message, *args, **kwargs):
-        logger = logging.getLogger(__name__)
-        value = {}
-
         for parser in self.parsers:
             try:
                 match = parser.search(message)
                 if not match: continue
             
-                # Match found. Proceed with validation
-                raw_value = match.group(1)
-                
-                # Try casting
-                value = self.typecast(raw_value)
-                if not value: continue
-                
-                # Try validating
-                validated = self.validate(str(value))
-                if not validated: continue
-                
-                return {self.field: value}
+                # Match found. Proceed with casting and validation
+                value = self.extract(match.group(1))
+                if value: return value
                 
             except Exception as e:
-                logger.error(e, exc_info=True)
+                errors.report('Parser.parse', e, self.field)
                 
+        return {}
+    
+    def extract(self, raw_value, *args, **kwargs):
+        """
+        Casts and validates a raw value, whether matched by a regex or read
+        from a structured (JSON or key=value) message.
+        
+        Returns:
+            value (dict): {field: value}, or empty if the value doesn't cast
+                or validate. False and 0 are values like any other; empty
+                strings, lists and objects are not.
+        
+        """
+        value = self.typecast(raw_value)
+        if value is None or value in ('', [], {}): return {}
+        
+        if self.validator is not None and not self.validate(str(value)): return {}
+        
+        return {self.field: value}
+    
+    def enrich(self, value, *args, **kwargs):
+        """
+        Adds anything derived from an extracted value; nothing, by default.
+        
+        """
         return value
     
     def typecast(self, value):
-        logger = logging.getLogger(__name__)
         casted = ''
         
         try:
             casted = self.cast(value)
         except Exception as e:
-            logger.error("%s failed casting to %s." % (value, self.type))
-            logger.error(e)
+            errors.report('Parser.typecast', e, '%s to %s' % (self.field, self.type))
             
         return casted
     
     def validate(self, value, *args, **kwargs):
-        logger = logging.getLogger(__name__)
+        if self.validator is None: return True
         
         # Validate the extracted value
         try:
             match = self.validator.search(value)
             if match:
-                logger.debug('Validated %s %s (%s).' % (self.field, value, self.validator))
+                if debug: logger.debug('Validated %s %s (%s).' % (self.field, value, self.validator))
                 return True
             else:
-                logger.debug('Failed %s validation: %s.' % (self.field, value,))
+                if debug: logger.debug('Failed %s validation: %s.' % (self.field, value,))
                 return False
                 
         except Exception as e:
-            logger.error(e, exc_info=True)
+            errors.report('Parser.validate', e, self.field)
             return False
             
             
@@ -102,8 +449,10 @@ class IPParser(Parser):
     
     @classmethod
     def geoip(cls, ip, *args, **kwargs):
-        logger = logging.getLogger(__name__)
-        logger.debug("Geolocating %s..." % ip)
+        if debug: logger.debug("Geolocating %s..." % ip)
+        if geo_index is not None and kwargs.get('index', True):
+            geo = geo_index.lookup(ip)
+            if geo is not None: return geo
         geo = {}
         
         # Get ASN info
@@ -121,12 +470,12 @@ class IPParser(Parser):
             geo['v6_bgp_end'] = str(IPAddress(network.last).format(dialect=ipv6_verbose))
             
         except Exception as e:
-            logger.error(e)
+            errors.report('IPParser.geoip.asn', e)
         
         # Get ISP info
         try: response = mm_isp_db.asn(ip)
         except Exception as e: 
-            logger.error(e)
+            errors.report('IPParser.geoip.isp', e)
             response = None
         
         if response:
@@ -138,7 +487,7 @@ class IPParser(Parser):
         # Get City info
         try: response = mm_city_db.city(ip)
         except Exception as e: 
-            logger.error(e)
+            errors.report('IPParser.geoip.city', e)
             response = None
         
         if response:
@@ -159,12 +508,43 @@ class IPParser(Parser):
         
         return geo
     
+    @classmethod
+    def geoip_batch(cls, ips, *args, **kwargs):
+        """
+        Looks up a batch of addresses, each distinct one only once: IPv4
+        addresses from the GeoIP index if there is one, and the rest from the
+        databases.
+        
+        Args:
+            ips (iterable): Addresses to look up, repeats included.
+        
+        Returns:
+            geo (dict): {ip: geoip(ip)} for every distinct address.
+        
+        """
+        ips = set(ips)
+        geo = geo_index.lookup_batch(ips) if geo_index is not None else {}
+        for ip in ips:
+            if ip not in geo: geo[ip] = cls.geoip(ip, index=False)
+        return geo
+    
     def parse(self, message, *args, **kwargs):
-        logger = logging.getLogger(__name__)
-
         value = super().parse(message, *args, **kwargs)
         if not value: return value
+        return self.enrich(value, **kwargs)
+    
+    def enrich(self, value, *args, **kwargs):
+        """
+        Adds the IPv4 and IPv6 forms of an extracted address, whether it is
+        private and, for public addresses, its GeoIP/ASN details.
         
+        Kwargs:
+            geoip (bool): Whether to look up public addresses; if not, the
+                caller is expected to (see ParsingEngine.parse_batch).
+            deferred (list): If given, (field, address) is appended to it for
+                a public address left unlooked up because geoip is False.
+        
+        """
         # Do some additional IP-specific enhancement
         ip = value[self.field]
         
@@ -182,9 +562,11 @@ class IPParser(Parser):
         value[self.field] = str(ip)
         
         # If not private, do geoip lookup
-        if not is_private:
+        if not is_private and kwargs.get('geoip', True):
             geo = self.geoip(str(ip))
             value.update({'%s_%s' % (self.field, k): v for k,v in geo.items()})
+        elif not is_private and kwargs.get('deferred') is not None:
+            kwargs['deferred'].append((self.field, value[self.field]))
         
         return value
     
@@ -194,7 +576,7 @@ class ParsingEngine(object):
     def __init__(self, *args, **kwargs):
         self.type_map = {
             'str': str,
-            'bool': bool,
+            'bool': boolean,
             'int': int,
             'float': float,
             'ip': IPAddress,
@@ -202,64 +584,356 @@ class ParsingEngine(object):
             'dict': dict,
         }
         
-        self._punct = re.compile('([^a-zA-Z0-9])')
+        # Punctuation characters, and how many of them to keep
+        self._punct = re.compile('[^a-zA-Z0-9]')
+        self._punct_limit = 30
+        
+        # Line boundaries recognized by str.splitlines(), besides \n and \r
+        self._linebreaks = re.compile('[\v\f\x1c\x1d\x1e\x85\u2028\u2029]')
+        self._eol = frozenset('\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029')
         
+        # Message families are keyed on up to two leading words
+        self._family = re.compile('[A-Za-z]+(?: [A-Za-z]+)?')
+        
+        # key=value pairs (logfmt); keys start a word, values may be quoted.
+        # Only messages made up of nothing but pairs are logfmt, so text that
+        # merely contains a few (e.g. firewall logs) is left to the regexes
+        pair = '([A-Za-z_][\\w.\\-]*)=("(?:[^"\\\\]|\\\\.)*"|[^\\s"]*)'
+        self._pair = re.compile('(?<!\\S)' + pair)
+        self._logfmt = re.compile('\\s*(?:%s\\s+)*%s\\s*' % (pair, pair))
+        self._pair_minimum = 2
+        
+        self.parse_tree = {}
+        self.families = {}
+        
+        # Every known field, for values read from structured messages
+        self.fields = {}
+    
     def parse(self, service, message, *args, **kwargs):
-        logger = logging.getLogger(__name__)
-        logger.info("Parsing new message...")
+        """
+        Extracts the fields of a message.
         
+        Values that a JSON or key=value message labels itself, under a known
+        field key, take precedence; the service's regex parsers then only run
+        for the fields still missing, so structured events that carry every
+        field skip regex matching entirely.
+        
+        Kwargs:
+            geoip (bool): Whether to look up public addresses.
+            deferred (list): Passed on to IPParser.enrich.
+        
+        Returns:
+            data (dict): Extracted (and enriched) fields, plus the message's
+                punct signature and line count.
+        
+        """
         data = {}
         
-        for field, parser in self.parse_tree.get(service, {}).items():
-            logger.debug("Parsing %s..." % field)
-            parsed = parser.parse(message)
+        pairs = self.structured(message)
+        if pairs:
+            data = self.extract(service, pairs, **kwargs)
+        
+        for field, parser in self.parsers(service, message):
+            if field in data: continue
+            if debug: logger.debug("Parsing %s..." % field)
+            parsed = parser.parse(message, **kwargs)
             if parsed: data.update(parsed)
                 
-        # Calculate punct string
-        data['punct'] = re.sub(' ', '_', ''.join(re.findall(self._punct, message)[:30]))
+        # Calculate punct string and line count
+        data['punct'], data['linecount'] = self.signature(message)
+        
+        return data
+    
+    def parse_batch(self, items, *args, **kwargs):
+        """
+        Parses a batch of messages, looking up each distinct public address
+        in the batch only once (attackers and busy clients show up in many
+        events of the same batch) and spreading the results back.
+        
+        Args:
+            items (iterable): (service, message) pairs.
+        
+        Kwargs:
+            counters (dict): If given, `geoip_requested` (public addresses
+                found) and `geoip_lookups` (distinct ones looked up) are added
+                to it.
+            pause (callable): Called without arguments every `pause_every`
+                (default 50) messages, e.g. to let other greenthreads run.
+        
+        Returns:
+            data (list): parse() results, in the same order.
+        
+        """
+        pause = kwargs.get('pause')
+        pause_every = kwargs.get('pause_every', 50)
+        
+        results = []
+        pending = []
+        for i, (service, message) in enumerate(items, 1):
+            if pause and i % pause_every == 0: pause()
+            
+            # Public addresses the IP parsers left for the batch lookup
+            deferred = []
+            try:
+                data = self.parse(service, message, geoip=False, deferred=deferred)
+            except Exception as e:
+                errors.report('ParsingEngine.parse_batch', e, service)
+                data, deferred = {}, []
+            
+            pending.extend((data, field, ip) for field, ip in deferred)
+            results.append(data)
+        
+        geo = IPParser.geoip_batch(ip for data, field, ip in pending)
+        for data, field, ip in pending:
+            data.update({'%s_%s' % (field, k): v for k,v in geo[ip].items()})
+        
+        counters = kwargs.get('counters')
+        if counters is not None:
+            counters['geoip_requested'] = counters.get('geoip_requested', 0) + len(pending)
+            counters['geoip_lookups'] = counters.get('geoip_lookups', 0) + len(geo)
+        
+        return results
+    
+    def signature(self, message, *args, **kwargs):
+        """
+        Computes the punct signature and line count of a message.
+        
+        Equivalent to
+            
+            re.sub(' ', '_', ''.join(re.findall('([^a-zA-Z0-9])', message)[:30]))
+            len(message.splitlines())
         
-        # Calculate line count
-        data['linecount'] = len(message.splitlines())
+        but stops scanning for punctuation once the first 30 characters have
+        been found and counts line breaks instead of allocating every line.
+        
+        Returns:
+            signature (tuple): (punct, linecount)
+        
+        """
+        limit = self._punct_limit
+        size = len(message)
+        
+        # Scan in growing windows; most messages are done within the first
+        # 128 characters
+        chars = []
+        pos = 0
+        step = 128
+        while len(chars) < limit and pos < size:
+            chars += self._punct.findall(message, pos, pos + step)
+            pos += step
+            step *= 2
+        
+        punct = ''.join(chars[:limit]).replace(' ', '_')
+        
+        if not size:
+            return punct, 0
+        
+        # \r\n is a single boundary; a trailing boundary doesn't start a line
+        linecount = message.count('\n') + message.count('\r') - message.count('\r\n')
+        linecount += len(self._linebreaks.findall(message))
+        if message[-1] not in self._eol:
+            linecount += 1
+        
+        return punct, linecount
+        
+    def structured(self, message, *args, **kwargs):
+        """
+        Reads the key/value pairs of a JSON object or key=value (logfmt)
+        message in a single pass.
+        
+        Keys are lowercased, with dashes and dots turned into underscores;
+        nested JSON objects are flattened by joining keys with underscores
+        (i.e. {"src": {"ip": ...}} gives src_ip). Messages with fewer than two
+        key=value pairs, or with anything besides pairs, aren't considered
+        structured.
+        
+        Returns:
+            pairs (dict): {key: raw value}, or None if the message isn't
+                structured.
+        
+        """
+        if message[:1] == '{' and message.rstrip()[-1:] == '}':
+            try: obj = json.loads(message)
+            except ValueError: return None
+            if not isinstance(obj, dict): return None
+            
+            pairs = {}
+            stack = [('', obj)]
+            while stack:
+                prefix, obj = stack.pop()
+                for key, value in obj.items():
+                    key = prefix + key.lower().replace('-', '_').replace('.', '_')
+                    if isinstance(value, dict): stack.append((key + '_', value))
+                    elif value is not None: pairs[key] = value
+            return pairs
+        
+        if '=' not in message or not self._logfmt.fullmatch(message): return None
+        
+        found = self._pair.findall(message)
+        if len(found) < self._pair_minimum: return None
+        
+        pairs = {}
+        for key, value in found:
+            if value[:1] == '"': value = value[1:-1].replace('\\"', '"')
+            if value: pairs[key.lower().replace('-', '_').replace('.', '_')] = value
+        return pairs
+    
+    def extract(self, service, pairs, *args, **kwargs):
+        """
+        Casts, validates and enriches the values of a structured message
+        whose keys are known fields, using the service's own parser for the
+        field if it has one.
+        
+        Returns:
+            data (dict): Extracted fields.
+        
+        """
+        fields = self.parse_tree.get(service, {})
+        
+        data = {}
+        for key, raw_value in pairs.items():
+            parser = fields.get(key) or self.fields.get(key)
+            if parser is None: continue
+            
+            # Lists and objects only fill fields of that type
+            if isinstance(raw_value, (list, dict)) != parser.container: continue
+            
+            try:
+                value = parser.extract(raw_value)
+                if value: data.update(parser.enrich(value, **kwargs))
+            except Exception as e:
+                errors.report('ParsingEngine.extract', e, key)
         
         return data
+    
+    def family(self, message, *args, **kwargs):
+        """
+        Identifies the message family (i.e. sshd's "Failed password" or
+        "Accepted publickey") from its leading words.
+        
+        Returns:
+            family (str): Lowercased family key; empty if the message doesn't
+                start with a word.
+        
+        """
+        match = self._family.match(message)
+        if not match: return ''
+        return match.group().lower()
+    
+    def parsers(self, service, message, *args, **kwargs):
+        """
+        Picks the field parsers worth running against a message.
+        
+        If the service has a family map and the message belongs to a known
+        family, the fields that matched none of that family's samples are
+        left out; every other field of the service, including any added since
+        the map was built, is returned.
+        
+        Returns:
+            parsers (list): (field, Parser) pairs, in parse tree order.
+        
+        """
+        fields = self.parse_tree.get(service, {})
+        
+        families = self.families.get(service)
+        if families:
+            skip = families.get(self.family(message))
+            if skip:
+                return [(field, parser) for field, parser in fields.items() if field not in skip]
+        
+        return list(fields.items())
+    
+    def matching_fields(self, service, message, *args, **kwargs):
+        """
+        Returns:
+            fields (list): Fields of the service that extract a value from the
+                message, checked without any enrichment (i.e. GeoIP).
+        
+        """
+        return [field for field, parser in self.parse_tree.get(service, {}).items() if Parser.parse(parser, message)]
+    
+    def build_families(self, service, messages, *args, **kwargs):
+        """
+        Builds a family map for a service from sample messages: each family
+        found maps to the fields that matched none of its samples, which are
+        the ones parse() may skip for it.
+        
+        Args:
+            service (str): Service key.
+            messages (iterable): Sample message bodies (without syslog header).
+        
+        Returns:
+            families (dict): {family: [fields, in parse tree order]}
+        
+        """
+        order = list(self.parse_tree.get(service, {}).keys())
         
+        matched = {}
+        for message in messages:
+            fields = matched.setdefault(self.family(message), set())
+            fields.update(self.matching_fields(service, message))
+        
+        return {family: [x for x in order if x not in fields] for family, fields in matched.items()}
+    
     def load_parsers(self, parse_tree, *args, **kwargs):
         """
         Precompile the regexes for all valid parsers and get associated
         attributes.
         
+        Keys starting with an underscore are metadata rather than fields; a
+        service's `_family_skip` entry is its optional family map, and the
+        top-level `_fields` entry lists the type and validator of every known
+        field, for values read from structured messages.
+        
         """
-        logger = logging.getLogger(__name__)
         logger.info("Building parsing tree...")
         
         self.parse_tree = {}
+        self.families = {}
+        self.fields = {}
         for service in parse_tree.keys():
+            if service.startswith('_'): continue
+            
             self.parse_tree[service] = {}
             for field in parse_tree[service].keys():
-                data = parse_tree[service][field]
-                data['cast'] = self.type_map[data['type']]
-                data['field'] = field
+                if field.startswith('_'): continue
                 
                 logger.debug('%s: %s' % (service, field))
+                self.parse_tree[service][field] = self.build_parser(field, parse_tree[service][field])
+            
+            families = parse_tree[service].get('_family_skip')
+            if families:
+                self.families[service] = {family: frozenset(fields) for family, fields in families.items()}
                 
-                Model = Parser
-                if data['type'] == 'ip':
-                    Model = IPParser
-                
-                self.parse_tree[service][field] = Model(**data)
-                
+        for field, data in parse_tree.get('_fields', {}).items():
+            self.fields[field] = self.build_parser(field, dict(data, parsers=[]))
+        
         logger.info("Done building parsing tree.")
         logger.debug(self.parse_tree)
     
+    def build_parser(self, field, data, *args, **kwargs):
+        """
+        Returns:
+            parser (Parser): Parser for a field, from its parse tree entry.
+        
+        """
+        data['cast'] = self.type_map[data['type']]
+        data['field'] = field
+        
+        Model = Parser
+        if data['type'] == 'ip':
+            Model = IPParser
+        
+        return Model(**data)
+    
     def read_parser_file(self, *args, **kwargs):
         """
         Reads parse tree structure from file and closes it as quickly as possible.
         
         """
-        logger = logging.getLogger(__name__)
         logger.info("Reading parsers from file...")
         
-        path = kwargs.get('path', '/var/log/paragun/lookups/parsers.json')
+        path = kwargs.get('path', parsers_path)
         
         try:
             parse_tree = {}
@@ -272,6 +946,458 @@ class ParsingEngine(object):
         return parse_tree
 
 
+class Metrics(object):
+    """
+    Counts events and bytes per token, host and app in memory and
+    periodically appends the totals to the metrics index, one line per key:
+        
+        token\t\thost\t\tapp\t\tcount\t\tbytes
+    
+    This is the format PulseUpdateView accepts, so rsyslog no longer has to
+    write a line to the index for every event.
+    
+    More than one parser process can run at once; each appends its own
+    totals and rsysaggregate.py sums them when the index is rotated.
+    
+    Unless `counts` is set, the count column is written as 0 and only bytes
+    are reported, since rsysstats.py appends rsyslog's event counts for the
+    same keys.
+    
+    """
+    def __init__(self, path=None, interval=None, *args, **kwargs):
+        self.path = path or metrics_path
+        self.interval = interval or metrics_interval
+        self.counts = kwargs.get('counts', metrics_counts)
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+    
+    def add(self, token, host, app, size=0):
+        key = (token, host, app)
+        with self.lock:
+            entry = self.counters.get(key)
+            if entry is None:
+                self.counters[key] = [1, size]
+            else:
+                entry[0] += 1
+                entry[1] += size
+    
+    def record(self, properties):
+        """
+        Counts an event from the local ($!) properties rsyslog passes in.
+        
+        """
+        token = properties.get('token_ext')
+        if not token: return
+        
+        try:
+            size = int(properties.get('msg_bytes') or 0)
+        except ValueError:
+            size = 0
+        
+        self.add(token, properties.get('fromhost-ip_clean', ''), properties.get('programname_clean', ''), size)
+    
+    def flush(self):
+        """
+        Appends the current totals to the metrics index and resets them.
+        
+        Returns:
+            count (int): Number of lines written.
+        
+        """
+        
+        with self.lock:
+            counters, self.counters = self.counters, {}
+        
+        if not counters:
+            return 0
+        
+        lines = ''.join(
+            '%s\t\t%s\t\t%s\t\t%s\t\t%s\n' % (token, host or '-', app or '-', count if self.counts else 0, size)
+            for (token, host, app), (count, size) in counters.items()
+        )
+        
+        # Reopen each time so logrotate can move the file out from under us
+        try:
+            with open(self.path, 'a') as f:
+                f.write(lines)
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            
+            # Keep the counts for the next attempt
+            with self.lock:
+                for key, (count, size) in counters.items():
+                    entry = self.counters.setdefault(key, [0, 0])
+                    entry[0] += count
+                    entry[1] += size
+            return 0
+        
+        return len(counters)
+    
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+    
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='metrics', daemon=True)
+            self.thread.start()
+    
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+
+def describe_prefix(first, length):
+    """
+    Returns:
+        row (tuple): (bgp, v6_bgp_beg, v6_bgp_end) the way IPParser.geoip()
+            gives them for an IPv4 BGP prefix.
+    
+    """
+    last = first | (1 << (32 - length)) - 1
+    return (
+        '%s/%s' % (socket.inet_ntoa(first.to_bytes(4, 'big')), length),
+        '0000:0000:0000:0000:0000:ffff:%04x:%04x' % (first >> 16, first & 0xffff),
+        '0000:0000:0000:0000:0000:ffff:%04x:%04x' % (last >> 16, last & 0xffff),
+    )
+
+
+def asn_networks(db):
+    """
+    Yields (first, last, (first, length)) for every IPv4 prefix in a pyasn
+    database. Prefixes nest; see flatten().
+    
+    """
+    for prefix in db.radix.prefixes():
+        if ':' in prefix: continue
+        address, length = prefix.split('/')
+        if db.radix.search_exact(address, masklen=int(length)).asn is None: continue
+        
+        first = int.from_bytes(socket.inet_aton(address), 'big')
+        yield first, first | (1 << (32 - int(length))) - 1, (first, int(length))
+
+
+def mmdb_networks(path, describe):
+    """
+    Yields (first, last, describe(record)) for every IPv4 network in a MaxMind
+    database, in address order.
+    
+    maxminddb 1.4.1 (pinned in deploy.yml) has no way to list a database's
+    networks, so this walks the search tree with the pure Python reader's
+    private methods, starting from the IPv4 subtree (::/96 in IPv6
+    databases). Each record is only decoded and described once, however many
+    networks share it. A reader without those methods raises AttributeError
+    before anything is yielded (open_index then goes without an index).
+    
+    """
+    import maxminddb.reader
+    
+    reader = maxminddb.reader.Reader(path, MODE_MMAP)
+    try:
+        start_node, read_node, resolve = reader._start_node, reader._read_node, reader._resolve_data_pointer
+        count = reader.metadata().node_count
+        described = {}
+        stack = [(start_node(32), 0, 0)]
+        while stack:
+            node, depth, prefix = stack.pop()
+            if node == count: continue
+            if node > count:
+                if node not in described: described[node] = describe(resolve(node))
+                first = prefix << (32 - depth)
+                yield first, first | (1 << (32 - depth)) - 1, described[node]
+                continue
+            if depth == 32: continue
+            
+            # Left (0) is pushed last so it comes out first
+            stack.append((read_node(node, 1), depth + 1, prefix << 1 | 1))
+            stack.append((read_node(node, 0), depth + 1, prefix << 1))
+    finally:
+        reader.close()
+
+
+def describe_isp(record):
+    return (record.get('autonomous_system_number'), record.get('autonomous_system_organization'))
+
+
+def describe_city(record):
+    """
+    Returns:
+        row (tuple): (iso, iso_local, lat, lon) the way IPParser.geoip()
+            reads them from a geoip2 City response.
+    
+    """
+    iso = (record.get('country') or {}).get('iso_code')
+    subdivisions = record.get('subdivisions') or [{}]
+    location = record.get('location') or {}
+    return (iso, '%s-%s' % (iso, subdivisions[-1].get('iso_code') or '??'), location.get('latitude'), location.get('longitude'))
+
+
+def flatten(ranges):
+    """
+    Turns nested ranges (such as BGP prefixes, which nest but never
+    partially overlap) into disjoint ones, each address keeping the row of
+    the most specific range covering it.
+    
+    Args:
+        ranges (iterable): (first, last, row) in any order.
+    
+    Returns:
+        ranges (generator): Disjoint (first, last, row) in address order.
+    
+    """
+    # Ranges enclosing the current one, innermost last, and the first address
+    # not yielded yet
+    stack, position = [], 0
+    for first, last, row in sorted(ranges, key=lambda x: (x[0], -x[1])):
+        while stack and stack[-1][1] < first:
+            outer_last, outer_row = stack.pop()[1:]
+            if position <= outer_last:
+                yield position, outer_last, outer_row
+                position = outer_last + 1
+        if stack and position < first:
+            yield position, first - 1, stack[-1][2]
+        position = max(position, first)
+        stack.append((first, last, row))
+    
+    while stack:
+        outer_last, outer_row = stack.pop()[1:]
+        if position <= outer_last:
+            yield position, outer_last, outer_row
+            position = outer_last + 1
+
+
+class GeoIndex(object):
+    """
+    In-memory index answering IPParser.geoip() for IPv4 addresses, a whole
+    batch at a time, with one numpy.searchsorted per database instead of
+    three database lookups per address.
+    
+    Each database (pyasn, ISP and City) becomes sorted, disjoint address
+    ranges, each pointing at a row of the fields geoip() reads from it (for
+    pyasn, the prefix, formatted on the way out).
+    Addresses outside any range of one of the databases, and IPv6 addresses,
+    are left to the readers.
+    
+    Building it walks every IPv4 network in the databases, which takes a
+    while; save() writes it to a sidecar file that load() reads back in a
+    fraction of that time.
+    
+    """
+    SOURCES = ('asn', 'isp', 'city')
+    VERSION = 1
+    
+    def __init__(self, ranges, tables, *args, **kwargs):
+        """
+        Args:
+            ranges (dict): {source: (firsts, lasts, rows)}; uint32 arrays of
+                the first and last address of each range, and an int32 array
+                of the row in tables[source] it points to.
+            tables (dict): {source: [row]}.
+        
+        Kwargs:
+            mtime (float): Modification time of the sidecar it was loaded from.
+        
+        """
+        self.ranges = ranges
+        self.tables = tables
+        self.mtime = kwargs.get('mtime')
+    
+    def __len__(self):
+        return sum(len(x[0]) for x in self.ranges.values())
+    
+    @classmethod
+    def from_ranges(cls, sources):
+        """
+        Args:
+            sources (dict): {source: disjoint (first, last, row) in address
+                order}, with rows as tuples.
+        
+        Returns:
+            index (GeoIndex): With adjacent ranges of equal rows merged.
+        
+        """
+        from array import array
+        
+        ranges, tables = {}, {}
+        for source in cls.SOURCES:
+            firsts, lasts, rows, numbers = array('I'), array('I'), array('i'), {}
+            for first, last, row in sources[source]:
+                number = numbers.setdefault(row, len(numbers))
+                if rows and rows[-1] == number and lasts[-1] + 1 == first:
+                    lasts[-1] = last
+                    continue
+                firsts.append(first)
+                lasts.append(last)
+                rows.append(number)
+            
+            ranges[source] = (numpy.array(firsts, dtype=numpy.uint32), numpy.array(lasts, dtype=numpy.uint32), numpy.array(rows, dtype=numpy.int32))
+            tables[source] = sorted(numbers, key=numbers.get)
+        return cls(ranges, tables)
+    
+    @classmethod
+    def build(cls, asn, isp_path, city_path):
+        """
+        Args:
+            asn (pyasn.pyasn): Loaded pyasn database.
+            isp_path (str): Path to a MaxMind ASN/ISP database.
+            city_path (str): Path to a MaxMind City database.
+        
+        """
+        return cls.from_ranges({
+            'asn': flatten(asn_networks(asn)),
+            'isp': mmdb_networks(isp_path, describe_isp),
+            'city': mmdb_networks(city_path, describe_city),
+        })
+    
+    @classmethod
+    def load(cls, path):
+        with numpy.load(path, allow_pickle=False) as data:
+            if int(data['version']) != cls.VERSION:
+                raise ValueError('%s is a version %s index, not %s.' % (path, int(data['version']), cls.VERSION))
+            ranges = {x: (data['%s_firsts' % x], data['%s_lasts' % x], data['%s_rows' % x]) for x in cls.SOURCES}
+            tables = json.loads(data['tables'].tobytes().decode('utf-8'))
+        return cls(ranges, tables, mtime=os.path.getmtime(path))
+    
+    def save(self, path):
+        """
+        Writes the index to `path` (an .npz file), replacing any earlier one
+        at once so a reader never sees half of it.
+        
+        """
+        tables = numpy.frombuffer(json.dumps(self.tables, separators=(',', ':')).encode('utf-8'), dtype=numpy.uint8)
+        arrays = {'version': numpy.array(self.VERSION), 'tables': tables}
+        for source, (firsts, lasts, rows) in self.ranges.items():
+            arrays.update({'%s_firsts' % source: firsts, '%s_lasts' % source: lasts, '%s_rows' % source: rows})
+        
+        with open(path + '.tmp', 'wb') as f:
+            numpy.savez(f, **arrays)
+        os.replace(path + '.tmp', path)
+        self.mtime = os.path.getmtime(path)
+    
+    def lookup_batch(self, ips):
+        """
+        Args:
+            ips (iterable): Addresses as strings, repeats included.
+        
+        Returns:
+            geo (dict): {ip: fields} as IPParser.geoip() would give them, for
+                the IPv4 addresses all three databases have a range for.
+        
+        """
+        ips = [ip for ip in set(ips) if ':' not in ip]
+        try:
+            numbers = numpy.frombuffer(b''.join(socket.inet_aton(ip) for ip in ips), dtype='>u4').astype(numpy.uint32)
+        except OSError:
+            ips = [ip for ip in ips if IPAddress(ip).version == 4]
+            numbers = numpy.frombuffer(b''.join(socket.inet_aton(ip) for ip in ips), dtype='>u4').astype(numpy.uint32)
+        if not ips: return {}
+        
+        found = []
+        for source in self.SOURCES:
+            firsts, lasts, rows = self.ranges[source]
+            if not len(firsts):
+                found.append([-1] * len(ips))
+                continue
+            at = numpy.searchsorted(firsts, numbers, side='right') - 1
+            inside = (at >= 0) & (numbers <= lasts[at])
+            found.append(numpy.where(inside, rows[at], -1).tolist())
+        
+        return {ip: self.fields(*rows) for ip, *rows in zip(ips, *found) if min(rows) >= 0}
+    
+    def lookup(self, ip):
+        """
+        Same as lookup_batch() for a single address, without the batch
+        overhead.
+        
+        Returns:
+            geo (dict): Fields as IPParser.geoip() would give them, or None
+                if the index cannot answer for the address.
+        
+        """
+        # Searching with anything but a uint32 would convert the whole array
+        try: number = numpy.uint32(int.from_bytes(socket.inet_aton(ip), 'big'))
+        except OSError: return None
+        
+        found = []
+        for source in self.SOURCES:
+            firsts, lasts, rows = self.ranges[source]
+            at = int(firsts.searchsorted(number, 'right')) - 1
+            if at < 0 or number > lasts[at]: return None
+            found.append(int(rows[at]))
+        return self.fields(*found)
+    
+    def fields(self, asn, isp, city):
+        bgp, v6_bgp_beg, v6_bgp_end = describe_prefix(*self.tables['asn'][asn])
+        number, org = self.tables['isp'][isp]
+        iso, iso_local, lat, lon = self.tables['city'][city]
+        return {'bgp': bgp, 'v6_bgp_beg': v6_bgp_beg, 'v6_bgp_end': v6_bgp_end, 'asn': number, 'org': org, 'iso': iso, 'iso_local': iso_local, 'lat': lat, 'lon': lon}
+
+
+def open_databases():
+    """
+    Opens (or reopens) the GeoIP and ASN databases used for IP enrichment.
+    
+    Kept separate from onInit() so the engine can be imported and used by
+    other processes (i.e. the native ingest service) without side effects.
+    
+    """
+    global mm_isp_db
+    mm_isp_db = geoip2.database.Reader(os.path.join(geoip_path, 'latest-isp'))
+    
+    global mm_city_db
+    mm_city_db = geoip2.database.Reader(os.path.join(geoip_path, 'latest-city'))
+    
+    global asn_db
+    asn_db = pyasn.pyasn(os.path.join(geoip_path, 'latest-asn'))
+
+
+def open_index(build=None):
+    """
+    Loads the IPv4 GeoIP index (see GeoIndex) from its sidecar file if that
+    is at least as new as the databases, or else builds it from them and
+    writes the sidecar when building is enabled. Without numpy, or without a
+    current index, every lookup goes to the readers.
+    
+    Kwargs:
+        build (bool): Whether to build a missing or outdated index; defaults
+            to geoip_index_build.
+    
+    """
+    global geo_index
+    if numpy is None:
+        geo_index = None
+        return
+    
+    if build is None: build = geoip_index_build
+    try:
+        newest = max(os.path.getmtime(os.path.join(geoip_path, x)) for x in ('latest-asn', 'latest-isp', 'latest-city'))
+        mtime = os.path.getmtime(geoip_index_path) if os.path.exists(geoip_index_path) else None
+        if mtime is not None and mtime >= newest:
+            if geo_index is None or geo_index.mtime != mtime:
+                started = time()
+                geo_index = GeoIndex.load(geoip_index_path)
+                logger.info('Loaded GeoIP index of %s ranges in %.1fs.' % (len(geo_index), time() - started))
+        elif build:
+            started = time()
+            geo_index = GeoIndex.build(asn_db, os.path.join(geoip_path, 'latest-isp'), os.path.join(geoip_path, 'latest-city'))
+            geo_index.save(geoip_index_path)
+            logger.info('Built GeoIP index of %s ranges in %.1fs.' % (len(geo_index), time() - started))
+        else:
+            geo_index = None
+    except AttributeError as e:
+        # mmdb_networks relies on private maxminddb.reader methods
+        logger.error('GeoIP index unavailable; this maxminddb reader cannot list networks (%s). Using the databases.' % e)
+        geo_index = None
+    except Exception as e:
+        logger.error('GeoIP index unavailable; using the databases. %s' % e)
+        geo_index = None
+    
+
 # Rsyslog logic
 def onInit():
     """ 
@@ -279,16 +1405,30 @@ def onInit():
     open files, create handles, connect to systems...)
       
     """
-    logger = logging.getLogger(__name__)
+    global debug
+    debug = logger.isEnabledFor(logging.DEBUG)
     
-    global mm_isp_db
-    mm_isp_db = geoip2.database.Reader('/usr/share/GeoIP/latest-isp')
+    # `kill -USR1` writes the most recent errors to the log
+    signal.signal(signal.SIGUSR1, errors.dump)
     
-    global mm_city_db
-    mm_city_db = geoip2.database.Reader('/usr/share/GeoIP/latest-city')
+    # `kill -USR2` profiles the script for a while
+    global profiler
+    if profiler is None:
+        profiler = Profiler('rsysparse', profile_path, duration=profile_duration)
+        profiler.install()
     
-    global asn_db
-    asn_db = pyasn.pyasn('/usr/share/GeoIP/latest-asn')
+    # Without the databases, events are still parsed, just not enriched
+    try:
+        open_databases()
+        open_index()
+    except Exception as e:
+        logger.error('GeoIP databases unavailable; IP enrichment disabled. %s' % e)
+    
+    # Counters survive parser tree reloads; only start them once
+    global metrics
+    if metrics is None:
+        metrics = Metrics()
+        metrics.start()
     
     global engine
     engine = ParsingEngine()
@@ -309,29 +1449,32 @@ def onReceive(blob):
     reply before the next message is pushed to this module).
     
     """
-    logger = logging.getLogger(__name__)
     data = {}
     
     try:
-        # Deserialize JSON string
-        rsysjson = json.loads(blob)
+        # Deserialize the local variables; nothing else is needed
+        properties = local_properties(blob)
+        
+        # Count the event towards its token's metrics
+        if metrics is not None:
+            metrics.record(properties)
         
         # Get the service that produced the log
-        service = rsysjson.get('$!', {}).get('programname_clean', '')
-        logger.debug('Service: %s' % service)
+        service = properties.get('programname_clean', '')
+        if debug: logger.debug('Service: %s' % service)
         
         # Get the cleaned-up message
-        message = rsysjson.get('$!', {}).get('msg_short', '')
-        logger.debug('Message: %s' % message)
+        message = properties.get('msg_short', '')
+        if debug: logger.debug('Message: %s' % message)
         
         if service and message:
             data = engine.parse(service, message)
     
     except Exception as e:
-        logger.error(e, exc_info=True)
+        errors.report('onReceive', e)
 
     # Return only the parsed data
-    print(json.dumps({'$!':{'data':data}}, separators=(',', ':')))
+    output.write(json.dumps({'$!':{'data':data}}, separators=(',', ':')) + '\n')
     
     
 def onExit():
@@ -341,8 +1484,14 @@ def onExit():
     being called immediately before exiting.
     
     """
-    mm_isp_db.close()
-    mm_city_db.close()
+    if metrics is not None:
+        metrics.stop()
+    errors.flush()
+    
+    if profiler is not None: profiler.stop()
+    
+    if mm_isp_db is not None: mm_isp_db.close()
+    if mm_city_db is not None: mm_city_db.close()
 
 
 """
@@ -358,7 +1507,16 @@ important once we get to the point where the plugin does
 two-way conversations with rsyslog. Do NOT change this!
 See also: https://github.com/rsyslog/rsyslog/issues/22
 """
+if __name__ == '__main__' and sys.argv[1:] == ['--build-index']:
+    # Run by update_geoip.sh once new databases are in place
+    if numpy is None: sys.exit('numpy is not installed; no GeoIP index built.')
+    open_databases()
+    open_index(build=True)
+    sys.exit(0 if geo_index is not None else 1)
+
 if __name__ == '__main__':
+    output = sys.stdout
+    sys.stdout = StrayOutput()
     onInit()
     keepRunning = 1
     max_minutes = refresh_interval * 60
@@ -367,7 +1525,7 @@ if __name__ == '__main__':
         if msg:
             msg = msg[:len(msg)-1] # remove LF
             onReceive(msg)
-            sys.stdout.flush() # very important, Python buffers far too much!
+            output.flush() # very important, Python buffers far too much!
             
             # Check if we need to reload parser tree
             now = time()
@@ -375,11 +1533,14 @@ if __name__ == '__main__':
                 start_time = now
                 onInit()
             
+            # Check if we have been asked to profile
+            profiler.poll(now)
+            
         else: # an empty line means stdin has been closed
             keepRunning = 0
             
     onExit()
-    sys.stdout.flush() # very important, Python buffers far too much!
+    output.flush() # very important, Python buffers far too much!
 
 """
 For testing
@@ -398,4 +1559,332 @@ class RsysparseTest(unittest.TestCase):
     
     def test_stuff(self):
         msg = 'Aug  1 18:27:46 knight sshd[20325]: Failed password for illegal user test from 218.49.183.17 port 48849 ssh2'
-        print(self.engine.parse('sshd', msg))
+        data = self.engine.parse('sshd', msg)
+        self.assertEqual((data['user'], data['src_ip'], data['linecount']), ('test', '218.49.183.17', 1))
+    
+    def test_families(self):
+        "Messages of a known family should skip only the parsers that matched none of its samples."
+        samples = (
+            'Failed password for illegal user test from 218.49.183.17 port 48849 ssh2',
+            'Connection closed by 218.49.183.17 port 48849 [preauth]',
+        )
+        families = self.engine.build_families('sshd', samples)
+        self.assertEqual(families, {'failed password': [], 'connection closed': ['src_ip', 'user']})
+        self.engine.families['sshd'] = {k: frozenset(v) for k,v in families.items()}
+        
+        self.assertEqual([x[0] for x in self.engine.parsers('sshd', 'Connection closed by 10.0.0.1 port 22')], [])
+        self.assertEqual(len(self.engine.parsers('sshd', 'Something else entirely from 10.0.0.1')), 2)
+        
+        # Fields the map doesn't know about are always run
+        self.engine.parse_tree['sshd']['port'] = self.engine.build_parser('port', {'type': 'int', 'validator': '(.*)', 'parsers': ['port ([0-9]+)']})
+        self.assertEqual(self.engine.parse('sshd', 'Connection closed by 10.0.0.1 port 22')['port'], 22)
+        
+        data = self.engine.parse('sshd', 'Failed password for illegal user admin from 10.0.0.1 port 22 ssh2')
+        self.assertEqual(data['user'], 'admin')
+        self.assertEqual(data['src_ip'], '10.0.0.1')
+    
+    def test_metrics(self):
+        "Counts should be flushed as one PulseUpdateView line per key."
+        import tempfile
+        with tempfile.TemporaryDirectory() as directory:
+            counter = Metrics(path=os.path.join(directory, 'index'), interval=3600, counts=True)
+            event = {'token_ext': 'abcd', 'fromhost-ip_clean': '10.0.0.1', 'programname_clean': 'sshd', 'msg_bytes': 100}
+            for i in range(3):
+                counter.record(event)
+            counter.record(dict(event, programname_clean='', msg_bytes='x'))
+            counter.record({'msg_bytes': 10})
+            
+            self.assertEqual(counter.flush(), 2)
+            self.assertEqual(counter.flush(), 0)
+            
+            with open(counter.path) as f:
+                lines = sorted(f.read().splitlines())
+            self.assertEqual(lines, ['abcd\t\t10.0.0.1\t\t-\t\t1\t\t0', 'abcd\t\t10.0.0.1\t\tsshd\t\t3\t\t300'])
+    
+    def test_signature(self):
+        "Signature must match the original findall/splitlines computation."
+        corpus = (
+            '',
+            ' ',
+            'nopunctuationatall',
+            'Aug  1 18:27:46 knight sshd[20325]: Failed password for illegal user test from 218.49.183.17 port 48849 ssh2',
+            '[UFW BLOCK] IN=eth0 OUT= MAC=00:00:00:00:00:00:00:00:00:00:00:00:08:00 SRC=1.2.3.4 DST=5.6.7.8 LEN=40',
+            '127.0.0.1 - - [01/Aug/2018:18:27:46 +0000] "GET /index.html?a=b&c=d HTTP/1.1" 200 612 "-" "curl/7.58.0"',
+            '(root) CMD (   cd / && run-parts --report /etc/cron.hourly)',
+            '.' * 29,
+            '.' * 30,
+            '.' * 31,
+            'a-b' * 40,
+            'café, naïve — résumé ☃',
+            'line one\nline two\n',
+            'line one\r\nline two\r\n\r\n',
+            '\n\n\r\r\n',
+            'trailing\r',
+            'odd\x0bbreaks\x0c\x1c\x1d\x1e\x85\u2028\u2029end',
+            'Traceback (most recent call last):\n  File "x.py", line 1\n    raise Exception()\nException',
+        )
+        
+        # Plus a few hundred random strings heavy on separators and breaks
+        import random
+        rand = random.Random(0)
+        alphabet = 'ab1 .:-_[]\n\r\x0b\x85\u2028é'
+        corpus += tuple(''.join(rand.choice(alphabet) for i in range(rand.randint(0, 80))) for n in range(500))
+        
+        for message in corpus:
+            expected = (
+                re.sub(' ', '_', ''.join(re.findall('([^a-zA-Z0-9])', message)[:30])),
+                len(message.splitlines()),
+            )
+            self.assertEqual(self.engine.signature(message), expected, repr(message))
+    
+    def test_local_properties(self):
+        "Decoding just $! should give what decoding the whole message gives."
+        properties = {'token_ext': 'aaaa', 'msg_short': 'say "$!": {} to \\ me', 'programname_clean': 'sshd', 'data': '{}'}
+        blobs = (
+            json.dumps({'msg': 'say "$!": {"x": 1}', 'rawmsg': '<13>say "$!": 1', 'hostname': 'web1', '$!': properties, '$.': {'inc': 1}}),
+            json.dumps({'msg': 'compact', '$!': properties}, separators=(',', ':')),
+            json.dumps({'msg': 'no locals', '$.': {'inc': 1}}),
+        )
+        for blob in blobs:
+            self.assertEqual(local_properties(blob), json.loads(blob).get('$!', {}), blob)
+    
+    def test_errors(self):
+        "Repeated errors should be logged once per interval, counted, and kept for dumping."
+        reporter = ErrorReporter(interval=3600, size=3)
+        with self.assertLogs(logger, 'WARNING') as logs:
+            for i in range(5):
+                reporter.report('Parser.typecast', ValueError('bad value %s' % i), 'port to int')
+            reporter.report('IPParser.geoip.asn', KeyError('x'))
+            reporter.flush()
+            reporter.dump()
+        
+        self.assertEqual([x.split(':', 2)[2].splitlines()[0] for x in logs.output[:3]], [
+            'Parser.typecast: bad value 0 (port to int)',
+            "IPParser.geoip.asn: 'x'",
+            '4 more ValueError errors in Parser.typecast in the last 0s.',
+        ])
+        self.assertIn('Last 3 of 6 errors since start:', logs.output[3])
+        self.assertEqual(len(logs.output), 7)
+        self.assertTrue(logs.output[-1].endswith("IPParser.geoip.asn KeyError: 'x'"))
+    
+    def test_stray_output(self):
+        "Stray prints must not reach rsyslog; every event gets exactly one reply line."
+        global engine, output
+        from io import StringIO
+        
+        saved = (engine, output, sys.stdout)
+        engine, output = self.engine, StringIO()
+        try:
+            sys.stdout = StrayOutput()
+            with self.assertLogs(logger, 'WARNING') as logs:
+                print('debugging leftover')
+                onReceive(json.dumps({'$!': {'programname_clean': 'sshd', 'msg_short': 'Failed password for invalid user test from 10.0.0.1 port 48849 ssh2'}}))
+                onReceive('not json')
+            replies = output.getvalue()
+        finally:
+            engine, output, sys.stdout = saved
+        
+        self.assertIn('debugging leftover', logs.output[0])
+        lines = replies.split('\n')
+        self.assertEqual(lines[-1], '')
+        self.assertEqual([json.loads(x)['$!']['data'].get('user') for x in lines[:-1]], ['test', None])
+
+    def test_structured(self):
+        "Values labelled by JSON and key=value messages should win over regexes, which only fill in what is missing."
+        self.assertEqual(self.engine.structured('level=info user="John \\"JJ\\" Doe" OUT= Src-IP=10.0.0.1'), {'level': 'info', 'user': 'John "JJ" Doe', 'src_ip': '10.0.0.1'})
+        self.assertEqual(self.engine.structured('{"user": "test", "src": {"ip": "10.0.0.1"}, "tags": null}'), {'user': 'test', 'src_ip': '10.0.0.1'})
+        ufw = '[UFW BLOCK] IN=eth0 OUT= MAC=52:54:00:12:34:56 SRC=45.33.1.2 DST=10.0.0.5 LEN=40 TTL=243 ID=54321 PROTO=TCP SPT=51234 DPT=22'
+        for message in ('Failed password for user=test from 10.0.0.1', '{not json}', '["a", "b"]', 'no pairs at all', ufw, 'user=test src_ip=10.0.0.1 logged in'):
+            self.assertIsNone(self.engine.structured(message), message)
+        
+        data = self.engine.parse('sshd', 'src_ip=10.0.0.2 user=admin msg="Failed password for user test from 10.0.0.1"')
+        self.assertEqual((data['src_ip'], data['src_ip_private'], data['user']), ('10.0.0.2', True, 'admin'))
+        data = self.engine.parse('sshd', 'action=login user=admin msg="from 10.0.0.1"')
+        self.assertEqual((data['src_ip'], data['user']), ('10.0.0.1', 'admin'))
+        
+        # Only known fields are read, typecast and validated
+        self.engine.fields['port'] = self.engine.build_parser('port', {'type': 'int', 'validator': '(.*)', 'parsers': []})
+        data = self.engine.parse('nginx', '{"port": "8080", "user": "x", "src_ip": [1]}')
+        self.assertEqual(data['port'], 8080)
+        self.assertNotIn('user', data)
+        self.assertNotIn('src_ip', data)
+        
+        # Booleans are read from text, and false values are kept
+        self.engine.fields['ok'] = self.engine.build_parser('ok', {'type': 'bool', 'validator': '(.*)', 'parsers': []})
+        self.assertEqual(self.engine.parse('nginx', 'ok=false port=0')['ok'], False)
+        self.assertEqual(self.engine.parse('nginx', 'ok=Yes port=0')['port'], 0)
+        data = self.engine.parse('nginx', '{"ok": false, "port": 0}')
+        self.assertEqual((data['ok'], data['port']), (False, 0))
+        self.assertNotIn('ok', self.engine.parse('nginx', 'ok=maybe port=1'))
+    
+    def test_geoip_batch(self):
+        "Each distinct public address in a batch should be looked up once, with the same results as one at a time."
+        global mm_isp_db, mm_city_db, asn_db
+        from types import SimpleNamespace
+        
+        lookups = []
+        class Reader(object):
+            def asn(self, ip):
+                lookups.append(ip)
+                return SimpleNamespace(autonomous_system_number=64512, autonomous_system_organization='Example')
+            def city(self, ip):
+                return SimpleNamespace(country=SimpleNamespace(iso_code='US'), subdivisions=SimpleNamespace(most_specific=SimpleNamespace(iso_code='CA')), location=SimpleNamespace(latitude=1.0, longitude=2.0))
+        class ASN(object):
+            def lookup(self, ip):
+                return 64512, '%s/32' % ip
+        
+        saved = (mm_isp_db, mm_city_db, asn_db)
+        mm_isp_db = mm_city_db = Reader()
+        asn_db = ASN()
+        try:
+            messages = ['Failed password for illegal user test%s from %s port 22 ssh2' % (i, ip) for i, ip in enumerate(['8.8.8.8', '10.0.0.1', '8.8.8.8', '1.1.1.1', '8.8.8.8'])]
+            expected = [self.engine.parse('sshd', x) for x in messages]
+            del lookups[:]
+            
+            counters = {}
+            results = self.engine.parse_batch([('sshd', x) for x in messages] + [('sshd', 42)], counters=counters)
+        finally:
+            mm_isp_db, mm_city_db, asn_db = saved
+        
+        self.assertEqual(results[:-1], expected)
+        self.assertEqual(results[-1], {})
+        self.assertEqual(expected[0]['src_ip_iso_local'], 'US-CA')
+        self.assertEqual(sorted(lookups), ['1.1.1.1', '8.8.8.8'])
+        self.assertEqual(counters, {'geoip_requested': 4, 'geoip_lookups': 2})
+        
+        # Without lookups, enrich reports the public addresses it skipped
+        deferred = []
+        data = self.engine.parse('sshd', messages[0], geoip=False, deferred=deferred)
+        self.assertEqual(deferred, [('src_ip', '8.8.8.8')])
+        self.assertNotIn('src_ip_iso_local', data)
+    
+    def test_profiler(self):
+        "Touching the trigger file should profile the process and write stacks and per-parser samples."
+        import tempfile
+        
+        message = 'Failed password for illegal user test from 10.0.0.1 port 48849 ssh2'
+        with tempfile.TemporaryDirectory() as path:
+            profiler = Profiler('test', path, interval=0.001)
+            with open(os.path.join(path, 'profile.trigger'), 'w') as f:
+                f.write('60')
+            os.utime(profiler.trigger, (profiler.triggered + 1, profiler.triggered + 1))
+            
+            with self.assertLogs(logger, 'INFO'):
+                profiler.poll()
+                self.assertTrue(profiler.active)
+                started = time()
+                while profiler.samples < 50 and time() - started < 10:
+                    self.engine.parse('sshd', message)
+                folded, parsers = profiler.stop()
+            
+            self.assertFalse(profiler.active)
+            with open(folded) as f:
+                stacks = [x.rsplit(' ', 1) for x in f.read().splitlines()]
+            self.assertEqual(sum(int(x[1]) for x in stacks), profiler.samples)
+            self.assertTrue(any('parse (rsysparse.py);parse (rsysparse.py)' in x[0] for x in stacks))
+            with open(parsers) as f:
+                rows = [x.split('\t') for x in f.read().splitlines()]
+            self.assertEqual(rows[0][:3], ['service', 'field', 'samples'])
+            self.assertTrue(set(x[1] for x in rows[1:]) <= {'src_ip', 'user'})
+            self.assertTrue(all(x[0] == 'sshd' for x in rows[1:]))
+    
+    def test_geo_index(self):
+        "The IPv4 index should give what the databases give, and leave IPv6 and unknown addresses to them."
+        if numpy is None: self.skipTest('numpy is not installed')
+        global mm_isp_db, mm_city_db, asn_db, geo_index
+        import tempfile
+        from types import SimpleNamespace
+        
+        prefixes = {'8.0.0.0/8': 3356, '8.8.8.0/24': 15169, '1.1.1.0/24': 13335}
+        isps = {x: {'autonomous_system_number': asn, 'autonomous_system_organization': 'AS%s' % asn} for x, asn in prefixes.items()}
+        cities = {
+            '8.0.0.0/8': {'country': {'iso_code': 'US'}, 'subdivisions': [{'iso_code': 'CO'}], 'location': {'latitude': 39.7, 'longitude': -105.0}},
+            '8.8.8.0/24': {'country': {'iso_code': 'US'}, 'location': {'latitude': 37.751, 'longitude': -97.822}},
+            '1.1.1.0/24': {'country': {'iso_code': 'AU'}, 'subdivisions': [{'iso_code': 'NSW'}], 'location': {'latitude': -33.49, 'longitude': 143.21}},
+        }
+        
+        lookups = []
+        def find(networks, ip):
+            lookups.append(ip)
+            matches = [x for x in networks if IPAddress(ip) in IPNetwork(x)]
+            if not matches: raise KeyError(ip)
+            return max(matches, key=lambda x: IPNetwork(x).prefixlen)
+        class Reader(object):
+            def asn(self, ip):
+                record = isps[find(isps, ip)]
+                return SimpleNamespace(**record)
+            def city(self, ip):
+                record = cities[find(cities, ip)]
+                subdivision = (record.get('subdivisions') or [{}])[-1].get('iso_code')
+                return SimpleNamespace(country=SimpleNamespace(iso_code=record['country']['iso_code']), subdivisions=SimpleNamespace(most_specific=SimpleNamespace(iso_code=subdivision)), location=SimpleNamespace(**record['location']))
+        class ASN(object):
+            radix = SimpleNamespace(
+                prefixes=lambda: list(prefixes) + ['2001:db8::/32'],
+                search_exact=lambda ip, masklen: SimpleNamespace(asn=prefixes.get('%s/%s' % (ip, masklen))),
+            )
+            def lookup(self, ip):
+                try: network = find(prefixes, ip)
+                except KeyError: return None, None
+                return prefixes[network], network
+        
+        def ranges(records, describe):
+            return flatten((IPNetwork(x).first, IPNetwork(x).last, describe(record)) for x, record in records.items())
+        
+        saved = (mm_isp_db, mm_city_db, asn_db, geo_index)
+        mm_isp_db = mm_city_db = Reader()
+        asn_db = ASN()
+        try:
+            ips = ['8.8.8.8', '8.8.4.4', '8.255.255.255', '1.1.1.1', '9.9.9.9', '2001:4860:4860::8888']
+            expected = {ip: IPParser.geoip(ip) for ip in ips}
+            
+            index = GeoIndex.from_ranges({'asn': flatten(asn_networks(asn_db)), 'isp': ranges(isps, describe_isp), 'city': ranges(cities, describe_city)})
+            self.assertEqual([len(x[0]) for x in index.ranges.values()], [4, 4, 4])
+            with tempfile.TemporaryDirectory() as path:
+                index.save(os.path.join(path, 'index.npz'))
+                geo_index = GeoIndex.load(os.path.join(path, 'index.npz'))
+            
+            self.assertEqual(sorted(geo_index.lookup_batch(ips + ips)), ['1.1.1.1', '8.255.255.255', '8.8.4.4', '8.8.8.8'])
+            del lookups[:]
+            self.assertEqual(IPParser.geoip_batch(ips + ips), expected)
+            self.assertEqual(IPParser.geoip('8.8.8.8'), expected['8.8.8.8'])
+            self.assertEqual(set(lookups), {'9.9.9.9', '2001:4860:4860::8888'})
+        finally:
+            mm_isp_db, mm_city_db, asn_db, geo_index = saved
+        
+        self.assertEqual(expected['8.8.8.8']['bgp'], '8.8.8.0/24')
+        self.assertEqual(expected['8.8.4.4']['iso_local'], 'US-CO')
+        self.assertEqual(expected['8.8.8.8']['iso_local'], 'US-??')
+    
+    def test_geo_index_reader(self):
+        "A maxminddb reader without the private methods mmdb_networks walks should just mean no index."
+        if numpy is None: self.skipTest('numpy is not installed')
+        global geoip_path, geoip_index_path, asn_db, geo_index
+        import maxminddb.reader
+        import tempfile
+        from types import SimpleNamespace
+        from unittest import mock
+        
+        class Reader(object):
+            def __init__(self, *args):
+                pass
+            def metadata(self):
+                return SimpleNamespace(node_count=0)
+            def close(self):
+                pass
+        
+        saved = (geoip_path, geoip_index_path, asn_db, geo_index)
+        with tempfile.TemporaryDirectory() as path, mock.patch.object(maxminddb.reader, 'Reader', Reader):
+            for name in ('latest-asn', 'latest-isp', 'latest-city'):
+                open(os.path.join(path, name), 'w').close()
+            geoip_path, geoip_index_path = path, os.path.join(path, 'latest-index.npz')
+            asn_db = SimpleNamespace(radix=SimpleNamespace(prefixes=lambda: []))
+            try:
+                with self.assertRaises(AttributeError):
+                    list(mmdb_networks(os.path.join(path, 'latest-isp'), describe_isp))
+                with self.assertLogs(logger, 'ERROR') as logs:
+                    open_index(build=True)
+                self.assertIn('cannot list networks', logs.output[0])
+                self.assertIsNone(geo_index)
+                self.assertFalse(os.path.exists(geoip_index_path))
+            finally:
+                geoip_path, geoip_index_path, asn_db, geo_index = saved
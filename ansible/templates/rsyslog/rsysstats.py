@@ -0,0 +1,357 @@
+#!/opt/paragun/ENV/bin/pypy3
+"""
+Imports the dyn_stats counters rsyslog's impstats module writes to
+rsyslog-health every few seconds.
+
+The counters are resettable, so every record holds the delta since the
+previous one and the deltas only need summing:
+
+* event-metrics (token(#)host(#)app) become event counts, appended to the
+  metrics index in the format PulseUpdateView accepts. The parser processes
+  contribute the byte counts for the same keys (see rsysparse.Metrics), and
+  rsysaggregate.py sums both when the index is rotated.
+* event-rejects (by source IP, no token) and token-rejects (by token, not
+  valid) are posted to the rejects API.
+
+Queue and action statistics from the same file (queue size, enqueued and
+discarded events; actions processed, failed and suspended) are summarized
+per minute and posted to the node health API, if --health-url is given.
+Health samples that can't be posted are dropped rather than retried.
+
+Only lines added since the previous run are read; the position is kept in a
+state file and starts over if rsyslog-health is rotated. If the rejects
+can't be posted nothing is written and the same lines are read again next
+time.
+
+Usage:
+    
+    rsysstats.py --url http://paragun/api/metrics/rejects/ --health-url http://paragun/api/nodes/health/
+
+"""
+from time import mktime, strptime, time
+from urllib.request import Request, urlopen
+
+import argparse
+import json
+import logging
+import os
+import socket
+import sys
+import unittest
+
+# dyn_stats bucket -> reject reason understood by RejectUpdateView
+REJECTS = {
+    'event-rejects': 'token',
+    'token-rejects': 'invalid',
+}
+
+METRICS = 'event-metrics'
+SEPARATOR = '(#)'
+
+# impstats counters reported as node health, by record origin
+HEALTH = {
+    'core.queue': {
+        'size': ('size',),
+        'enqueued': ('enqueued',),
+        'discarded': ('discarded.full', 'discarded.nf'),
+    },
+    'core.action': {
+        'processed': ('processed',),
+        'failed': ('failed',),
+        'suspended': ('suspended',),
+    },
+}
+
+
+def read_new(path, state_path):
+    """
+    Reads complete lines appended to a file since the last call.
+    
+    Args:
+        path (str): File to read.
+        state_path (str): Where the inode and offset reached are kept.
+    
+    Returns:
+        lines (list): New lines.
+        state (dict): State to save() once the lines have been dealt with.
+    
+    """
+    try:
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        state = {}
+    
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return [], state
+    
+    # Start over if the file was rotated or truncated
+    offset = state.get('offset', 0)
+    if state.get('inode') != stat.st_ino or stat.st_size < offset:
+        offset = 0
+    
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    
+    # Leave any partially written line for next time
+    end = data.rfind(b'\n') + 1
+    lines = data[:end].decode('utf-8', 'replace').splitlines()
+    
+    return lines, {'inode': stat.st_ino, 'offset': offset + end}
+
+
+def save(state, state_path):
+    with open(state_path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(state_path + '.tmp', state_path)
+
+
+def collect(lines):
+    """
+    Sums dyn_stats deltas from impstats JSON lines.
+    
+    Lines may be prefixed with a timestamp; anything that isn't a dyn_stats
+    record is ignored.
+    
+    Returns:
+        buckets (dict): {bucket: {key: count}}
+    
+    """
+    logger = logging.getLogger(__name__)
+    buckets = {}
+    
+    for line in lines:
+        start = line.find('{')
+        if start < 0: continue
+        
+        try:
+            record = json.loads(line[start:])
+        except ValueError:
+            continue
+        
+        origin = record.get('origin')
+        name = record.get('name')
+        values = record.get('values', {})
+        
+        if origin == 'dynstats.bucket' and (name == METRICS or name in REJECTS):
+            bucket = buckets.setdefault(name, {})
+            for key, count in values.items():
+                bucket[key] = bucket.get(key, 0) + count
+        
+        elif origin == 'dynstats' and name == 'global':
+            # Keys past maxCardinality aren't counted at all
+            for key, count in values.items():
+                if key.endswith('.ops_overflow') and count:
+                    logger.warning('%s: %s events not counted; raise maxCardinality.' % (key, count))
+    
+    return buckets
+
+
+def parse_time(line, default=None):
+    """
+    Reads the timestamp impstats prefixes its log file lines with, e.g.
+    `Mon Feb 18 10:12:49 2019: {...}`.
+    
+    Returns:
+        ts (float): Epoch seconds, or `default` if there is no timestamp.
+    
+    """
+    try:
+        return mktime(strptime(line[:line.index(': {')].strip(), '%a %b %d %H:%M:%S %Y'))
+    except ValueError:
+        return default
+
+
+def health(lines, now=None):
+    """
+    Summarizes queue and action statistics per minute.
+    
+    Returns:
+        samples (list): [epoch, series, total, peak] for each minute and
+            series, where series is `<queue or action>.<metric>`, total the
+            sum of the values reported in that minute and peak the largest.
+    
+    """
+    now = now or time()
+    buckets = {}
+    
+    for line in lines:
+        start = line.find('{')
+        if start < 0: continue
+        
+        try:
+            record = json.loads(line[start:])
+        except ValueError:
+            continue
+        
+        metrics = HEALTH.get(record.get('origin'))
+        name = record.get('name', '')
+        
+        # Skip actions rsyslog named automatically (e.g. action-3-builtin:omfile)
+        if not metrics or not name or name.startswith('action-'): continue
+        
+        ts = int(parse_time(line, now))
+        minute = ts - ts % 60
+        
+        for metric, keys in metrics.items():
+            if not any(x in record for x in keys): continue
+            value = sum(int(record.get(x, 0)) for x in keys)
+            entry = buckets.setdefault((minute, '%s.%s' % (name, metric)), [0, 0])
+            entry[0] += value
+            entry[1] = max(entry[1], value)
+    
+    return [[minute, series, total, peak] for (minute, series), (total, peak) in sorted(buckets.items())]
+
+
+def metrics_lines(counts):
+    """
+    Formats event-metrics counts as metrics index lines with no bytes.
+    
+    """
+    lines = []
+    for key, count in sorted(counts.items()):
+        if not count: continue
+        parts = key.split(SEPARATOR)
+        if len(parts) != 3 or not parts[0]: continue
+        token, host, app = parts
+        lines.append('%s\t\t%s\t\t%s\t\t%s\t\t0\n' % (token, host or '-', app or '-', count))
+    return lines
+
+
+def rejects_lines(buckets):
+    """
+    Formats reject counts as `reason\\t\\tkey\\t\\tcount` lines.
+    
+    """
+    lines = []
+    for name, reason in sorted(REJECTS.items()):
+        for key, count in sorted(buckets.get(name, {}).items()):
+            if count and key:
+                lines.append('%s\t\t%s\t\t%s\n' % (reason, key, count))
+    return lines
+
+
+def post(url, data, timeout=30, content_type='application/octet-stream'):
+    request = Request(url, data=data.encode('utf-8'), headers={'Content-Type': content_type})
+    with urlopen(request, timeout=timeout) as response:
+        return response.status
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--health', default='/var/log/paragun/metrics/rsyslog-health', help='impstats log file.')
+    parser.add_argument('--state', default='/var/log/paragun/metrics/rsyslog-health.state', help='Where to keep the read position.')
+    parser.add_argument('--index', default='/var/log/paragun/metrics/index', help='Metrics index to append event counts to.')
+    parser.add_argument('--url', required=True, help='Rejects API endpoint.')
+    parser.add_argument('--health-url', default=None, help='Node health API endpoint.')
+    parser.add_argument('--node', default=socket.gethostname(), help='Name to report node health under.')
+    args = parser.parse_args(argv)
+    
+    logging.basicConfig(format='%(asctime)s [%(levelname)-8s] %(filename)s: %(message)s', level=logging.INFO)
+    logger = logging.getLogger(__name__)
+    
+    lines, state = read_new(args.health, args.state)
+    buckets = collect(lines)
+    
+    rejects = rejects_lines(buckets)
+    if rejects:
+        try:
+            post(args.url, ''.join(rejects))
+        except Exception as e:
+            logger.error('Could not post rejects; will retry next run.')
+            logger.error(e)
+            return 1
+    
+    samples = health(lines)
+    if samples and args.health_url:
+        try:
+            post(args.health_url, json.dumps({'node': args.node, 'samples': samples}), content_type='application/json')
+        except Exception as e:
+            logger.warning('Could not post node health; %s samples dropped.' % len(samples))
+            logger.warning(e)
+    
+    metrics = metrics_lines(buckets.get(METRICS, {}))
+    if metrics:
+        with open(args.index, 'a') as f:
+            f.write(''.join(metrics))
+    
+    save(state, args.state)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+"""
+For testing
+
+python -m unittest rsysstats.py
+
+"""
+class RsysstatsTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.lines = [
+            'Mon Feb 18 10:12:49 2019: {"name":"global","origin":"dynstats","values":{"event-metrics.ops_overflow":0,"event-metrics.new_metric_add":2}}',
+            'Mon Feb 18 10:12:49 2019: {"name":"event-metrics","origin":"dynstats.bucket","values":{"abcd(#)10.0.0.1(#)sshd":3,"abcd(#)10.0.0.1(#)cron":1}}',
+            'Mon Feb 18 10:12:49 2019: {"name":"event-rejects","origin":"dynstats.bucket","values":{"10.0.0.9":7}}',
+            'Mon Feb 18 10:12:49 2019: {"name":"imtcp(10514)","origin":"imtcp","submitted":12}',
+            'Mon Feb 18 10:12:54 2019: {"name":"event-metrics","origin":"dynstats.bucket","values":{"abcd(#)10.0.0.1(#)sshd":2,"efgh(#)10.0.0.2(#)":0}}',
+            'Mon Feb 18 10:12:54 2019: {"name":"token-rejects","origin":"dynstats.bucket","values":{"deadbeef":4}}',
+            'garbage {not json',
+        ]
+    
+    def test_collect(self):
+        buckets = collect(self.lines)
+        self.assertEqual(metrics_lines(buckets[METRICS]), [
+            'abcd\t\t10.0.0.1\t\tcron\t\t1\t\t0\n',
+            'abcd\t\t10.0.0.1\t\tsshd\t\t5\t\t0\n',
+        ])
+        self.assertEqual(rejects_lines(buckets), ['token\t\t10.0.0.9\t\t7\n', 'invalid\t\tdeadbeef\t\t4\n'])
+    
+    def test_health(self):
+        lines = [
+            'Mon Feb 18 10:12:49 2019: {"name":"pipeline-in","origin":"core.queue","size":120,"enqueued":500,"full":0,"discarded.full":0,"discarded.nf":0,"maxqsize":900}',
+            'Mon Feb 18 10:12:54 2019: {"name":"pipeline-in","origin":"core.queue","size":80,"enqueued":300,"full":0,"discarded.full":2,"discarded.nf":1,"maxqsize":900}',
+            'Mon Feb 18 10:12:54 2019: {"name":"rsysparser","origin":"core.action","processed":300,"failed":0,"suspended":0}',
+            'Mon Feb 18 10:12:54 2019: {"name":"action-3-builtin:omfile","origin":"core.action","processed":300,"failed":0}',
+            'Mon Feb 18 10:13:04 2019: {"name":"pipeline-in","origin":"core.queue","size":10,"enqueued":20,"discarded.full":0,"discarded.nf":0}',
+        ]
+        minute = int(parse_time(lines[0]))
+        minute -= minute % 60
+        samples = {(x[0] - minute, x[1]): (x[2], x[3]) for x in health(lines)}
+        
+        self.assertEqual(samples[(0, 'pipeline-in.size')][1], 120)
+        self.assertEqual(samples[(0, 'pipeline-in.enqueued')], (800, 500))
+        self.assertEqual(samples[(0, 'pipeline-in.discarded')], (3, 3))
+        self.assertEqual(samples[(0, 'rsysparser.processed')], (300, 300))
+        self.assertEqual(samples[(60, 'pipeline-in.enqueued')], (20, 20))
+        self.assertFalse(any(x[1].startswith('action-') for x in samples))
+    
+    def test_read_new(self):
+        "Only complete lines added since the last read should be returned."
+        import tempfile
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'rsyslog-health')
+            state_path = os.path.join(directory, 'state')
+            
+            with open(path, 'w') as f:
+                f.write(self.lines[0] + '\n' + self.lines[1][:20])
+            lines, state = read_new(path, state_path)
+            self.assertEqual(lines, self.lines[:1])
+            save(state, state_path)
+            
+            with open(path, 'a') as f:
+                f.write(self.lines[1][20:] + '\n')
+            lines, state = read_new(path, state_path)
+            self.assertEqual(lines, self.lines[1:2])
+            save(state, state_path)
+            
+            # Rotated; start from the top of the new file
+            os.rename(path, path + '.1')
+            with open(path, 'w') as f:
+                f.write(self.lines[2] + '\n')
+            self.assertEqual(read_new(path, state_path)[0], self.lines[2:3])
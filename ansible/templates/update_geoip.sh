@@ -21,6 +21,9 @@ ln -sf /usr/share/GeoIP/GeoLite2-City.mmdb /usr/share/GeoIP/latest-city
 ln -sf /usr/share/GeoIP/GeoLite2-ASN.mmdb /usr/share/GeoIP/latest-isp
 ln -sf /usr/share/GeoIP/pyasn.mmdb /usr/share/GeoIP/latest-asn
 
+# Rebuild the IPv4 lookup index rsysparse.py loads next to them (needs numpy)
+/opt/paragun/ENV/bin/pypy3 /opt/paragun/rsysparse.py --build-index
+
 # Reload rsyslog (SIGHUP)
 /usr/sbin/invoke-rc.d rsyslog rotate > /dev/null
 
@@ -0,0 +1,67 @@
+from time import perf_counter
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The standalone parsing script deployed to rsyslog nodes
+RSYSPARSE = os.path.join(ROOT, 'ansible', 'templates', 'rsyslog', 'rsysparse.py')
+
+
+def setup():
+    """
+    Configures Django so benchmarks can use settings, models and the apps'
+    helpers the same way management commands do.
+    
+    """
+    import django
+    
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'paragun.settings')
+    django.setup()
+
+
+def rsysparse():
+    """
+    Imports rsysparse.py without needing Django settings.
+    
+    Returns:
+        module (module): The rsysparse module.
+    
+    """
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    from parsing.engine import get_module
+    return get_module(path=RSYSPARSE)
+
+
+class Timer(object):
+    """
+    Context manager measuring wall-clock time.
+        
+        with Timer() as t:
+            do_stuff()
+        print(t.elapsed)
+    
+    """
+    def __enter__(self):
+        self.start = perf_counter()
+        self.elapsed = 0
+        return self
+    
+    def __exit__(self, *args):
+        self.elapsed = perf_counter() - self.start
+
+
+def table(rows, headers):
+    """
+    Prints rows as a fixed-width table.
+    
+    """
+    rows = [[str(x) for x in row] for row in rows]
+    widths = [max(len(str(h)), *(len(r[i]) for r in rows)) if rows else len(str(h)) for i,h in enumerate(headers)]
+    print('  '.join(str(h).rjust(w) for h,w in zip(headers, widths)))
+    for row in rows:
+        print('  '.join(x.rjust(w) for x,w in zip(row, widths)))
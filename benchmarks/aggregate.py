@@ -0,0 +1,93 @@
+"""
+Compares rsysaggregate.py against the `datamash -s -W --group 1,2,3 count 4
+sum 5` step it replaces, on a generated metrics index.
+    
+    python -m benchmarks.aggregate --lines 100000000 --keys 5000
+
+The index is written to --path (a temp file by default) and reused if it
+already has the requested number of lines. datamash is skipped if it is not
+installed.
+"""
+from benchmarks import ROOT, Timer, table
+
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+AGGREGATOR = os.path.join(ROOT, 'ansible', 'templates', 'rsyslog', 'rsysaggregate.py')
+
+
+def generate(path, lines, keys, seed=0):
+    """
+    Writes a metrics index in the ParagunMetric template's format.
+    
+    """
+    rand = random.Random(seed)
+    tokens = ['%032x' % rand.getrandbits(128) for x in range(max(1, keys // 50))]
+    prefixes = [
+        ('%s\t\t10.%s.%s.%s\t\t%s' % (rand.choice(tokens), rand.randint(0, 255), rand.randint(0, 255), rand.randint(1, 254), rand.choice(('sshd', 'nginx', 'cron', 'kernel', 'ufw')))).encode()
+        for x in range(keys)
+    ]
+    
+    with open(path, 'wb') as f:
+        chunk = []
+        for i in range(lines):
+            chunk.append(b'%s\t\t1\t\t%d\n' % (rand.choice(prefixes), rand.randint(40, 2000)))
+            if len(chunk) >= 100000:
+                f.writelines(chunk)
+                chunk = []
+        f.writelines(chunk)
+
+
+def count_lines(path):
+    with open(path, 'rb') as f:
+        return sum(x.count(b'\n') for x in iter(lambda: f.read(1 << 20), b''))
+
+
+def run(command, source, output):
+    with open(source, 'rb') as stdin, open(output, 'wb') as stdout, Timer() as timer:
+        subprocess.check_call(command, stdin=stdin, stdout=stdout)
+    return timer.elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lines', type=int, default=1000000)
+    parser.add_argument('--keys', type=int, default=5000)
+    parser.add_argument('--max-keys', type=int, default=1000000)
+    parser.add_argument('--path', default=os.path.join(tempfile.gettempdir(), 'paragun-metrics-index'))
+    parser.add_argument('--python', default=sys.executable, help='Interpreter to run the aggregator with, e.g. pypy3.')
+    args = parser.parse_args()
+    
+    if not os.path.exists(args.path) or count_lines(args.path) != args.lines:
+        with Timer() as timer:
+            generate(args.path, args.lines, args.keys)
+        print('Generated %s lines in %.1fs' % (args.lines, timer.elapsed))
+    
+    size = os.path.getsize(args.path)
+    commands = [('rsysaggregate', [args.python, AGGREGATOR, '--max-keys', str(args.max_keys)])]
+    if shutil.which('datamash'):
+        commands.append(('datamash', ['datamash', '-s', '-W', '--group', '1,2,3', 'count', '4', 'sum', '5']))
+    
+    rows = []
+    outputs = {}
+    for name, command in commands:
+        outputs[name] = args.path + '.' + name
+        elapsed = run(command, args.path, outputs[name])
+        rows.append((name, '%.2f' % elapsed, '%.0f' % (args.lines / elapsed), '%.1f' % (size / elapsed / 2**20)))
+    
+    table(rows, ('aggregator', 'seconds', 'lines/sec', 'MB/sec'))
+    
+    if 'datamash' in outputs:
+        # Row order may differ with the locale datamash sorts in
+        with open(outputs['datamash'], 'rb') as a, open(outputs['rsysaggregate'], 'rb') as b:
+            same = sorted(a.read().split(b'\n')) == sorted(b.read().split(b'\n'))
+        print('Outputs match' if same else 'OUTPUTS DIFFER')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Compares writing plain per-token logs and gzipping them on rotation (what
+paragun-logs does) against writing block-compressed archives directly, and
+reading one time slice back from each.
+    
+    python -m benchmarks.archive --records 500000
+"""
+from benchmarks import Timer, setup, table
+
+import argparse
+import gzip
+import os
+import random
+import shutil
+import tempfile
+
+
+def lines(count, seed=0):
+    from parsing.pipeline import WriteStage, rfc3339
+    
+    rand = random.Random(seed)
+    start = 1546300800
+    for i in range(count):
+        yield WriteStage.serialize({
+            'timestamp': rfc3339(start + i // 10),
+            'timestamp_rec': rfc3339(start + i // 10),
+            'node': 'node1',
+            'protocol': 'tcp',
+            'host': 'web%s' % rand.randint(1, 20),
+            'host_dns': '', 'host_ip': '10.0.0.%s' % rand.randint(1, 254),
+            'process': 'sshd', 'facility': 'auth', 'severity': 'info',
+            'msg': 'Failed password for invalid user user%s from 218.49.%s.%s port %s ssh2' % (rand.randint(1, 500), rand.randint(0, 255), rand.randint(0, 255), rand.randint(1024, 65535)),
+            'msg_bytes': '90', 'token': '3f125cd7-fd46-4e37-a88e-610db52c1562',
+            'data': {'user': 'user%s' % rand.randint(1, 500), 'src_ip': '218.49.1.1'},
+        })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=500000)
+    parser.add_argument('--batch', type=int, default=500)
+    parser.add_argument('--block-size', type=int, default=1000)
+    args = parser.parse_args()
+    
+    setup()
+    from parsing.archive import ArchiveWriter, epoch, iter_lines, record_timestamp
+    
+    def in_range(line):
+        ts = epoch(record_timestamp(line))
+        return ts is not None and start <= ts <= end
+    
+    corpus = list(lines(args.records))
+    batches = [corpus[i:i + args.batch] for i in range(0, len(corpus), args.batch)]
+    raw = sum(len(x) for x in corpus)
+    
+    # Slice of about 1% of the records
+    start = 1546300800 + args.records // 20
+    end = start + args.records // 1000
+    
+    directory = tempfile.mkdtemp()
+    rows = []
+    try:
+        plain = os.path.join(directory, 'plain.log')
+        with Timer() as write:
+            for batch in batches:
+                with open(plain, 'a') as f:
+                    f.write(''.join(batch))
+        with Timer() as rotate:
+            with open(plain, 'rb') as src, gzip.open(plain + '.gz', 'wb', compresslevel=6) as dst:
+                shutil.copyfileobj(src, dst)
+            os.unlink(plain)
+        with Timer() as read:
+            with gzip.open(plain + '.gz', 'rt') as f:
+                found = sum(1 for x in f if in_range(x))
+        compressed = os.path.getsize(plain + '.gz')
+        rows.append(('plain + gzip', '%.2f' % write.elapsed, '%.2f' % rotate.elapsed, '%.1f' % ((raw * 2 + compressed) / 2**20), compressed, found, '%.3f' % read.elapsed))
+        
+        archive = os.path.join(directory, 'archive.log.gz')
+        writer = ArchiveWriter(archive, block_size=args.block_size, linger=3600)
+        with Timer() as write:
+            for batch in batches:
+                writer.write(batch)
+            writer.close()
+        with Timer() as read:
+            found = sum(1 for x in iter_lines(archive, start=start, end=end) if in_range(x))
+        compressed = os.path.getsize(archive) + os.path.getsize(archive + '.idx')
+        rows.append(('archive', '%.2f' % write.elapsed, '0.00', '%.1f' % (compressed / 2**20), compressed, found, '%.3f' % read.elapsed))
+    finally:
+        shutil.rmtree(directory)
+    
+    print('%s records, %.1f MB uncompressed' % (args.records, raw / 2**20))
+    table(rows, ('method', 'write s', 'rotate s', 'disk MB moved', 'bytes on disk', 'slice records', 'slice read s'))
+
+
+if __name__ == '__main__':
+    main()
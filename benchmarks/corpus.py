@@ -0,0 +1,160 @@
+"""
+Seeded generator of realistic syslog traffic (sshd, ufw, nginx and cron
+messages, with a mix of public and private addresses) and a parse tree that
+covers it, shared by the parsing benchmarks.
+    
+    python -m benchmarks.corpus --events 100000 --output corpus.jsonl
+
+writes the events as mmexternal fulljson lines, as rsyslog would hand them to
+rsysparse.py, so the same traffic can be replayed later.
+"""
+import argparse
+import json
+import random
+import sys
+
+TOKEN = '3f125cd7-fd46-4e37-a88e-610db52c1562'
+
+IPV4 = '([0-9]{1,3}\\.[0-9]{1,3}\\.[0-9]{1,3}\\.[0-9]{1,3})'
+
+PARSE_TREE = {
+    'sshd': {
+        'src_ip': {'validator': '(.*)', 'type': 'ip', 'parsers': ['from ' + IPV4, 'rhost=' + IPV4]},
+        'src_port': {'validator': '(.*)', 'type': 'int', 'parsers': ['port ([0-9]+)']},
+        'user': {'validator': '(.*)', 'type': 'str', 'parsers': ['invalid user ([a-zA-Z0-9\\.\\-]+) from', 'for ([a-zA-Z0-9\\.\\-]+) from', 'user=([a-zA-Z0-9\\.\\-]+)']},
+        'action': {'validator': '(.*)', 'type': 'str', 'parsers': ['^(Accepted|Failed) ']},
+    },
+    'kernel': {
+        'action': {'validator': '(.*)', 'type': 'str', 'parsers': ['\\[UFW ([A-Z]+)\\]']},
+        'src_ip': {'validator': '(.*)', 'type': 'ip', 'parsers': ['SRC=' + IPV4]},
+        'dest_ip': {'validator': '(.*)', 'type': 'ip', 'parsers': ['DST=' + IPV4]},
+        'protocol': {'validator': '(.*)', 'type': 'str', 'parsers': ['PROTO=([A-Z]+)']},
+        'dest_port': {'validator': '(.*)', 'type': 'int', 'parsers': ['DPT=([0-9]+)']},
+    },
+    'nginx': {
+        'src_ip': {'validator': '(.*)', 'type': 'ip', 'parsers': ['^' + IPV4 + ' ']},
+        'http_method': {'validator': '(GET|POST|PUT|DELETE|HEAD)', 'type': 'str', 'parsers': ['"([A-Z]+) ']},
+        'uri_path': {'validator': '(.*)', 'type': 'str', 'parsers': ['"[A-Z]+ ([^ ?"]+)']},
+        'status': {'validator': '(.*)', 'type': 'int', 'parsers': ['" ([0-9]{3}) ']},
+        'bytes': {'validator': '(.*)', 'type': 'int', 'parsers': ['" [0-9]{3} ([0-9]+) ']},
+        'http_user_agent': {'validator': '(.*)', 'type': 'str', 'parsers': ['"([^"]*)"$']},
+    },
+    'cron': {
+        'user': {'validator': '(.*)', 'type': 'str', 'parsers': ['^\\(([a-z]+)\\)']},
+        'command': {'validator': '(.*)', 'type': 'str', 'parsers': ['CMD \\((.*)\\)$']},
+    },
+}
+
+USERS = ('root', 'admin', 'ubuntu', 'deploy', 'test', 'oracle', 'postgres', 'git')
+PATHS = ('/', '/index.html', '/api/v1/items', '/login', '/static/app.js', '/wp-login.php', '/favicon.ico')
+AGENTS = ('Mozilla/5.0 (X11; Linux x86_64; rv:64.0) Gecko/20100101 Firefox/64.0', 'curl/7.58.0', 'Googlebot/2.1 (+http://www.google.com/bot.html)')
+COMMANDS = ('cd / && run-parts --report /etc/cron.hourly', '/usr/bin/php /var/www/cron.php', 'test -x /usr/sbin/anacron || ( cd / && run-parts --report /etc/cron.daily )')
+
+TEMPLATES = {
+    'sshd': (
+        'Failed password for invalid user %(user)s from %(ip)s port %(port)s ssh2',
+        'Failed password for %(user)s from %(ip)s port %(port)s ssh2',
+        'Accepted publickey for %(user)s from %(ip)s port %(port)s ssh2: RSA SHA256:abcDEF123+/xyz',
+        'Connection closed by %(ip)s port %(port)s [preauth]',
+        'pam_unix(sshd:auth): authentication failure; logname= uid=0 euid=0 tty=ssh ruser= rhost=%(ip)s  user=%(user)s',
+    ),
+    'kernel': (
+        '[UFW BLOCK] IN=eth0 OUT= MAC=00:00:00:00:00:00 SRC=%(ip)s DST=%(private)s LEN=40 TOS=0x00 PREC=0x00 TTL=244 ID=54321 PROTO=TCP SPT=%(port)s DPT=%(service)s WINDOW=1024 RES=0x00 SYN URGP=0',
+        '[UFW ALLOW] IN=eth0 OUT= MAC=00:00:00:00:00:00 SRC=%(ip)s DST=%(private)s LEN=60 TOS=0x00 PREC=0x00 TTL=57 ID=0 DF PROTO=TCP SPT=%(port)s DPT=443 WINDOW=29200 RES=0x00 SYN URGP=0',
+    ),
+    'nginx': (
+        '%(ip)s - - [01/Jan/2019:00:00:00 +0000] "%(method)s %(path)s HTTP/1.1" %(status)s %(bytes)s "-" "%(agent)s"',
+    ),
+    'cron': (
+        '(%(user)s) CMD (%(command)s)',
+        'pam_unix(cron:session): session opened for user %(user)s by (uid=0)',
+    ),
+}
+
+# Relative share of each service in the traffic
+MIX = (('sshd', 40), ('kernel', 30), ('nginx', 25), ('cron', 5))
+
+
+def address(rand, public, pool=None):
+    if rand.random() < public:
+        if pool: return rand.choice(pool)
+        
+        # Public unicast, avoiding the obviously reserved first octets
+        return '%s.%s.%s.%s' % (rand.choice((8, 23, 45, 62, 81, 104, 151, 185, 203, 218)), rand.randint(0, 255), rand.randint(0, 255), rand.randint(1, 254))
+    octets = (rand.randint(0, 255), rand.randint(0, 255), rand.randint(1, 254))
+    return rand.choice(('10.%s.%s.%s' % octets, '192.168.%s.%s' % octets[1:], '172.16.%s.%s' % octets[1:]))
+
+
+def generate(count, seed=0, public=0.5, addresses=None):
+    """
+    Yields (service, message) pairs.
+    
+    Kwargs:
+        seed (int): Random seed; the same seed always gives the same events.
+        public (float): Share of addresses that are public (and so get
+            GeoIP/ASN enrichment).
+        addresses (int): Draw public addresses from a pool of this many, as
+            when a few scanners or clients make most of the traffic. By
+            default nearly every public address is different.
+    
+    """
+    rand = random.Random(seed)
+    pool = [address(random.Random(seed + i), 1) for i in range(addresses)] if addresses else None
+    services = [service for service, weight in MIX for i in range(weight)]
+    for i in range(count):
+        service = rand.choice(services)
+        yield service, rand.choice(TEMPLATES[service]) % {
+            'user': rand.choice(USERS),
+            'ip': address(rand, public, pool),
+            'private': address(rand, 0),
+            'port': rand.randint(1024, 65535),
+            'service': rand.choice((22, 23, 80, 443, 3389, 8080)),
+            'method': rand.choice(('GET', 'GET', 'GET', 'POST', 'HEAD')),
+            'path': rand.choice(PATHS),
+            'status': rand.choice((200, 200, 200, 301, 404, 500)),
+            'bytes': rand.randint(0, 50000),
+            'agent': rand.choice(AGENTS),
+            'command': rand.choice(COMMANDS),
+        }
+
+
+def fulljson(service, message, host='10.0.0.1'):
+    """
+    Wraps an event the way rsyslog's consumer ruleset hands it to
+    mmexternal (interface.input="fulljson"), after tagging it with a token.
+    
+    """
+    raw = '%s %s@P4R4GN' % (message, TOKEN)
+    return json.dumps({
+        'msg': raw,
+        'rawmsg': '<38>Jan  1 00:00:00 web1 %s[1234]: %s' % (service, raw),
+        'timereported': '2019-01-01T00:00:00.000000+00:00',
+        'hostname': 'web1', 'syslogtag': '%s[1234]:' % service, 'inputname': 'imrelp', 'fromhost': 'web1', 'fromhost-ip': host,
+        'pri': '38', 'syslogfacility': '4', 'syslogseverity': '6', 'timegenerated': '2019-01-01T00:00:00.000000+00:00',
+        'programname': service, 'protocol-version': '0', 'structured-data': '-', 'app-name': service, 'procid': '1234', 'msgid': '-', 'uuid': None,
+        '$!': {
+            'token_ext': TOKEN, 'msg_short': message, 'hostname_clean': 'web1', 'fromhost_clean': 'web1', 'fromhost-ip_clean': host,
+            'programname_clean': service, 'facility-text_clean': 'auth', 'severity-text_clean': 'info', 'msg_bytes': len(raw), 'data': '{}',
+        },
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--public', type=float, default=0.5, help="Share of public addresses.")
+    parser.add_argument('--addresses', type=int, help="Number of distinct public addresses.")
+    parser.add_argument('--output', default='-')
+    args = parser.parse_args()
+    
+    output = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        for service, message in generate(args.events, args.seed, args.public, args.addresses):
+            output.write(fulljson(service, message) + '\n')
+    finally:
+        if output is not sys.stdout: output.close()
+
+
+if __name__ == '__main__':
+    main()
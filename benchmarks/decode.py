@@ -0,0 +1,59 @@
+"""
+Measures per-event decode cost of rsysparse's input: json.loads of the whole
+fulljson message against local_properties(), which decodes only `$!`.
+    
+    python -m benchmarks.decode --events 50000
+"""
+from benchmarks import Timer, rsysparse, table
+
+import argparse
+import json
+
+
+def blob(size):
+    """
+    A fulljson line shaped like rsyslog's, with a message of about `size`
+    bytes.
+    
+    """
+    token = '3f125cd7-fd46-4e37-a88e-610db52c1562'
+    message = ('Failed password for invalid user admin from 10.1.2.3 port 22 ssh2 ' * (size // 66 + 1))[:size]
+    fields = {
+        'msg': '%s@P4R4GN %s' % (token, message),
+        'rawmsg': '<38>Jan  1 00:00:00 web1 sshd[1234]: %s@P4R4GN %s' % (token, message),
+        'timereported': '2019-01-01T00:00:00.000000+00:00',
+        'hostname': 'web1', 'syslogtag': 'sshd[1234]:', 'inputname': 'imrelp', 'fromhost': 'web1', 'fromhost-ip': '10.0.0.1',
+        'pri': '38', 'syslogfacility': '4', 'syslogseverity': '6', 'timegenerated': '2019-01-01T00:00:00.000000+00:00',
+        'programname': 'sshd', 'protocol-version': '0', 'structured-data': '-', 'app-name': 'sshd', 'procid': '1234', 'msgid': '-', 'uuid': None,
+        '$!': {
+            'token_ext': token, 'msg_short': message, 'hostname_clean': 'web1', 'fromhost_clean': 'web1', 'fromhost-ip_clean': '10.0.0.1',
+            'programname_clean': 'sshd', 'facility-text_clean': 'auth', 'severity-text_clean': 'info', 'msg_bytes': size, 'data': '{}',
+        },
+    }
+    # rsyslog writes `"key": value` pairs separated by `, `
+    return json.dumps(fields)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=50000)
+    args = parser.parse_args()
+    
+    module = rsysparse()
+    rows = []
+    for size in (100, 1000, 8000):
+        line = blob(size)
+        assert module.local_properties(line) == json.loads(line)['$!']
+        
+        with Timer() as full:
+            for i in range(args.events): json.loads(line).get('$!', {})
+        with Timer() as local:
+            for i in range(args.events): module.local_properties(line)
+        
+        rows.append([size, len(line), '%.2f' % (full.elapsed / args.events * 1e6), '%.2f' % (local.elapsed / args.events * 1e6), '%.1fx' % (full.elapsed / local.elapsed)])
+    
+    table(rows, ('msg bytes', 'line bytes', 'fulljson us/event', '$! only us/event', 'speedup'))
+
+
+if __name__ == '__main__':
+    main()
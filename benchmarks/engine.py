@@ -0,0 +1,217 @@
+"""
+Benchmarks the parsing engine in rsysparse.py on a seeded synthetic corpus
+(see benchmarks.corpus): ParsingEngine.parse, ParsingEngine.parse_batch,
+IPParser.geoip, ParsingEngine.load_parsers and onReceive.
+    
+    python -m benchmarks.engine --events 20000 --output results.json
+    python -m benchmarks.engine --compare results.json
+
+parse_batch is timed per batch of --batch events (as the native service's
+ParseStage calls it), but its throughput is in events per second, so it
+compares directly with parse. Use --addresses to make public addresses repeat
+the way scanners and busy clients do; the lookups saved show up in the
+geoip_dedup ratio (events per lookup).
+
+Each benchmark reports throughput, latency percentiles and, from a separate
+pass under tracemalloc, peak and retained memory. Results are written as JSON
+(tagged with the git commit) so runs on different commits can be compared
+with --compare.
+
+GeoIP lookups use in-memory stand-ins for the MaxMind/pyasn readers unless
+--geoip points at a directory with real latest-isp, latest-city and
+latest-asn databases, so the numbers measure the engine rather than the
+databases.
+"""
+from benchmarks import ROOT, corpus, rsysparse, table
+from time import perf_counter
+from types import SimpleNamespace
+
+import argparse
+import copy
+import json
+import os
+import platform
+import re
+import subprocess
+import tracemalloc
+
+
+class StubReader(object):
+    """
+    Stands in for a geoip2.database.Reader with both ISP and city data.
+    
+    """
+    def asn(self, ip):
+        first = int(ip.split('.')[0])
+        return SimpleNamespace(autonomous_system_number=64512 + first, autonomous_system_organization='Example Networks %s' % first)
+    
+    def city(self, ip):
+        first = int(ip.split('.')[0])
+        return SimpleNamespace(
+            country=SimpleNamespace(iso_code='US'),
+            subdivisions=SimpleNamespace(most_specific=SimpleNamespace(iso_code='CA')),
+            location=SimpleNamespace(latitude=37.0 + first / 100, longitude=-122.0),
+        )
+    
+    def close(self):
+        pass
+
+
+class StubASN(object):
+    """
+    Stands in for a pyasn.pyasn database.
+    
+    """
+    def lookup(self, ip):
+        return 64512 + int(ip.split('.')[0]), '%s.0.0.0/8' % ip.split('.')[0]
+
+
+class Sink(object):
+    def write(self, data):
+        return len(data)
+    
+    def flush(self):
+        pass
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def measure(function, items, sample=5000, repeat=3):
+    """
+    Calls `function(item)` for every item, `repeat` times; the fastest pass
+    is reported, since slower ones mostly measure other load on the machine.
+    
+    Returns:
+        result (dict): Calls per second, latency percentiles (microseconds)
+            and, over the first `sample` items, peak and retained memory
+            allocated (KB).
+    
+    """
+    latencies = None
+    for i in range(repeat):
+        current = []
+        for item in items:
+            start = perf_counter()
+            function(item)
+            current.append(perf_counter() - start)
+        if latencies is None or sum(current) < sum(latencies):
+            latencies = current
+    
+    tracemalloc.start()
+    for item in items[:sample]:
+        function(item)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    
+    total = sum(latencies)
+    latencies.sort()
+    return {
+        'calls': len(items),
+        'seconds': round(total, 4),
+        'per_second': round(len(items) / total, 1) if total else None,
+        'p50_us': round(percentile(latencies, 50) * 1e6, 2),
+        'p90_us': round(percentile(latencies, 90) * 1e6, 2),
+        'p99_us': round(percentile(latencies, 99) * 1e6, 2),
+        'max_us': round(latencies[-1] * 1e6, 2),
+        'peak_kb': round(peak / 1024, 1),
+        'retained_kb': round(current / 1024, 1),
+    }
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    module = rsysparse()
+    if args.geoip:
+        import geoip2.database
+        import pyasn
+        module.mm_isp_db = geoip2.database.Reader(os.path.join(args.geoip, 'latest-isp'))
+        module.mm_city_db = geoip2.database.Reader(os.path.join(args.geoip, 'latest-city'))
+        module.asn_db = pyasn.pyasn(os.path.join(args.geoip, 'latest-asn'))
+    else:
+        module.mm_isp_db = module.mm_city_db = StubReader()
+        module.asn_db = StubASN()
+    
+    events = list(corpus.generate(args.events, args.seed, args.public, args.addresses))
+    engine = module.ParsingEngine()
+    engine.load_parsers(copy.deepcopy(corpus.PARSE_TREE))
+    module.engine = engine
+    
+    ip = re.compile('(?:^|[ =])((?:[0-9]{1,3}\\.){3}[0-9]{1,3})')
+    public = [x for x in (ip.search(message).group(1) for service, message in events if ip.search(message)) if not module.IPAddress(x).is_private()]
+    trees = [copy.deepcopy(corpus.PARSE_TREE) for i in range(args.reloads)]
+    lines = [corpus.fulljson(service, message) for service, message in events]
+    
+    results = {}
+    results['parse'] = measure(lambda x: engine.parse(*x), events, repeat=args.repeat)
+    
+    batches = [events[i:i + args.batch] for i in range(0, len(events), args.batch)]
+    counters = {}
+    engine.parse_batch(events, counters=counters)
+    results['parse_batch'] = measure(engine.parse_batch, batches, sample=len(batches), repeat=args.repeat)
+    results['parse_batch']['per_second'] = round(len(events) / results['parse_batch']['seconds'], 1)
+    results['geoip'] = measure(module.IPParser.geoip, public, repeat=args.repeat)
+    results['load_parsers'] = measure(module.ParsingEngine().load_parsers, trees, sample=len(trees), repeat=1)
+    module.output = Sink()
+    results['onReceive'] = measure(module.onReceive, lines, repeat=args.repeat)
+    
+    return {
+        'commit': commit(),
+        'python': '%s %s' % (platform.python_implementation(), platform.python_version()),
+        'events': args.events,
+        'seed': args.seed,
+        'public': args.public,
+        'addresses': args.addresses,
+        'batch': args.batch,
+        'geoip_dedup': round(counters['geoip_requested'] / counters['geoip_lookups'], 2) if counters.get('geoip_lookups') else None,
+        'geoip': 'real' if args.geoip else 'stub',
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--public', type=float, default=0.5, help="Share of public addresses in the corpus.")
+    parser.add_argument('--addresses', type=int, help="Number of distinct public addresses in the corpus.")
+    parser.add_argument('--batch', type=int, default=500, help="Events per parse_batch call.")
+    parser.add_argument('--reloads', type=int, default=50, help="Parse tree loads to time.")
+    parser.add_argument('--repeat', type=int, default=3, help="Timed passes per benchmark; the fastest is kept.")
+    parser.add_argument('--geoip', help="Directory with real GeoIP/ASN databases.")
+    parser.add_argument('--output', help="Write results to this JSON file.")
+    parser.add_argument('--compare', help="Results JSON from an earlier run to compare against.")
+    args = parser.parse_args()
+    
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    
+    rows = []
+    for name, result in report['results'].items():
+        row = [name, result['calls'], result['per_second'], result['p50_us'], result['p90_us'], result['p99_us'], result['peak_kb']]
+        if baseline:
+            before = baseline['results'].get(name)
+            row.append('%+.1f%%' % ((result['per_second'] / before['per_second'] - 1) * 100) if before else '-')
+        rows.append(row)
+    
+    print('%s on %s, %s events, %s GeoIP, %s events per lookup in batches of %s' % (report['python'], report['commit'], report['events'], report['geoip'], report['geoip_dedup'], report['batch']))
+    headers = ('benchmark', 'calls', 'per second', 'p50 us', 'p90 us', 'p99 us', 'peak KB')
+    table(rows, headers + (('vs %s' % baseline['commit'],) if baseline else ()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Measures how many regexes ParsingEngine.parse evaluates per event, and how
+fast it runs, with and without a per-service family map.
+    
+    python -m benchmarks.families --events 20000
+"""
+from benchmarks import Timer, rsysparse, table
+
+import argparse
+import copy
+import random
+
+IPV4 = '([0-9]{1,3}\\.[0-9]{1,3}\\.[0-9]{1,3}\\.[0-9]{1,3})'
+
+PARSE_TREE = {
+    'sshd': {
+        'src_ip': {'validator': '(.*)', 'type': 'str', 'parsers': ['from ' + IPV4, 'by ' + IPV4, 'rhost=' + IPV4]},
+        'src_port': {'validator': '(.*)', 'type': 'int', 'parsers': ['port ([0-9]+)']},
+        'user': {'validator': '(.*)', 'type': 'str', 'parsers': ['invalid user ([a-zA-Z0-9\\.\\-]+) from', 'for ([a-zA-Z0-9\\.\\-]+) from', 'user=([a-zA-Z0-9\\.\\-]+)']},
+        'action': {'validator': '(.*)', 'type': 'str', 'parsers': ['^(Accepted|Failed) ']},
+        'signature': {'validator': '(.*)', 'type': 'str', 'parsers': ['(publickey|password|keyboard-interactive)']},
+        'ssl_hash': {'validator': '(.*)', 'type': 'str', 'parsers': ['SHA256:([A-Za-z0-9+/]+)']},
+        'session_id': {'validator': '(.*)', 'type': 'str', 'parsers': ['session ([0-9]+)']},
+        'protocol': {'validator': '(.*)', 'type': 'str', 'parsers': [' (ssh2)']},
+    },
+}
+
+TEMPLATES = (
+    'Failed password for invalid user %(user)s from %(ip)s port %(port)s ssh2',
+    'Failed password for %(user)s from %(ip)s port %(port)s ssh2',
+    'Accepted publickey for %(user)s from %(ip)s port %(port)s ssh2: RSA SHA256:abcDEF123+/xyz',
+    'Connection closed by %(ip)s port %(port)s [preauth]',
+    'Received disconnect from %(ip)s port %(port)s:11: Bye Bye [preauth]',
+    'pam_unix(sshd:session): session opened for user %(user)s by (uid=0)',
+    'Disconnected from user %(user)s %(ip)s port %(port)s',
+)
+
+
+class CountingPattern(object):
+    """
+    Wraps a compiled regex and counts how often it is searched.
+    
+    """
+    count = 0
+    
+    def __init__(self, pattern):
+        self.pattern = pattern
+    
+    def search(self, *args, **kwargs):
+        CountingPattern.count += 1
+        return self.pattern.search(*args, **kwargs)
+
+
+def events(count, seed=0):
+    rand = random.Random(seed)
+    users = ('root', 'admin', 'ubuntu', 'test', 'deploy')
+    for i in range(count):
+        yield rand.choice(TEMPLATES) % {
+            'user': rand.choice(users),
+            'ip': '%s.%s.%s.%s' % tuple(rand.randint(1, 254) for x in range(4)),
+            'port': rand.randint(1024, 65535),
+        }
+
+
+def engine(families=False):
+    module = rsysparse()
+    obj = module.ParsingEngine()
+    obj.load_parsers(copy.deepcopy(PARSE_TREE))
+    
+    if families:
+        # One sample per template, like a parser author would add
+        samples = list(events(len(TEMPLATES) * 20, seed=1))
+        obj.families['sshd'] = {k: frozenset(v) for k,v in obj.build_families('sshd', samples).items()}
+    
+    for parser in obj.parse_tree['sshd'].values():
+        parser.parsers = tuple(CountingPattern(x) for x in parser.parsers)
+    return obj
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=20000)
+    args = parser.parse_args()
+    
+    corpus = list(events(args.events))
+    
+    rows = []
+    results = {}
+    for families in (False, True):
+        obj = engine(families)
+        CountingPattern.count = 0
+        with Timer() as timer:
+            results[families] = [obj.parse('sshd', x) for x in corpus]
+        rows.append(('families' if families else 'all fields', '%.2f' % (CountingPattern.count / len(corpus)), '%.0f' % (len(corpus) / timer.elapsed)))
+    
+    # Families built from samples covering every template must not lose fields
+    assert results[False] == results[True]
+    
+    table(rows, ('mode', 'regex evals/event', 'events/sec'))
+
+
+if __name__ == '__main__':
+    main()
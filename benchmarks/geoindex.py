@@ -0,0 +1,164 @@
+"""
+Benchmarks the IPv4 GeoIP index in rsysparse.py (GeoIndex) on random public
+IPv4 addresses: building, saving and loading it, and looking addresses up in
+batches (as IPParser.geoip_batch does), one at a time, and through the
+databases it stands in for.
+    
+    python -m benchmarks.geoindex --count 1000000
+    python -m benchmarks.geoindex --geoip /usr/share/GeoIP --output results.json
+
+Without --geoip the index is built from synthetic ranges (--ranges of them
+per database, covering the address space with a few gaps, as the real ones
+do) and there are no databases to compare against. With --geoip
+it is built from the real latest-asn, latest-isp and latest-city databases
+in that directory, and the first --compare addresses are also looked up
+through the databases, both to time them and to check the index gives the
+same fields for every one.
+"""
+from benchmarks import Timer, rsysparse, table
+from benchmarks.engine import commit
+
+import argparse
+import json
+import os
+import platform
+import random
+import tempfile
+
+# First octets that are never public unicast (private, loopback, CGNAT,
+# link local, multicast and reserved) or only partly (172, 192, 198)
+RESERVED = {0, 10, 127, 224, 225, 226, 227, 228, 229, 230, 231, 232, 233, 234, 235, 236, 237, 238, 239} | set(range(240, 256))
+
+
+def public_address(rand):
+    while True:
+        number = rand.getrandbits(32)
+        first, second = number >> 24, number >> 16 & 0xff
+        if first in RESERVED: continue
+        if (first, second >> 6) == (100, 1) or (first, second) in ((169, 254), (192, 168), (198, 18), (198, 19)): continue
+        if first == 172 and 16 <= second < 32: continue
+        return '%s.%s.%s.%s' % (first, second, number >> 8 & 0xff, number & 0xff)
+
+
+def synthetic(module, count, seed=0):
+    """
+    Returns:
+        index (GeoIndex): Built from `count` random ranges per database, one
+            in ten of them followed by a gap, with rows shaped like the real
+            ones.
+    
+    """
+    rand = random.Random(seed)
+    sources = {}
+    for source in module.GeoIndex.SOURCES:
+        starts = [0] + sorted(rand.sample(range(1, 1 << 32), count - 1))
+        ranges = []
+        for first, following in zip(starts, starts[1:] + [1 << 32]):
+            last = following - 1 if rand.random() < 0.9 else (first + following) // 2
+            group = rand.randint(0, count // 10)
+            if source == 'asn':
+                row = (first, 32)
+            elif source == 'isp':
+                row = (group, 'Example Networks %s' % group)
+            else:
+                row = ('US', 'US-%s' % (group % 50), round(rand.uniform(-90, 90), 4), round(rand.uniform(-180, 180), 4))
+            ranges.append((first, last, row))
+        sources[source] = ranges
+    return module.GeoIndex.from_ranges(sources)
+
+
+def run(args):
+    module = rsysparse()
+    if module.numpy is None:
+        raise SystemExit('numpy is not installed; rsysparse.py has no GeoIP index without it.')
+    
+    rand = random.Random(args.seed)
+    ips = [public_address(rand) for i in range(args.count)]
+    
+    with Timer() as build:
+        if args.geoip:
+            module.geoip_path = args.geoip
+            module.open_databases()
+            index = module.GeoIndex.build(module.asn_db, os.path.join(args.geoip, 'latest-isp'), os.path.join(args.geoip, 'latest-city'))
+        else:
+            index = synthetic(module, args.ranges, args.seed)
+    
+    path = os.path.join(tempfile.mkdtemp(prefix='geoindex-'), 'index.npz')
+    with Timer() as save:
+        index.save(path)
+    with Timer() as load:
+        index = module.GeoIndex.load(path)
+    
+    results = {}
+    with Timer() as t:
+        found = {}
+        for i in range(0, len(ips), args.batch):
+            found.update(index.lookup_batch(ips[i:i + args.batch]))
+    results['lookup_batch'] = {'calls': len(ips), 'seconds': t.elapsed}
+    
+    with Timer() as t:
+        index.lookup_batch(ips)
+    results['lookup_batch (all)'] = {'calls': len(ips), 'seconds': t.elapsed}
+    
+    single = ips[:args.single]
+    with Timer() as t:
+        for ip in single:
+            index.lookup(ip)
+    results['lookup'] = {'calls': len(single), 'seconds': t.elapsed}
+    
+    mismatches = None
+    if args.geoip:
+        sample = ips[:args.compare]
+        with Timer() as t:
+            expected = {ip: module.IPParser.geoip(ip, index=False) for ip in sample}
+        results['geoip (databases)'] = {'calls': len(sample), 'seconds': t.elapsed}
+        mismatches = sum(1 for ip in sample if ip in found and found[ip] != expected[ip])
+    
+    for result in results.values():
+        result['per_second'] = round(result['calls'] / result['seconds'], 1) if result['seconds'] else None
+        result['seconds'] = round(result['seconds'], 4)
+    
+    return {
+        'commit': commit(),
+        'python': '%s %s' % (platform.python_implementation(), platform.python_version()),
+        'count': args.count,
+        'seed': args.seed,
+        'batch': args.batch,
+        'geoip': 'real' if args.geoip else 'synthetic',
+        'ranges': {source: len(index.ranges[source][0]) for source in index.SOURCES},
+        'hits': round(len(found) / len(set(ips)), 4),
+        'mismatches': mismatches,
+        'build_s': round(build.elapsed, 3),
+        'save_s': round(save.elapsed, 3),
+        'load_s': round(load.elapsed, 3),
+        'sidecar_kb': round(os.path.getsize(path) / 1024, 1),
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=1000000, help="Random public IPv4 addresses to look up.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--batch', type=int, default=500, help="Addresses per lookup_batch call.")
+    parser.add_argument('--single', type=int, default=100000, help="Addresses to look up one at a time.")
+    parser.add_argument('--ranges', type=int, default=500000, help="Synthetic ranges per database.")
+    parser.add_argument('--geoip', help="Directory with real GeoIP/ASN databases.")
+    parser.add_argument('--compare', type=int, default=20000, help="Addresses to also look up through the databases (with --geoip).")
+    parser.add_argument('--output', help="Write results to this JSON file.")
+    args = parser.parse_args()
+    
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    
+    print('%s on %s, %s GeoIP, %s ranges; built in %ss, saved in %ss (%s KB), loaded in %ss' % (report['python'], report['commit'], report['geoip'], report['ranges'], report['build_s'], report['save_s'], report['sidecar_kb'], report['load_s']))
+    print('%.1f%% of addresses found in the index%s' % (report['hits'] * 100, '' if report['mismatches'] is None else ', %s differing from the databases' % report['mismatches']))
+    table([[name, x['calls'], x['seconds'], x['per_second']] for name, x in report['results'].items()], ('benchmark', 'calls', 'seconds', 'per second'))
+    
+    if report['mismatches']: raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
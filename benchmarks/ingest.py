@@ -0,0 +1,139 @@
+"""
+Measures native ingest throughput (events per second) as the number of
+SO_REUSEPORT worker processes grows.
+    
+    python -m benchmarks.ingest --workers 1 2 4 --events 200000
+
+Clients run on the same machine and compete for the same cores, so treat
+the numbers as relative, not absolute.
+"""
+from benchmarks import Timer, setup, table
+from multiprocessing import Process
+from time import sleep, time
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import tempfile
+
+TOKEN = '3f125cd7-fd46-4e37-a88e-610db52c1562'
+
+PARSE_TREE = {
+    'sshd': {
+        'src_ip': {'validator': '(.*)', 'type': 'str', 'parsers': ['from ([0-9]{1,3}\\.[0-9]{1,3}\\.[0-9]{1,3}\\.[0-9]{1,3})']},
+        'user': {'validator': '(.*)', 'type': 'str', 'parsers': ['user ([a-zA-Z0-9\\.\\-]+) from', 'username ([a-zA-Z0-9\\.\\-]+)']},
+    },
+}
+
+LINE = '<38>Aug  1 18:27:46 knight sshd[%s]: Failed password for illegal user test%s from 218.49.183.17 port 48849 ssh2 ' + TOKEN + '@P4R4GN\n'
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def stats(port):
+    """
+    Fetches a worker's stats, or None if it isn't answering yet.
+    
+    """
+    try:
+        sock = socket.create_connection(('127.0.0.1', port), timeout=1)
+        sock.sendall(b'GET / HTTP/1.0\r\n\r\n')
+        data = b''
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk: break
+            data += chunk
+        sock.close()
+        return json.loads(data.split(b'\r\n\r\n', 1)[1].decode('utf-8'))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def client(port, count):
+    payload = ''.join(LINE % (i, i) for i in range(count)).encode('utf-8')
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(payload)
+    sock.close()
+
+
+def run(workers, events, clients):
+    """
+    Starts a supervisor with the given number of workers, pushes `events`
+    lines through it and waits until all of them have been written.
+    
+    Returns:
+        elapsed (float): Seconds taken.
+    
+    """
+    from parsing.engine import get_engine
+    from parsing.service import Supervisor
+    
+    path = tempfile.mkdtemp()
+    port = free_port()
+    stats_port = free_port()
+    
+    pid = os.fork()
+    if not pid:
+        engine = get_engine(PARSE_TREE)
+        Supervisor(workers=workers, interface='127.0.0.1', port=port, stats_port=stats_port, engine=engine, tokens=[TOKEN], path=path).run()
+        os._exit(0)
+    
+    try:
+        # Wait for all workers to come up
+        deadline = time() + 30
+        while not all(stats(stats_port + n) for n in range(workers)):
+            if time() > deadline: raise RuntimeError("Workers did not start.")
+            sleep(0.1)
+        
+        per_client = events // clients
+        total = per_client * clients
+        
+        with Timer() as timer:
+            procs = [Process(target=client, args=(port, per_client)) for n in range(clients)]
+            for proc in procs: proc.start()
+            for proc in procs: proc.join()
+            
+            while True:
+                written = sum(s['pipeline']['WriteStage']['emitted'] for s in (stats(stats_port + n) for n in range(workers)) if s)
+                if written >= total: break
+                sleep(0.01)
+        
+        return total, timer.elapsed
+    
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+        shutil.rmtree(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--events', type=int, default=200000)
+    parser.add_argument('--clients', type=int, default=0, help="Client connections (default: 4 per worker).")
+    args = parser.parse_args()
+    
+    setup()
+    
+    rows = []
+    baseline = None
+    for workers in args.workers:
+        total, elapsed = run(workers, args.events, args.clients or workers * 4)
+        eps = total / elapsed
+        baseline = baseline or eps
+        rows.append((workers, total, '%.2f' % elapsed, '%.0f' % eps, '%.2fx' % (eps / baseline)))
+    
+    table(rows, ('workers', 'events', 'seconds', 'eps', 'speedup'))
+
+
+if __name__ == '__main__':
+    main()
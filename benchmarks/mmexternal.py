@@ -0,0 +1,264 @@
+"""
+Runs rsysparse.py the way rsyslog's mmexternal does and replays traffic
+through it end to end: events are written to the script's stdin as fulljson
+lines, and one reply line per event is read back from its stdout.
+    
+    python -m benchmarks.mmexternal --events 20000
+    python -m benchmarks.mmexternal --corpus corpus.jsonl --batch 32 --reload 0.1
+
+With the default --batch 1 only one event is in flight at a time, as with
+rsyslog, which waits for each reply before sending the next event. Larger
+batches keep that many events queued in the pipe, to tell the script's own
+throughput apart from the round trips.
+
+Reports sustained events per second, reply latency percentiles and reload
+pauses: replies that took over ten times the median, which is where parser
+tree reloads (every --reload minutes) and metrics flushes show up. Every
+reply is also checked to be exactly one line holding {"$!": {"data": {...}}};
+anything else (a stray print, a traceback, a missing newline) would shift
+every later reply onto the wrong event in rsyslog, and is counted as a
+framing error.
+
+The script runs against a temporary directory holding the parse tree from
+benchmarks.corpus, its log, its metrics index and, with --profile, its
+profiles (see Profiler in rsysparse.py). Without --geoip the GeoIP
+databases are missing, so IP enrichment is skipped (and its errors logged).
+"""
+from benchmarks import RSYSPARSE, corpus, table
+from benchmarks.engine import commit, percentile
+from collections import deque
+from time import perf_counter
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+
+
+class Script(object):
+    """
+    rsysparse.py running in a subprocess, with at most `batch` events in
+    flight.
+    
+    """
+    def __init__(self, python, workdir, env=None, batch=1, *args, **kwargs):
+        self.workdir = workdir
+        self.stderr = open(os.path.join(workdir, 'stderr'), 'w+b')
+        self.process = subprocess.Popen(
+            [python, RSYSPARSE],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.stderr,
+            cwd=workdir, env=env, bufsize=0,
+        )
+        self.replies = self.process.stdout
+        self.slots = threading.Semaphore(batch)
+        self.sent = deque()
+    
+    def send(self, lines, close=True):
+        """
+        Writes lines to the script's stdin as replies free up slots, then
+        (unless told not to) closes it; meant to run in its own thread.
+        
+        """
+        try:
+            for line in lines:
+                self.slots.acquire()
+                self.sent.append(perf_counter())
+                self.process.stdin.write(line.encode('utf-8') + b'\n')
+            if close: self.process.stdin.close()
+        except (BrokenPipeError, ValueError):
+            pass
+    
+    def receive(self):
+        """
+        Returns:
+            reply (tuple): (reply line, seconds since its event was sent),
+                or (None, None) once the script has closed its stdout.
+        
+        """
+        line = self.replies.readline()
+        if not line: return None, None
+        latency = perf_counter() - self.sent.popleft() if self.sent else None
+        self.slots.release()
+        return line, latency
+    
+    def close(self, timeout=30):
+        try:
+            self.process.stdin.close()
+        except (BrokenPipeError, ValueError):
+            pass
+        try:
+            return self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            return self.process.wait()
+    
+    def errors(self, tail=2000):
+        self.stderr.seek(0)
+        return self.stderr.read()[-tail:].decode('utf-8', 'replace')
+
+
+def framing_error(line):
+    """
+    Returns:
+        error (str): Why a reply line would break the mmexternal protocol,
+            or None if it is fine.
+    
+    """
+    if not line.endswith(b'\n'): return 'no trailing newline'
+    try:
+        reply = json.loads(line.decode('utf-8'))
+    except ValueError:
+        return 'not JSON'
+    if not isinstance(reply, dict) or list(reply) != ['$!']: return 'not a $! reply'
+    if not isinstance(reply['$!'], dict) or list(reply['$!']) != ['data']: return 'not a $!data reply'
+    if not isinstance(reply['$!']['data'], dict): return '$!data is not an object'
+    return None
+
+
+def replay(script, lines, close=True):
+    """
+    Sends every line through the script and reads its replies. Once stdin is
+    closed, anything else the script writes is counted as a framing error.
+    
+    Returns:
+        result (dict): Counts, latencies (seconds, in order) and framing
+            errors (up to 10 examples are kept).
+    
+    """
+    sender = threading.Thread(target=script.send, args=(lines, close), daemon=True)
+    latencies, bad, examples = [], 0, []
+    
+    start = perf_counter()
+    sender.start()
+    for i in range(len(lines)):
+        line, latency = script.receive()
+        if line is None: break
+        latencies.append(latency)
+        error = framing_error(line)
+        if error:
+            bad += 1
+            if len(examples) < 10: examples.append('%s: %r' % (error, line[:200]))
+    elapsed = perf_counter() - start
+    
+    sender.join()
+    extra = script.replies.read() if close else None
+    if extra:
+        bad += 1
+        examples.append('unrequested output: %r' % extra[:200])
+    
+    return {'sent': len(lines), 'replies': len(latencies), 'seconds': elapsed, 'latencies': latencies, 'framing_errors': bad, 'examples': examples}
+
+
+def load(args):
+    if args.corpus:
+        with open(args.corpus) as f:
+            return [line.rstrip('\n') for line in f if line.strip()]
+    return [corpus.fulljson(service, message) for service, message in corpus.generate(args.events, args.seed, args.public)]
+
+
+def run(args):
+    lines = load(args)
+    workdir = tempfile.mkdtemp(prefix='mmexternal-')
+    with open(os.path.join(workdir, 'parsers.json'), 'w') as f:
+        json.dump(corpus.PARSE_TREE, f)
+    
+    env = dict(os.environ)
+    env.update({
+        'RSYSPARSE_LOG': os.path.join(workdir, 'rsysparse.log'),
+        'RSYSPARSE_PARSERS': os.path.join(workdir, 'parsers.json'),
+        'RSYSPARSE_METRICS': os.path.join(workdir, 'metrics'),
+        'RSYSPARSE_GEOIP': args.geoip or os.path.join(workdir, 'GeoIP'),
+        'RSYSPARSE_REFRESH': str(args.reload),
+        'RSYSPARSE_PROFILE_DIR': workdir,
+        'PYTHONUNBUFFERED': '1',
+    })
+    
+    started = perf_counter()
+    script = Script(args.python, workdir, env, args.batch)
+    try:
+        # The first event also pays for startup (imports, databases, parse
+        # tree), so it is timed on its own
+        warmup = replay(script, lines[:1], close=False)
+        if warmup['replies'] != 1 or warmup['framing_errors']:
+            raise RuntimeError('rsysparse.py did not reply to the first event: %s\n%s' % (warmup['examples'], script.errors()))
+        startup = perf_counter() - started
+        
+        if args.profile:
+            with open(os.path.join(workdir, 'profile.trigger'), 'w') as f:
+                f.write(str(args.profile))
+        
+        result = replay(script, lines)
+    finally:
+        code = script.close()
+    
+    latencies = sorted(result['latencies'])
+    median = percentile(latencies, 50) if latencies else 0
+    pauses = [x for x in result['latencies'] if x > 10 * median]
+    log = os.path.join(workdir, 'rsysparse.log')
+    with open(log, errors='replace') as f:
+        stray = sum(1 for x in f if 'Stray output' in x)
+    
+    return {
+        'commit': commit(),
+        'python': subprocess.check_output([args.python, '-c', 'import platform; print(platform.python_implementation(), platform.python_version())']).decode('ascii').strip(),
+        'batch': args.batch,
+        'geoip': 'real' if args.geoip else 'none',
+        'startup_s': round(startup, 3),
+        'sent': result['sent'],
+        'replies': result['replies'],
+        'seconds': round(result['seconds'], 3),
+        'eps': round(result['replies'] / result['seconds'], 1) if result['seconds'] else None,
+        'p50_us': round(median * 1e6, 1) if latencies else None,
+        'p90_us': round(percentile(latencies, 90) * 1e6, 1) if latencies else None,
+        'p99_us': round(percentile(latencies, 99) * 1e6, 1) if latencies else None,
+        'max_us': round(latencies[-1] * 1e6, 1) if latencies else None,
+        'pauses': len(pauses),
+        'pause_max_ms': round(max(pauses) * 1e3, 1) if pauses else 0,
+        'framing_errors': result['framing_errors'],
+        'framing_examples': result['examples'],
+        'stray_output': stray,
+        'log_bytes': os.path.getsize(log),
+        'exit_code': code,
+        'stderr': script.errors() if code else '',
+        'workdir': workdir,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', help="Replay fulljson lines from this file (see benchmarks.corpus) instead of generating them.")
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--public', type=float, default=0.5, help="Share of public addresses in the corpus.")
+    parser.add_argument('--batch', type=int, default=1, help="Events in flight at once; 1 is what rsyslog does.")
+    parser.add_argument('--reload', type=float, default=15, help="Minutes between parser tree reloads.")
+    parser.add_argument('--geoip', help="Directory with real GeoIP/ASN databases.")
+    parser.add_argument('--profile', type=float, help="Profile the script for this many seconds of the run; profiles are left in its directory.")
+    parser.add_argument('--python', default=sys.executable, help="Interpreter to run the script with.")
+    parser.add_argument('--output', help="Write results to this JSON file.")
+    args = parser.parse_args()
+    
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    
+    print('%s on %s, batch %s, %s GeoIP; startup %ss, files in %s' % (report['python'], report['commit'], report['batch'], report['geoip'], report['startup_s'], report['workdir']))
+    headers = ('replies', 'EPS', 'p50 us', 'p90 us', 'p99 us', 'max us', 'pauses', 'max pause ms', 'framing errors', 'stray')
+    table([[report['replies'], report['eps'], report['p50_us'], report['p90_us'], report['p99_us'], report['max_us'], report['pauses'], report['pause_max_ms'], report['framing_errors'], report['stray_output']]], headers)
+    
+    for example in report['framing_examples']:
+        print('  %s' % example)
+    if report['replies'] < report['sent']:
+        print('Only %s of %s events got a reply.' % (report['replies'], report['sent']))
+    if report['exit_code']:
+        print('rsysparse.py exited with %s:\n%s' % (report['exit_code'], report['stderr']))
+    
+    sys.exit(1 if report['framing_errors'] or report['replies'] < report['sent'] or report['exit_code'] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Compares the punct signature/line count routine in ParsingEngine against the
+original findall/splitlines computation on messages of increasing length.
+    
+    python -m benchmarks.punct --sizes 100 1000 10000 100000
+"""
+from benchmarks import rsysparse, table
+
+import argparse
+import random
+import re
+import timeit
+
+PUNCT = re.compile('([^a-zA-Z0-9])')
+
+
+def legacy(message):
+    return (
+        re.sub(' ', '_', ''.join(re.findall(PUNCT, message)[:30])),
+        len(message.splitlines()),
+    )
+
+
+def message(size, seed=0):
+    """
+    Builds a log-like message of roughly `size` characters, several lines long.
+    
+    """
+    rand = random.Random(seed)
+    words = ('Failed', 'password', 'for', 'user', 'from', '218.49.183.17', 'port', '48849', 'ssh2', 'GET', '/index.html?a=b', 'HTTP/1.1', '[UFW', 'BLOCK]', 'SRC=1.2.3.4')
+    parts = []
+    length = 0
+    while length < size:
+        word = rand.choice(words)
+        parts.append(word)
+        length += len(word) + 1
+        if rand.random() < 0.02:
+            parts.append('\n')
+    return ' '.join(parts)[:size]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    
+    engine = rsysparse().ParsingEngine()
+    
+    rows = []
+    for size in args.sizes:
+        msg = message(size)
+        assert engine.signature(msg) == legacy(msg)
+        
+        number = max(1, 200000 // size)
+        old = min(timeit.repeat(lambda: legacy(msg), number=number, repeat=args.repeat)) / number
+        new = min(timeit.repeat(lambda: engine.signature(msg), number=number, repeat=args.repeat)) / number
+        rows.append((size, '%.2f' % (old * 1e6), '%.2f' % (new * 1e6), '%.1fx' % (old / new)))
+    
+    table(rows, ('chars', 'legacy (us)', 'signature (us)', 'speedup'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+Compares indexed log search (sparse time index plus per-block bloom
+filters) against scanning every record, on a synthetic corpus of one
+token's logs.
+    
+    python -m benchmarks.search --gigabytes 50 --path /data/paragun-bench
+
+The corpus is written as plain logs, logrotated gzips and block archives in
+equal parts, and reused if --path already holds one of the same size.
+"""
+from benchmarks import Timer, setup, table
+
+import argparse
+import gzip
+import json
+import os
+import random
+
+TOKEN = '3f125cd7-fd46-4e37-a88e-610db52c1562'
+START = 1546300800
+
+
+def generate(path, gigabytes, seed=0):
+    from parsing.archive import ArchiveWriter
+    from parsing.pipeline import WriteStage, rfc3339
+    
+    rand = random.Random(seed)
+    target = int(gigabytes * 2**30)
+    per_file = max(target // 30, 1 << 20)
+    written = 0
+    i = 0
+    n = 0
+    
+    while written < target:
+        kind = ('raw', 'stream', 'archive')[n % 3]
+        name = os.path.join(path, '%s_node%s' % (TOKEN, n))
+        name = {'raw': name + '.log', 'stream': name + '.log-2019-01-01.gz', 'archive': name + '-2019-01-01.log.gz'}[kind]
+        
+        size = 0
+        chunks = []
+        while size < per_file:
+            line = WriteStage.serialize({
+                'timestamp': rfc3339(START + i // 20),
+                'host': 'web%s' % rand.randint(1, 50),
+                'process': 'sshd',
+                'msg': 'Failed password for invalid user user%s from 10.%s.%s.%s port %s ssh2' % (i, rand.randint(0, 255), rand.randint(0, 255), rand.randint(1, 254), rand.randint(1024, 65535)),
+                'token': TOKEN,
+                'data': {'user': 'user%s' % i, 'src_port': str(rand.randint(1024, 65535))},
+            })
+            chunks.append(line)
+            size += len(line)
+            i += 1
+        
+        if kind == 'raw':
+            with open(name, 'w') as f: f.write(''.join(chunks))
+        elif kind == 'stream':
+            with gzip.open(name, 'wt') as f: f.write(''.join(chunks))
+        else:
+            writer = ArchiveWriter(name, linger=3600)
+            writer.write(chunks)
+            writer.close()
+        
+        written += size
+        n += 1
+    
+    return i
+
+
+def scan(path, start, end, where):
+    """
+    The baseline: decode every record of every file.
+    
+    """
+    from parsing.archive import epoch
+    from parsing.search import terms, token_files
+    
+    wanted = set(('%s=%s' % x).lower() for x in where.items())
+    found = 0
+    for filename in token_files(TOKEN, path):
+        opener = gzip.open if filename.endswith('.gz') else open
+        with opener(filename, 'rt') as f:
+            for line in f:
+                record = json.loads(line)
+                ts = epoch(record['timestamp'])
+                if start is not None and ts < start: continue
+                if end is not None and ts > end: continue
+                if wanted and not wanted <= terms(record): continue
+                found += 1
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--gigabytes', type=float, default=0.2)
+    parser.add_argument('--path', default='/tmp/paragun-search-bench')
+    parser.add_argument('--skip-scan', action='store_true', help="Don't time the full-scan baseline.")
+    args = parser.parse_args()
+    
+    setup()
+    from parsing.search import build_index, search, token_files
+    
+    marker = os.path.join(args.path, 'corpus.json')
+    try:
+        with open(marker) as f: corpus = json.load(f)
+    except (IOError, ValueError):
+        corpus = {}
+    
+    if corpus.get('gigabytes') != args.gigabytes:
+        os.makedirs(args.path, exist_ok=True)
+        for name in os.listdir(args.path):
+            os.unlink(os.path.join(args.path, name))
+        with Timer() as timer:
+            corpus = {'gigabytes': args.gigabytes, 'records': generate(args.path, args.gigabytes)}
+        with open(marker, 'w') as f: json.dump(corpus, f)
+        print('Generated %s records in %.1fs' % (corpus['records'], timer.elapsed))
+    
+    records = corpus['records']
+    with Timer() as timer:
+        for filename in token_files(TOKEN, args.path):
+            build_index(filename)
+    print('Indexed %.1f GB in %.1fs' % (args.gigabytes, timer.elapsed))
+    
+    middle = START + records // 40
+    queries = (
+        ('user=<one>', None, None, {'user': 'user%s' % (records // 2)}),
+        ('1 minute', middle, middle + 59, {}),
+        ('1 minute + host', middle, middle + 59, {'host': 'web7'}),
+    )
+    
+    rows = []
+    for name, start, end, where in queries:
+        stats = {}
+        with Timer() as indexed:
+            found = len(search(TOKEN, start, end, where, limit=10**9, path=args.path, stats=stats))
+        row = [name, found, '%s/%s' % (stats['blocks_read'], stats['blocks']), '%.3f' % indexed.elapsed]
+        if not args.skip_scan:
+            with Timer() as full:
+                assert scan(args.path, start, end, where) == found
+            row.append('%.2f' % full.elapsed)
+        rows.append(row)
+    
+    table(rows, ('query', 'matches', 'blocks read', 'indexed s') + (() if args.skip_scan else ('full scan s',)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Measures what a fresh process (a gunicorn worker, a management command)
+pays to start up: wall-clock time of django.setup(), which imports every
+app's models, and the queries run while doing so.
+    
+    python -m benchmarks.startup --runs 20
+
+Each run is a separate interpreter, against the configured database.
+"""
+from benchmarks import ROOT, table
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+CHILD = '''
+import json, os, sys, time
+sys.path.insert(0, %r)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'paragun.settings')
+started = time.perf_counter()
+import django
+from django.db import connection
+queries = []
+connection.execute_wrappers.append(lambda execute, sql, *args: queries.append(sql) or execute(sql, *args))
+django.setup()
+print(json.dumps({'seconds': time.perf_counter() - started, 'queries': len(queries)}))
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+    
+    results = []
+    for i in range(args.runs):
+        output = subprocess.run([sys.executable, '-c', CHILD % ROOT], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=os.environ, check=True).stdout
+        results.append(json.loads(output.decode('utf-8').splitlines()[-1]))
+    
+    seconds = [x['seconds'] for x in results]
+    table([
+        ['first', '%.3f' % seconds[0], results[0]['queries']],
+        ['median of %s' % args.runs, '%.3f' % statistics.median(seconds), results[-1]['queries']],
+    ], ('run', 'seconds', 'queries'))
+
+
+if __name__ == '__main__':
+    main()
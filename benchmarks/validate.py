@@ -0,0 +1,117 @@
+"""
+Times parser validation over a synthetic set of services, samples and
+assertions, comparing the old one-service-at-a-time loop (a query per
+assertion and per save, a fresh regex per Parser instance) with
+Service.validate().
+    
+    python -m benchmarks.validate --samples 10000 --processes 4
+
+Runs against a throwaway test database.
+"""
+from benchmarks import Timer, setup, table
+
+import argparse
+import random
+
+IPV4 = '([0-9]{1,3}\\.[0-9]{1,3}\\.[0-9]{1,3}\\.[0-9]{1,3})'
+
+PARSERS = (
+    ('src_ip', ('from ' + IPV4, 'rhost=' + IPV4)),
+    ('src_port', ('port ([0-9]+)',)),
+    ('user', ('invalid user ([a-zA-Z0-9\\.\\-]+) from', 'for ([a-zA-Z0-9\\.\\-]+) from', 'user=([a-zA-Z0-9\\.\\-]+)')),
+)
+
+
+def populate(services, samples, seed=0):
+    from parsing.models import Assertion, Field, Parser, Sample, Service
+    
+    rand = random.Random(seed)
+    fields = {key: Field.objects.get_or_create(key=key)[0] for key, _ in PARSERS}
+    for i in range(services):
+        service = Service.objects.create(key='svc%s' % i)
+        for key, patterns in PARSERS:
+            for priority, pattern in enumerate(patterns):
+                Parser.objects.create(enabled=True, service=service, field=fields[key], value=pattern, priority=priority)
+        
+        for j in range(samples // services):
+            values = {'user': 'user%s' % rand.randint(1, 500), 'src_ip': '10.0.%s.%s' % (rand.randint(0, 255), rand.randint(1, 254)), 'src_port': str(rand.randint(1024, 65535))}
+            sample = Sample.objects.create(service=service, value='Failed password for invalid user %(user)s from %(src_ip)s port %(src_port)s ssh2' % values)
+            Assertion.objects.bulk_create(Assertion(sample=sample, key=fields[key], value=value) for key, value in values.items())
+
+
+class QueryCounter(object):
+    """
+    Counts queries run while installed with connection.execute_wrapper().
+    
+    """
+    def __init__(self):
+        self.count = 0
+    
+    def __call__(self, execute, *args, **kwargs):
+        self.count += 1
+        return execute(*args, **kwargs)
+
+
+def legacy(service):
+    """
+    Service.test() as it was before Service.validate().
+    
+    """
+    from django.db import transaction
+    
+    with transaction.atomic():
+        for sample in service.samples.enabled():
+            sample.status = True
+            for assertion in sample.assertions.enabled():
+                value = None
+                for parser in service.parsers.enabled().filter(field=assertion.key):
+                    value = parser.parse(sample.value)
+                    if value: break
+                assertion.status = value == assertion.value
+                assertion.save()
+                if not assertion.status: sample.status = False
+            sample.save()
+    return not service.samples.enabled().filter(status=False).exists()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--services', type=int, default=100)
+    parser.add_argument('--samples', type=int, default=10000)
+    parser.add_argument('--processes', type=int, nargs='*', default=[1, 2, 4])
+    parser.add_argument('--skip-legacy', action='store_true')
+    args = parser.parse_args()
+    
+    setup()
+    from django.db import connection
+    from parsing import models
+    from parsing.models import Service
+    
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        with Timer() as timer:
+            populate(args.services, args.samples)
+        print('Created %s samples in %.1fs' % (args.samples, timer.elapsed))
+        
+        rows = []
+        if not args.skip_legacy:
+            queries = QueryCounter()
+            with connection.execute_wrapper(queries), Timer() as timer:
+                expected = {x.pk: legacy(x) for x in Service.objects.enabled()}
+            rows.append(['serial (old)', queries.count, '%.2f' % timer.elapsed])
+        
+        for processes in args.processes:
+            models.compile_regex.cache_clear()
+            queries = QueryCounter()
+            with connection.execute_wrapper(queries), Timer() as timer:
+                results = Service.validate(processes=processes)
+            if not args.skip_legacy: assert results == expected
+            rows.append(['validate, %s process%s' % (processes, 'es' if processes > 1 else ''), queries.count, '%.2f' % timer.elapsed])
+        
+        table(rows, ('method', 'queries', 'seconds'))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,12 @@ class PulseAdmin(admin.ModelAdmin):
     list_display = ('token', 'host', 'app', 'count', 'bytes', 'created')
     list_filter = ('created', 'app')
 
+class RejectAdmin(admin.ModelAdmin):
+    list_display = ('reason', 'key', 'count', 'created')
+    list_filter = ('created', 'reason')
+    search_fields = ('key',)
+
 admin.site.register(Token, TokenAdmin)
 admin.site.register(Pulse, PulseAdmin)
+admin.site.register(Reject, RejectAdmin)
 admin.site.register(User)
\ No newline at end of file
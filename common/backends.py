@@ -0,0 +1,225 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+from time import time
+
+import hashlib
+import logging
+import queue
+import threading
+
+
+class LDAPConnectionPool(object):
+    """
+    Bounded pool of LDAP connections bound as the service account.
+    
+    Connections are opened (and bound) on first use rather than at startup,
+    and reused afterwards. One that has sat idle for longer than `idle`
+    seconds is assumed stale (servers and firewalls drop quiet connections)
+    and replaced; one that fails with a connection error is discarded and the
+    operation retried once on a fresh connection.
+    
+    """
+    def __init__(self, uri, bind_dn, password, *args, **kwargs):
+        """
+        Args:
+            uri (str): LDAP server URI.
+            bind_dn (str): DN of the service account.
+            password (str): Password of the service account.
+        
+        Kwargs:
+            size (int): Most connections open at once; callers wait for one
+                to be free beyond that.
+            timeout (float): Network timeout, and how long to wait for a free
+                connection.
+            idle (float): Seconds after which an idle connection is replaced.
+        
+        """
+        self.uri = uri
+        self.bind_dn = bind_dn
+        self.password = password
+        self.size = kwargs.get('size', settings.LDAP_POOL_SIZE)
+        self.timeout = kwargs.get('timeout', settings.LDAP_TIMEOUT)
+        self.idle = kwargs.get('idle', settings.LDAP_IDLE)
+        
+        # (connection, last used) pairs, most recently used last
+        self.connections = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(self.size)
+        self.counters = {'opened': 0, 'reused': 0, 'discarded': 0}
+    
+    def connect(self):
+        import ldap
+        
+        conn = ldap.initialize(self.uri)
+        conn.set_option(ldap.OPT_NETWORK_TIMEOUT, self.timeout)
+        conn.set_option(ldap.OPT_REFERRALS, 0)
+        conn.simple_bind_s(self.bind_dn, self.password)
+        self.counters['opened'] += 1
+        return conn
+    
+    def close(self, conn):
+        self.counters['discarded'] += 1
+        try: conn.unbind_s()
+        except Exception: pass
+    
+    def acquire(self):
+        """
+        Returns:
+            conn (LDAPObject): An idle connection, or a new one if there is
+                none fresh enough.
+        
+        """
+        if not self.slots.acquire(timeout=self.timeout):
+            raise RuntimeError('No LDAP connection became free within %ss.' % self.timeout)
+        
+        try:
+            while True:
+                try: conn, used = self.connections.get_nowait()
+                except queue.Empty: return self.connect()
+                if time() - used < self.idle:
+                    self.counters['reused'] += 1
+                    return conn
+                self.close(conn)
+        except Exception:
+            self.slots.release()
+            raise
+    
+    def release(self, conn, discard=False):
+        if discard: self.close(conn)
+        else: self.connections.put((conn, time()))
+        self.slots.release()
+    
+    def run(self, operation):
+        """
+        Runs `operation(conn)` on a pooled connection.
+        
+        Returns:
+            result: Whatever the operation returns.
+        
+        """
+        import ldap
+        
+        for attempt in range(2):
+            conn = self.acquire()
+            try:
+                result = operation(conn)
+            except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.TIMEOUT):
+                self.release(conn, discard=True)
+                if attempt: raise
+                continue
+            except Exception:
+                self.release(conn, discard=True)
+                raise
+            self.release(conn)
+            return result
+    
+    def clear(self):
+        while True:
+            try: conn, used = self.connections.get_nowait()
+            except queue.Empty: return
+            self.close(conn)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns:
+        pool (LDAPConnectionPool): This process's pool, created on first use.
+    
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = LDAPConnectionPool(
+                settings.LDAP_SERVER,
+                'uid=%(username)s,%(ldap_base)s' % {'username': settings.LDAP_USERNAME, 'ldap_base': settings.LDAP_BASE},
+                settings.LDAP_PASSWORD,
+            )
+        return _pool
+
+
+class LDAPBackend(ModelBackend):
+    """
+    Authenticates users against the LDAP directory, creating a local user the
+    first time someone logs in.
+    
+    Users are looked up by the service account and then verified by binding
+    as them on the same pooled connection, which is bound back as the
+    service account before being reused. Successful lookups (DN and
+    attributes, never passwords) are kept in Django's cache for
+    LDAP_CACHE_TTL seconds, which expires and culls them.
+    
+    """
+    @staticmethod
+    def cache_key(username):
+        return 'ldap-user:%s' % hashlib.sha1(username.encode('utf-8')).hexdigest()
+    
+    def lookup(self, username):
+        """
+        Returns:
+            entry (tuple): (dn, attributes) of the user, or None if not found.
+        
+        """
+        import ldap
+        import ldap.filter
+        
+        cached = cache.get(self.cache_key(username))
+        if cached is not None:
+            return cached
+        
+        query = settings.LDAP_USER_FILTER % {'username': ldap.filter.escape_filter_chars(username)}
+        results = get_pool().run(lambda conn: conn.search_s(settings.LDAP_BASE, ldap.SCOPE_SUBTREE, query, ['mail', 'givenName', 'sn']))
+        results = [x for x in results if x[0]]
+        if len(results) != 1:
+            return None
+        
+        cache.set(self.cache_key(username), results[0], settings.LDAP_CACHE_TTL)
+        return results[0]
+    
+    def verify(self, dn, password):
+        import ldap
+        
+        pool = get_pool()
+        
+        def bind(conn):
+            try:
+                conn.simple_bind_s(dn, password)
+                return True
+            except ldap.INVALID_CREDENTIALS:
+                return False
+            finally:
+                conn.simple_bind_s(pool.bind_dn, pool.password)
+        
+        return pool.run(bind)
+    
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        logger = logging.getLogger(__name__)
+        
+        if not settings.LDAP_ENABLED or not username or not password:
+            return None
+        
+        try:
+            entry = self.lookup(username)
+            if entry is None or not self.verify(entry[0], password):
+                return None
+        except Exception as e:
+            logger.error('LDAP authentication of %s failed: %s' % (username, e))
+            return None
+        
+        attributes = {k: v[0].decode('utf-8') for k,v in entry[1].items() if v}
+        User = get_user_model()
+        try:
+            user = User.objects.get(username=username)
+        except User.DoesNotExist:
+            if not attributes.get('mail'):
+                logger.warning('LDAP user %s has no email address; not creating an account.' % username)
+                return None
+            user = User(username=username, email=attributes['mail'], first_name=attributes.get('givenName', ''), last_name=attributes.get('sn', ''))
+            user.set_unusable_password()
+            user.save()
+        
+        return user if self.user_can_authenticate(user) else None
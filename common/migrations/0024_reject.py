@@ -0,0 +1,30 @@
+# Generated by Django 2.1.4 on 2026-10-19 11:58
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common', '0023_auto_20190117_2325'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Reject',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, help_text='Date and time of object creation.')),
+                ('updated', models.DateTimeField(auto_now=True, help_text='Date and time of last object modification.')),
+                ('enabled', models.BooleanField(default=True, help_text='Whether or not this object should be enabled.')),
+                ('tags', models.CharField(blank=True, help_text='Comma-separated list of any custom tags related to this object.', max_length=160, null=True)),
+                ('reason', models.CharField(choices=[('token', 'No token'), ('invalid', 'Invalid token')], max_length=8)),
+                ('key', models.CharField(help_text='Source IP for events without a token; the token presented otherwise.', max_length=64)),
+                ('count', models.PositiveIntegerField()),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.1.4 on 2026-10-19 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common', '0024_reject'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NodeMetric',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('node', models.CharField(max_length=64)),
+                ('series', models.CharField(max_length=64)),
+                ('resolution', models.PositiveIntegerField()),
+                ('ts', models.DateTimeField()),
+                ('total', models.BigIntegerField(default=0)),
+                ('peak', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='nodemetric',
+            unique_together={('node', 'series', 'resolution', 'ts')},
+        ),
+        migrations.AlterIndexTogether(
+            name='nodemetric',
+            index_together={('resolution', 'ts')},
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 2.1.4 on 2026-10-19 12:01
+
+from django.db import migrations, models
+
+
+def rollup(apps, schema_editor):
+    Reject = apps.get_model('common', 'Reject')
+    RejectRollup = apps.get_model('common', 'RejectRollup')
+    
+    buckets = {}
+    for reason, key, created, count in Reject.objects.values_list('reason', 'key', 'created', 'count').iterator():
+        bucket = (reason, key, created.replace(minute=0, second=0, microsecond=0))
+        buckets[bucket] = buckets.get(bucket, 0) + count
+        
+    RejectRollup.objects.bulk_create([
+        RejectRollup(reason=reason, key=key, ts=ts, count=count)
+        for (reason, key, ts), count in buckets.items()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common', '0025_nodemetric'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RejectRollup',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('reason', models.CharField(choices=[('token', 'No token'), ('invalid', 'Invalid token')], max_length=8)),
+                ('key', models.CharField(max_length=64)),
+                ('ts', models.DateTimeField()),
+                ('count', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='rejectrollup',
+            unique_together={('reason', 'key', 'ts')},
+        ),
+        migrations.AlterIndexTogether(
+            name='rejectrollup',
+            index_together={('reason', 'ts'), ('key', 'ts')},
+        ),
+        migrations.RunPython(rollup, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.1.4 on 2026-10-19 12:08
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common', '0026_rejectrollup'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='pulse',
+            index_together={('token', 'created')},
+        ),
+    ]
@@ -1,11 +1,13 @@
-from datetime import timedelta
+from datetime import datetime, timedelta
 from django.contrib.auth.models import AbstractUser
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
 from django.db.models import Q
 from django.db.models.functions import Coalesce, TruncDay, TruncHour
 from django.urls import reverse
 from django.utils import timezone
+from time import sleep
 from uuid import uuid4
 
 
@@ -69,6 +71,10 @@ class AbstractBaseModel(models.Model):
         
 class Pulse(AbstractBaseModel):
     
+    class Meta:
+        # Statistics and retention purges both select by token and age
+        index_together = (('token', 'created'),)
+    
     token = models.ForeignKey('Token', on_delete=models.CASCADE, related_name='metrics')
     host = models.GenericIPAddressField(blank=True, null=True)
     app = models.CharField(max_length=8)
@@ -76,6 +82,251 @@ class Pulse(AbstractBaseModel):
     bytes = models.PositiveIntegerField()
 
 
+class Reject(AbstractBaseModel):
+    """
+    Events a node dropped before parsing, as counted by rsyslog.
+    
+    Events presenting no token are counted per source IP; events presenting
+    a token that isn't valid are counted per token (which may not exist).
+    
+    """
+    REASONS = (
+        ('token', 'No token'),
+        ('invalid', 'Invalid token'),
+    )
+    
+    reason = models.CharField(max_length=8, choices=REASONS)
+    key = models.CharField(max_length=64, help_text="Source IP for events without a token; the token presented otherwise.")
+    count = models.PositiveIntegerField()
+
+
+class RejectRollup(models.Model):
+    """
+    Reject counts summed per reason, key and hour, kept up to date as
+    Rejects are ingested so reporting never has to scan the raw samples.
+    
+    """
+    class Meta:
+        unique_together = (('reason', 'key', 'ts'),)
+        index_together = (('reason', 'ts'), ('key', 'ts'))
+    
+    id = models.BigAutoField(primary_key=True)
+    reason = models.CharField(max_length=8, choices=Reject.REASONS)
+    key = models.CharField(max_length=64)
+    ts = models.DateTimeField()
+    count = models.BigIntegerField(default=0)
+    
+    @classmethod
+    def record(cls, rejects):
+        """
+        Adds Rejects to the rollup for the hour they were created in.
+        
+        Args:
+            rejects (iterable): Reject objects.
+        
+        Returns:
+            count (int): Number of rollup rows touched.
+        
+        """
+        buckets = {}
+        for reject in rejects:
+            ts = reject.created.replace(minute=0, second=0, microsecond=0)
+            key = (reject.reason, reject.key, ts)
+            buckets[key] = buckets.get(key, 0) + reject.count
+        
+        if not buckets:
+            return 0
+        
+        with transaction.atomic():
+            existing = set(cls.objects.filter(
+                reason__in={x[0] for x in buckets},
+                key__in={x[1] for x in buckets},
+                ts__in={x[2] for x in buckets},
+            ).values_list('reason', 'key', 'ts'))
+            
+            # Nodes report the first rejects of an hour at the same time, and
+            # row locks can't cover rows that don't exist yet; get_or_create
+            # inserts in a savepoint and falls back to the row another node
+            # just created. Buckets go in a fixed order so nodes lock rows in
+            # the same order
+            for (reason, key, ts), value in sorted(buckets.items()):
+                if (reason, key, ts) not in existing:
+                    cls.objects.get_or_create(reason=reason, key=key, ts=ts)
+                cls.objects.filter(reason=reason, key=key, ts=ts).update(count=models.F('count') + value)
+        
+        return len(buckets)
+    
+    @classmethod
+    def for_tokens(cls, tokens, days=7):
+        """
+        Rejected events that presented any of the given tokens.
+        
+        Args:
+            tokens (iterable): Tokens, or token strings.
+        
+        Kwargs:
+            days (int): How far back to look.
+        
+        Returns:
+            rejects (QuerySet): {key, num_events, last_seen} per token, most
+                rejected first.
+        
+        """
+        since = timezone.now() - timedelta(days=days)
+        keys = [str(x).lower() for x in tokens]
+        return cls.objects.filter(reason='invalid', key__in=keys, ts__gte=since).values('key').annotate(
+            num_events=models.Sum('count'), last_seen=models.Max('ts')
+        ).order_by('-num_events')
+    
+    @classmethod
+    def top(cls, reason='token', n=20, days=1):
+        """
+        Keys with the most rejected events, e.g. the IPs sending the most
+        events without a token.
+        
+        Returns:
+            rejects (QuerySet): {key, num_events, last_seen} for the top n.
+        
+        """
+        since = timezone.now() - timedelta(days=days)
+        return cls.objects.filter(reason=reason, ts__gte=since).values('key').annotate(
+            num_events=models.Sum('count'), last_seen=models.Max('ts')
+        ).order_by('-num_events')[:n]
+
+
+class NodeMetric(models.Model):
+    """
+    Health series reported by each rsyslog node (queue depth, events enqueued
+    and discarded, actions processed and failed), as summarized by
+    rsysstats.py.
+    
+    Every series is kept at two resolutions: one row per minute and one per
+    hour, both updated as samples arrive. `total` is the sum of the values
+    reported in the bucket and `peak` the largest single value, so counters
+    are read from `total` and gauges (queue sizes) from `peak`. Minute rows
+    are dropped after NODE_METRIC_RETENTION hours.
+    
+    This does not extend AbstractBaseModel; there can be a great many of
+    these and none of its bookkeeping fields apply.
+    
+    """
+    MINUTE = 60
+    HOUR = 3600
+    
+    class Meta:
+        unique_together = (('node', 'series', 'resolution', 'ts'),)
+        index_together = (('resolution', 'ts'),)
+    
+    id = models.BigAutoField(primary_key=True)
+    node = models.CharField(max_length=64)
+    series = models.CharField(max_length=64)
+    resolution = models.PositiveIntegerField()
+    ts = models.DateTimeField()
+    total = models.BigIntegerField(default=0)
+    peak = models.BigIntegerField(default=0)
+    
+    @classmethod
+    def record(cls, node, samples):
+        """
+        Merges samples from a node into its minute and hour rows.
+        
+        Args:
+            node (str): Name of the reporting node.
+            samples (iterable): (ts, series, total, peak) tuples, with ts as
+                a timezone-aware datetime.
+        
+        Returns:
+            count (int): Number of rows created or updated.
+        
+        """
+        buckets = {}
+        for ts, series, total, peak in samples:
+            epoch = int(ts.timestamp())
+            for resolution in (cls.MINUTE, cls.HOUR):
+                key = (series, resolution, epoch - epoch % resolution)
+                entry = buckets.setdefault(key, [0, 0])
+                entry[0] += total
+                entry[1] = max(entry[1], peak)
+        
+        if not buckets:
+            return 0
+        
+        stamps = {x[2] for x in buckets}
+        with transaction.atomic():
+            existing = cls.objects.select_for_update().filter(
+                node=node,
+                series__in={x[0] for x in buckets},
+                ts__in=[datetime.fromtimestamp(x, timezone.utc) for x in stamps],
+            )
+            
+            updated = 0
+            for row in existing:
+                entry = buckets.pop((row.series, row.resolution, int(row.ts.timestamp())), None)
+                if entry is None: continue
+                row.total += entry[0]
+                row.peak = max(row.peak, entry[1])
+                row.save(update_fields=['total', 'peak'])
+                updated += 1
+            
+            cls.objects.bulk_create([
+                cls(node=node, series=series, resolution=resolution, ts=datetime.fromtimestamp(epoch, timezone.utc), total=total, peak=peak)
+                for (series, resolution, epoch), (total, peak) in buckets.items()
+            ])
+        
+        cls.prune()
+        return updated + len(buckets)
+    
+    @classmethod
+    def prune(cls):
+        limit = timezone.now() - timedelta(hours=settings.NODE_METRIC_RETENTION)
+        return cls.objects.filter(resolution=cls.MINUTE, ts__lt=limit).delete()[0]
+    
+    @classmethod
+    def summary(cls, queue=None, hours=24):
+        """
+        Latest health of every node that reported in the last `hours`.
+        
+        Kwargs:
+            queue (str): Queue to report depth and EPS for. Defaults to
+                NODE_QUEUE.
+            hours (int): How far back to look.
+        
+        Returns:
+            nodes (list): One dict per node, sorted by name, with the last
+                minute's queue depth, EPS and discards, and an hourly EPS
+                trendline.
+        
+        """
+        queue = queue or settings.NODE_QUEUE
+        since = timezone.now() - timedelta(hours=hours)
+        wanted = ('%s.size' % queue, '%s.enqueued' % queue, '%s.discarded' % queue)
+        
+        rows = cls.objects.filter(series__in=wanted, ts__gte=since).order_by('node', 'resolution', 'ts').values_list('node', 'series', 'resolution', 'ts', 'total', 'peak')
+        
+        nodes = {}
+        for node, series, resolution, ts, total, peak in rows:
+            entry = nodes.setdefault(node, {'node': node, 'seen': None, 'depth': 0, 'eps': 0, 'discarded': 0, 'trend': {}, 'latest': None})
+            metric = series[len(queue) + 1:]
+            
+            if resolution == cls.HOUR:
+                if metric == 'enqueued': entry['trend'][ts] = round(total / cls.HOUR, 1)
+                continue
+            
+            # Rows come oldest first; keep the most recent minute only
+            if entry['latest'] != ts:
+                entry.update({'latest': ts, 'seen': ts, 'depth': 0, 'eps': 0, 'discarded': 0})
+            if metric == 'size': entry['depth'] = peak
+            elif metric == 'enqueued': entry['eps'] = round(total / cls.MINUTE, 1)
+            elif metric == 'discarded': entry['discarded'] = total
+        
+        for entry in nodes.values():
+            entry['trendline'] = ','.join(str(x) for ts, x in sorted(entry.pop('trend').items()))
+            entry['saturation'] = round(100.0 * entry['depth'] / settings.NODE_QUEUE_HIGHWATERMARK, 1)
+            del entry['latest']
+        
+        return [nodes[x] for x in sorted(nodes)]
+
+
 class Statistics(object):
     
     limit_int = 30
@@ -132,6 +383,39 @@ class Token(AbstractBaseModel):
     def value(self):
         return self.id
     
+    def purge(self, batch_size=None, pause=0):
+        """
+        Deletes metrics older than this token's retention period.
+        
+        Rows are deleted in batches by primary key, each in its own short
+        transaction, so a large backlog never holds a lock on the table for
+        long.
+        
+        Kwargs:
+            batch_size (int): Rows to delete per batch. Defaults to
+                PURGE_BATCH_SIZE.
+            pause (float): Seconds to sleep between batches.
+        
+        Returns:
+            deleted (int): Number of rows deleted.
+        
+        """
+        batch_size = batch_size or settings.PURGE_BATCH_SIZE
+        limit = self.purge_date
+        deleted = 0
+        
+        while True:
+            ids = list(Pulse.objects.filter(token=self, created__lt=limit).values_list('id', flat=True)[:batch_size])
+            if not ids: break
+            
+            with transaction.atomic():
+                deleted += Pulse.objects.filter(id__in=ids).delete()[0]
+            
+            if len(ids) < batch_size: break
+            if pause: sleep(pause)
+        
+        return deleted
+    
     def __str__(self):
         return self.id
     
@@ -0,0 +1,201 @@
+"""
+Monthly range partitioning of the Pulse table by `created`.
+
+Only PostgreSQL 11 and later support what this needs (primary keys,
+indexes and foreign keys on partitioned tables, and a default partition);
+on anything else, e.g. SQLite during development, Pulse stays a single
+table and every function here is a no-op.
+
+Once converted, `common_pulse` is a partitioned table with one partition per
+calendar month (UTC), named `common_pulse_YYYYMM`, plus a default partition
+that catches rows outside every month created so far. Queries filtering on
+`created` (as Statistics does) only touch the partitions they cover, and
+whole months past retention are dropped instead of deleted row by row.
+
+"""
+from datetime import datetime
+from django.db import connection, transaction
+from django.utils import timezone
+
+from common.models import Pulse
+
+import logging
+import re
+
+TABLE = Pulse._meta.db_table
+DEFAULT = '%s_default' % TABLE
+NAME = re.compile(r'^%s_(\d{4})(\d{2})$' % TABLE)
+
+
+def supported():
+    return connection.vendor == 'postgresql' and connection.pg_version >= 110000
+
+
+def partitioned():
+    """
+    Returns:
+        partitioned (bool): Whether Pulse has been converted to a partitioned table.
+    
+    """
+    if not supported(): return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = %s", [TABLE])
+        return cursor.fetchone() is not None
+
+
+def month(value):
+    """
+    Returns:
+        month (datetime): Start of the UTC month containing a datetime.
+    
+    """
+    value = value.astimezone(timezone.utc)
+    return datetime(value.year, value.month, 1, tzinfo=timezone.utc)
+
+
+def add_months(value, months):
+    index = value.year * 12 + value.month - 1 + months
+    return value.replace(year=index // 12, month=index % 12 + 1)
+
+
+def name(start):
+    return '%s_%s' % (TABLE, start.strftime('%Y%m'))
+
+
+def partitions():
+    """
+    Returns:
+        partitions (list): (name, start, end) of each monthly partition, oldest
+            first. The default partition is not included.
+    
+    """
+    if not partitioned(): return []
+    
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = %s", [TABLE])
+        names = [x[0] for x in cursor.fetchall()]
+    
+    found = []
+    for partition in names:
+        match = NAME.match(partition)
+        if not match: continue
+        start = datetime(int(match.group(1)), int(match.group(2)), 1, tzinfo=timezone.utc)
+        found.append((partition, start, add_months(start, 1)))
+    return sorted(found, key=lambda x: x[1])
+
+
+def create(start, cursor):
+    """
+    Creates the partition for the month starting at `start`.
+    
+    Rows for that month already sitting in the default partition are moved
+    into the new partition before it is attached, since PostgreSQL refuses to
+    attach a range the default partition has rows for.
+    
+    """
+    partition, end = name(start), add_months(start, 1)
+    cursor.execute('CREATE TABLE "%s" (LIKE "%s" INCLUDING DEFAULTS)' % (partition, TABLE))
+    cursor.execute('INSERT INTO "%s" SELECT * FROM "%s" WHERE created >= %%s AND created < %%s' % (partition, DEFAULT), [start, end])
+    cursor.execute('DELETE FROM "%s" WHERE created >= %%s AND created < %%s' % DEFAULT, [start, end])
+    cursor.execute('ALTER TABLE "%s" ATTACH PARTITION "%s" FOR VALUES FROM (%%s) TO (%%s)' % (TABLE, partition), [start, end])
+
+
+def ensure(ahead=3, now=None):
+    """
+    Creates any missing partitions from the current month to `ahead` months
+    from now, so new rows never land in the default partition.
+    
+    Returns:
+        created (list): Names of the partitions created.
+    
+    """
+    logger = logging.getLogger(__name__)
+    if not partitioned(): return []
+    
+    existing = set(x[0] for x in partitions())
+    current = month(now or timezone.now())
+    created = []
+    for i in range(ahead + 1):
+        start = add_months(current, i)
+        if name(start) in existing: continue
+        with transaction.atomic(), connection.cursor() as cursor:
+            create(start, cursor)
+        logger.info('Created partition %s.' % name(start))
+        created.append(name(start))
+    return created
+
+
+def convert(ahead=3):
+    """
+    Converts the Pulse table into a partitioned one, copying its rows into
+    monthly partitions. The table is locked while this runs, so it is meant
+    to be run once, by hand, in a quiet period.
+    
+    Indexes keep their names, so later migrations can still alter them. The
+    primary key has to include the partition key and becomes (id, created);
+    ids still come from the same sequence and stay unique.
+    
+    Returns:
+        partitions (int): Number of monthly partitions created.
+    
+    """
+    if not supported() or partitioned(): return 0
+    
+    with transaction.atomic(), connection.cursor() as cursor:
+        old = '%s_unpartitioned' % TABLE
+        cursor.execute('LOCK TABLE "%s" IN ACCESS EXCLUSIVE MODE' % TABLE)
+        cursor.execute("SELECT indexname, indexdef FROM pg_indexes WHERE tablename = %s AND indexname != %s", [TABLE, '%s_pkey' % TABLE])
+        indexes = cursor.fetchall()
+        cursor.execute('SELECT min(created) FROM "%s"' % TABLE)
+        oldest = cursor.fetchone()[0] or timezone.now()
+        
+        cursor.execute('ALTER TABLE "%s" RENAME TO "%s"' % (TABLE, old))
+        for index, _ in indexes:
+            cursor.execute('ALTER INDEX "%s" RENAME TO "%s"' % (index, index[:50] + '_old'))
+        
+        cursor.execute('CREATE TABLE "%s" (LIKE "%s" INCLUDING DEFAULTS) PARTITION BY RANGE (created)' % (TABLE, old))
+        cursor.execute('ALTER TABLE "%s" ADD PRIMARY KEY (id, created)' % TABLE)
+        cursor.execute('ALTER TABLE "%s" ADD FOREIGN KEY (token_id) REFERENCES common_token (id) DEFERRABLE INITIALLY DEFERRED' % TABLE)
+        # The old table owns the id sequence; hand it over before dropping it
+        cursor.execute('ALTER SEQUENCE "%s_id_seq" OWNED BY "%s".id' % (TABLE, TABLE))
+        for index, definition in indexes:
+            # Index definitions are of the form "CREATE INDEX name ON [schema.]table USING ..."
+            cursor.execute(re.sub(r' ON \S+ USING ', ' ON "%s" USING ' % TABLE, definition, count=1))
+        
+        cursor.execute('CREATE TABLE "%s" PARTITION OF "%s" DEFAULT' % (DEFAULT, TABLE))
+        start, last = month(oldest), add_months(month(timezone.now()), ahead)
+        count = 0
+        while start <= last:
+            cursor.execute('CREATE TABLE "%s" PARTITION OF "%s" FOR VALUES FROM (%%s) TO (%%s)' % (name(start), TABLE), [start, add_months(start, 1)])
+            start = add_months(start, 1)
+            count += 1
+        
+        cursor.execute('INSERT INTO "%s" SELECT * FROM "%s"' % (TABLE, old))
+        cursor.execute('DROP TABLE "%s"' % old)
+    
+    return count
+
+
+def drop(before):
+    """
+    Drops monthly partitions that end on or before a date.
+    
+    Returns:
+        dropped (tuple): (partitions, estimated rows, bytes) reclaimed.
+    
+    """
+    logger = logging.getLogger(__name__)
+    
+    dropped = rows = reclaimed = 0
+    for partition, start, end in partitions():
+        if end > before: break
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute("SELECT reltuples::bigint, pg_total_relation_size(oid) FROM pg_class WHERE relname = %s", [partition])
+            estimate, size = cursor.fetchone()
+            cursor.execute('DROP TABLE "%s"' % partition)
+        logger.info('Dropped partition %s (~%s rows, %s bytes).' % (partition, estimate, size))
+        dropped += 1
+        rows += max(estimate, 0)
+        reclaimed += size
+    
+    return dropped, rows, reclaimed
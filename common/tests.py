@@ -24,4 +24,244 @@ class PulseUpdateViewTest(TestCase):
         
         response = self.client.post(reverse('pulse-update'), data, content_type="application/octet-stream")
         self.assertTrue(response.status_code == 200, 'Posting update should have yielded a 200 (returned %s).' % response.status_code)
-        self.assertEqual(Pulse.objects.all().count(), 2)
\ No newline at end of file
+        self.assertEqual(Pulse.objects.all().count(), 2)
+
+
+class RejectUpdateViewTest(TestCase):
+    
+    def test_post(self):
+        "Receive and ingest reject counts from a node."
+        data = """
+token\t\t10.0.0.9\t\t7
+invalid\t\tDEADBEEF\t\t4
+bogus\t\t10.0.0.9\t\t1
+"""
+        response = self.client.post(reverse('reject-update'), data, content_type="application/octet-stream")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(Reject.objects.values_list('reason', 'key', 'count')), [('invalid', 'deadbeef', 4), ('token', '10.0.0.9', 7)])
+        
+        response = self.client.post(reverse('reject-update'), 'token\t\t10.0.0.9', content_type="application/octet-stream")
+        self.assertEqual(response.status_code, 400)
+    
+    def test_rollup(self):
+        "Rejects should be summed per hour and shown to the token's owner."
+        user = get_user_model().objects.create_user('owner', 'owner@example.com', 'ownerpassword', is_staff=True)
+        token = Token.objects.create(id='3f125cd7-fd46-4e37-a88e-610db52c1562', user=user, enabled=False)
+        
+        for i in range(3):
+            self.client.post(reverse('reject-update'), "invalid\t\t%s\t\t5\ntoken\t\t10.0.0.9\t\t2\n" % token.id, content_type="application/octet-stream")
+        
+        self.assertEqual(Reject.objects.count(), 6)
+        self.assertEqual(RejectRollup.objects.count(), 2)
+        self.assertEqual(RejectRollup.objects.get(reason='invalid').count, 15)
+        self.assertEqual(list(RejectRollup.top('token').values_list('key', 'num_events')), [('10.0.0.9', 6)])
+        
+        # Another node creating the same bucket between our check and insert
+        from django.db.models.query import QuerySet
+        from unittest import mock
+        hour = timezone.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=1)
+        get = QuerySet.get
+        def racing(queryset, *args, **kwargs):
+            if not RejectRollup.objects.filter(key='10.0.0.10').exists():
+                RejectRollup.objects.create(reason='token', key='10.0.0.10', ts=hour, count=4)
+                raise RejectRollup.DoesNotExist()
+            return get(queryset, *args, **kwargs)
+        with mock.patch.object(QuerySet, 'get', racing):
+            self.assertEqual(RejectRollup.record([Reject(reason='token', key='10.0.0.10', count=3, created=hour)]), 1)
+        self.assertEqual(RejectRollup.objects.get(key='10.0.0.10').count, 7)
+        
+        self.client.force_login(user)
+        response = self.client.get(reverse('rejects'))
+        self.assertEqual(response.context['rejects'][0]['num_events'], 15)
+        self.assertContains(response, '10.0.0.9')
+
+
+class NodeMetricTest(TestCase):
+    
+    def setUp(self):
+        self.staff = get_user_model().objects.create_user('staff', 'staff@example.com', 'staffpassword', is_staff=True)
+    
+    def test_rollup(self):
+        "Samples should be merged into minute and hour rows."
+        minute = int(time()) // 3600 * 3600
+        payload = {'node': 'node1', 'samples': [
+            [minute, 'pipeline-in.size', 300, 200],
+            [minute, 'pipeline-in.enqueued', 6000, 1000],
+            [minute + 60, 'pipeline-in.size', 90, 50],
+            [minute + 60, 'pipeline-in.enqueued', 1200, 300],
+        ]}
+        response = self.client.post(reverse('node-health-update'), json.dumps(payload), content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        
+        # Reporting the same minute again adds to it
+        payload['samples'] = payload['samples'][3:]
+        self.client.post(reverse('node-health-update'), json.dumps(payload), content_type="application/json")
+        
+        self.assertEqual(NodeMetric.objects.filter(resolution=NodeMetric.MINUTE).count(), 4)
+        hourly = NodeMetric.objects.get(resolution=NodeMetric.HOUR, series='pipeline-in.enqueued')
+        self.assertEqual((hourly.total, hourly.peak), (8400, 1000))
+        
+        summary = NodeMetric.summary(queue='pipeline-in')
+        self.assertEqual([(x['node'], x['depth'], x['eps']) for x in summary], [('node1', 50, 40.0)])
+        
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse('node-health'))
+        self.assertContains(response, 'node1')
+        
+        # Rows updated plus rows created, not distinct timestamps
+        ts = datetime.fromtimestamp(minute + 60, timezone.utc)
+        self.assertEqual(NodeMetric.record('node1', [(ts, 'pipeline-in.size', 1, 1), (ts, 'pipeline-in.discarded', 1, 1)]), 4)
+    
+    def test_staff_only(self):
+        user = get_user_model().objects.create_user('user', 'user@example.com', 'userpassword')
+        self.client.force_login(user)
+        self.assertEqual(self.client.get(reverse('node-health')).status_code, 403)
+
+
+class PurgeTest(TestCase):
+    
+    def setUp(self):
+        import tempfile
+        self.path = tempfile.mkdtemp()
+        self.user1 = get_user_model().objects.create_user('Chevy Chase', 'chevy@chase.com', 'chevyspassword')
+        self.token = Token.objects.create(id='3f125cd7-fd46-4e37-a88e-610db52c1562', user=self.user1, retain=30)
+    
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.path)
+    
+    def test_purge(self):
+        "Metrics and archived logs past retention should be deleted; everything else kept."
+        from django.core.management import call_command
+        from io import StringIO
+        import os
+        
+        old = timezone.now() - timedelta(days=31)
+        for i in range(5):
+            Pulse.objects.create(token=self.token, app='sshd', count=1, bytes=100, created=old)
+        Pulse.objects.create(token=self.token, app='sshd', count=1, bytes=100)
+        
+        names = ('_node1.log', '_node1-2019-01-01.log.gz', '_node1-2019-01-01.log.gz.idx', '_node1.log-2019-01-01-1546300800.gz', '_node1-2099-01-01.log.gz')
+        for name in names:
+            with open(os.path.join(self.path, self.token.id + name), 'w') as f: f.write('x' * 10)
+            if '2099' not in name:
+                os.utime(os.path.join(self.path, self.token.id + name), (old.timestamp(), old.timestamp()))
+        
+        output = StringIO()
+        call_command('purge', path=self.path, batch_size=2, stdout=output)
+        
+        self.assertEqual(Pulse.objects.count(), 1)
+        self.assertEqual(sorted(os.listdir(self.path)), sorted(self.token.id + x for x in ('_node1.log', '_node1-2099-01-01.log.gz')))
+        self.assertIn('Purged 5 rows and 3 files (30 bytes)', output.getvalue())
+    
+    def test_partitions(self):
+        "Partition helpers; the command is a no-op outside PostgreSQL."
+        from common import partitions
+        from django.core.management import call_command
+        from io import StringIO
+        
+        start = partitions.month(datetime(2019, 12, 31, 23, 0, tzinfo=timezone.utc))
+        self.assertEqual(partitions.name(start), 'common_pulse_201912')
+        self.assertEqual(partitions.add_months(start, 1), datetime(2020, 1, 1, tzinfo=timezone.utc))
+        self.assertEqual(partitions.add_months(start, -12), datetime(2018, 12, 1, tzinfo=timezone.utc))
+        
+        output = StringIO()
+        call_command('partition', stdout=output)
+        self.assertIn('PostgreSQL 11', output.getvalue())
+        self.assertEqual(partitions.ensure(), [])
+
+
+class FakeDirectory(object):
+    """
+    Stand-in LDAP server and `ldap` module: one service account and one user.
+    
+    """
+    class LDAPError(Exception): pass
+    class SERVER_DOWN(LDAPError): pass
+    class CONNECT_ERROR(LDAPError): pass
+    class TIMEOUT(LDAPError): pass
+    class INVALID_CREDENTIALS(LDAPError): pass
+    
+    SCOPE_SUBTREE = 2
+    OPT_NETWORK_TIMEOUT = 1
+    OPT_REFERRALS = 2
+    
+    def __init__(self):
+        import types
+        self.passwords = {'uid=ldap,ou=Users,dc=example,dc=com': 'ldap_password123', 'uid=chevy,ou=Users,dc=example,dc=com': 'chevyspassword'}
+        self.connections = []
+        self.searches = 0
+        self.filter = types.SimpleNamespace(escape_filter_chars=lambda x: x.replace('*', '\\2a'))
+    
+    def initialize(self, uri):
+        directory = self
+        
+        class Connection(object):
+            alive = True
+            
+            def check(self):
+                if not self.alive: raise directory.SERVER_DOWN()
+            
+            def set_option(self, option, value): pass
+            
+            def simple_bind_s(self, dn, password):
+                self.check()
+                if directory.passwords.get(dn) != password: raise directory.INVALID_CREDENTIALS()
+                self.bound = dn
+            
+            def search_s(self, base, scope, query, attributes):
+                self.check()
+                directory.searches += 1
+                if query != '(uid=chevy)': return []
+                return [('uid=chevy,ou=Users,dc=example,dc=com', {'mail': [b'chevy@chase.com'], 'givenName': [b'Chevy'], 'sn': [b'Chase']})]
+            
+            def unbind_s(self): pass
+        
+        conn = Connection()
+        self.connections.append(conn)
+        return conn
+
+
+class LDAPBackendTest(TestCase):
+    
+    def test_authenticate(self):
+        "Logins should share one lazily opened, service-bound connection and survive it going stale."
+        from common import backends
+        from django.core.cache import cache
+        from django.test import override_settings
+        from time import sleep
+        from unittest import mock
+        import sys
+        
+        directory = FakeDirectory()
+        backend = backends.LDAPBackend()
+        cache.clear()
+        
+        with mock.patch.dict(sys.modules, {'ldap': directory, 'ldap.filter': directory.filter}), mock.patch.object(backends, '_pool', None), override_settings(LDAP_ENABLED=True):
+            self.assertEqual(directory.connections, [])
+            
+            user = backend.authenticate(None, username='chevy', password='chevyspassword')
+            self.assertEqual((user.email, user.first_name, user.has_usable_password()), ('chevy@chase.com', 'Chevy', False))
+            self.assertIsNone(backend.authenticate(None, username='chevy', password='wrong'))
+            self.assertIsNone(backend.authenticate(None, username='nobody', password='x'))
+            self.assertEqual(backend.authenticate(None, username='chevy', password='chevyspassword'), user)
+            
+            # One connection, bound back to the service account after each login;
+            # chevy was only looked up once
+            self.assertEqual(len(directory.connections), 1)
+            self.assertEqual(directory.connections[0].bound, 'uid=ldap,ou=Users,dc=example,dc=com')
+            self.assertEqual(directory.searches, 2)
+            
+            # A dropped connection is replaced transparently
+            directory.connections[0].alive = False
+            self.assertEqual(backend.authenticate(None, username='chevy', password='chevyspassword'), user)
+            self.assertEqual(len(directory.connections), 2)
+            self.assertEqual(backends.get_pool().counters['discarded'], 1)
+            
+            # Lookups expire instead of piling up for every username tried
+            with override_settings(LDAP_CACHE_TTL=0.01):
+                cache.clear()
+                backend.authenticate(None, username='chevy', password='wrong')
+                self.assertIsNotNone(cache.get(backend.cache_key('chevy')))
+                sleep(0.02)
+                self.assertIsNone(cache.get(backend.cache_key('chevy')))
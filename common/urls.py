@@ -21,14 +21,19 @@ from django.urls import path, include
 urlpatterns = [
     # HTML views
     path('dashboard/', DashboardView.as_view(), name="dashboard"),
+    path('nodes/', NodeHealthView.as_view(), name="node-health"),
+    path('rejects/', RejectView.as_view(), name="rejects"),
     
     path('tokens/create/', TokenCreateView.as_view(), name="token-create"),
     path('tokens/update/<str:pk>/', TokenUpdateView.as_view(), name="token-update"),
     path('tokens/detail/<str:pk>/', TokenDetailView.as_view(), name="token-detail"),
     path('tokens/delete/<str:pk>/', TokenDeleteView.as_view(), name="token-delete"),
+    path('tokens/search/<str:pk>/', TokenSearchView.as_view(), name="token-search"),
     
     # API views
     path('api/metrics/update/', PulseUpdateView.as_view(), name="pulse-update"),
+    path('api/metrics/rejects/', RejectUpdateView.as_view(), name="reject-update"),
+    path('api/nodes/health/', NodeHealthUpdateView.as_view(), name="node-health-update"),
     path('api/tokens/valid/', TokenDumpView.as_view(), name="token-dump"),
     path('api/tokens/retention/', TokenRetentionView.as_view(), name="token-retention"),
     path('api/parsers/', ParserDumpView.as_view(), name="parser-dump"),
@@ -2,16 +2,19 @@ from common.forms import *
 from common.models import *
 from django.conf import settings
 from django.contrib import messages
-from django.contrib.auth.mixins import LoginRequiredMixin
+from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.db import transaction
 from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseRedirect, JsonResponse
 from django.shortcuts import render
 from django.urls import reverse, reverse_lazy
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import TemplateView, ListView, DetailView, FormView, View
 from django.views.generic.edit import CreateView, UpdateView, DeleteView
 
+from datetime import datetime
 from time import time
 import json
 import logging
@@ -91,6 +94,55 @@ class DashboardView(LoginRequiredMixin, ListView):
             
         """
         return self.request.user.tokens.filter(enabled=True).order_by('-created')
+
+
+class NodeHealthView(LoginRequiredMixin, UserPassesTestMixin, TemplateView):
+    """
+    Displays queue depth and throughput for each rsyslog node, so a parser
+    bottleneck shows up before the queue starts spilling to disk.
+    
+    """
+    page_title = "Nodes"
+    template_name = 'common/node_health.html'
+    
+    def test_func(self):
+        return self.request.user.is_staff
+    
+    def get_context_data(self, *args, **kwargs):
+        context = super().get_context_data(*args, **kwargs)
+        context['nodes'] = NodeMetric.summary()
+        context['queue'] = settings.NODE_QUEUE
+        context['highwatermark'] = settings.NODE_QUEUE_HIGHWATERMARK
+        return context
+
+
+class RejectView(LoginRequiredMixin, TemplateView):
+    """
+    Displays events rejected for presenting any of the current user's
+    tokens after they stopped being valid and, for staff, the sources
+    sending the most events without a token.
+    
+    """
+    page_title = "Rejects"
+    template_name = 'common/rejects.html'
+    days = 7
+    top = 20
+    
+    def get_context_data(self, *args, **kwargs):
+        context = super().get_context_data(*args, **kwargs)
+        
+        # Include expired and disabled tokens; those are the ones that get rejected
+        tokens = {str(x.id).lower(): x for x in self.request.user.tokens.all()}
+        rejects = list(RejectRollup.for_tokens(tokens, days=self.days))
+        for row in rejects:
+            row['token'] = tokens.get(row['key'])
+        
+        context['days'] = self.days
+        context['rejects'] = rejects
+        if self.request.user.is_staff:
+            context['top_sources'] = RejectRollup.top('token', n=self.top, days=self.days)
+            context['top_tokens'] = RejectRollup.top('invalid', n=self.top, days=self.days)
+        return context
         
 
 class TokenCreateView(LoginRequiredMixin, CreateView):
@@ -248,6 +300,68 @@ class TokenDetailView(LoginRequiredMixin, DetailView):
         return self.request.user.tokens.filter(enabled=True)
         
 
+class TokenSearchView(LoginRequiredMixin, DetailView):
+    """
+    Searches the logs sent under a token by time range and field=value
+    conditions.
+    
+    Logs are read from OUTPUT_DIR, the log store nodes ship their rotated
+    logs to (see ansible/templates/logrotate/paragun-logs), so events show
+    up once their node has rotated and shipped them and cron has indexed
+    them.
+    
+    """
+    model = Token
+    page_title = "Search"
+    template_name = 'common/token_search.html'
+    limit = 100
+    
+    def get_queryset(self, **kwargs):
+        """
+        Restricts tokens available for access to only those owned by user.
+        
+        Returns:
+            tokens (QuerySet): Tokens owned by current user.
+        
+        """
+        return self.request.user.tokens.all()
+    
+    @staticmethod
+    def timestamp(value):
+        """
+        Parses a timestamp from the search form, taking it as UTC if no
+        offset is given.
+        
+        """
+        if not value: return None
+        ts = parse_datetime(value)
+        if ts is None: return None
+        if timezone.is_naive(ts):
+            ts = timezone.make_aware(ts, timezone.utc)
+        return ts.timestamp()
+    
+    def get_context_data(self, *args, **kwargs):
+        from parsing.search import search
+        
+        context = super().get_context_data(*args, **kwargs)
+        query = self.request.GET.get('q', '').strip()
+        start = self.request.GET.get('start', '')
+        end = self.request.GET.get('end', '')
+        
+        context.update({'q': query, 'start': start, 'end': end, 'searched': False})
+        if not (query or start or end):
+            return context
+        
+        where = dict(x.split('=', 1) for x in query.split() if '=' in x)
+        stats = {}
+        # Indexing (e.g. a freshly rotated log, which has to be decompressed
+        # in full) is left to `manage.py search --index`, run from cron
+        context['records'] = search(self.object.id, self.timestamp(start), self.timestamp(end), where, self.limit, stats=stats, build=False)
+        context['stats'] = stats
+        context['searched'] = True
+        return context
+
+
 class TokenDumpView(View):
     
     def get(self, request, *args, **kwargs):
@@ -368,4 +482,87 @@ class PulseUpdateView(View):
             logger.error(e, exc_info=True)
             return HttpResponse(e if settings.DEBUG else 'Server Error', status=500)
                 
+        return HttpResponse('Update Acknowledged', status=200)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class RejectUpdateView(View):
+    """
+    Receives counts of events nodes dropped for lacking a valid token, as
+    `reason\t\tkey\t\tcount` lines (see rsysstats.py).
+    
+    """
+    def post(self, request, *args, **kwargs):
+        logger = logging.getLogger(__name__)
+        
+        # TODO: Check for API key
+        
+        # Get payload
+        try:
+            data = (x.strip() for x in request.body.decode('utf-8').splitlines() if x.strip() != '')
+            rows = [re.split('\t+|\s{2,}', x) for x in data]
+        except Exception as e:
+            logger.error("Error getting payload:")
+            logger.error(e, exc_info=True)
+            return HttpResponse(e if settings.DEBUG else 'Server Error', status=500)
+        
+        reasons = dict(Reject.REASONS)
+        rejects = []
+        for row in rows:
+            try:
+                reason, key, count = [x.strip() for x in row]
+                count = int(count)
+            except ValueError as e:
+                logger.error(e, exc_info=True)
+                return HttpResponseBadRequest()
+            
+            if reason not in reasons or count < 1 or len(key) > 64:
+                logger.debug('Skipping malformed reject row: %s' % row)
+                continue
+            
+            rejects.append(Reject(reason=reason, key=key.lower(), count=count))
+        
+        try:
+            with transaction.atomic():
+                Reject.objects.bulk_create(rejects)
+                RejectRollup.record(rejects)
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            return HttpResponse(e if settings.DEBUG else 'Server Error', status=500)
+        
+        return HttpResponse('Update Acknowledged', status=200)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class NodeHealthUpdateView(View):
+    """
+    Receives per-minute rsyslog health samples from a node (see
+    rsysstats.py) as JSON:
+        
+        {"node": "name", "samples": [[epoch, series, total, peak], ...]}
+    
+    """
+    def post(self, request, *args, **kwargs):
+        logger = logging.getLogger(__name__)
+        
+        # TODO: Check for API key
+        
+        try:
+            payload = json.loads(request.body.decode('utf-8'))
+            node = str(payload['node'])[:64]
+            samples = [
+                (datetime.fromtimestamp(int(ts), timezone.utc), str(series)[:64], int(total), int(peak))
+                for ts, series, total, peak in payload.get('samples', [])
+            ]
+        except Exception as e:
+            logger.error("Error getting payload:")
+            logger.error(e, exc_info=True)
+            return HttpResponseBadRequest()
+        
+        try:
+            NodeMetric.record(node, samples)
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            return HttpResponse(e if settings.DEBUG else 'Server Error', status=500)
+        
         return HttpResponse('Update Acknowledged', status=200)
\ No newline at end of file
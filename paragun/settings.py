@@ -11,7 +11,6 @@ https://docs.djangoproject.com/en/2.1/ref/settings/
 """
 from django.urls import reverse_lazy
 import os
-import ldap
 import logging
 #logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)-8s] %(filename)s:%(lineno)d %(message)s')
 logger = logging.getLogger(__name__)
@@ -56,6 +55,72 @@ LISTEN_INTERFACE = "0.0.0.0"
 # What TCP port to listen for events on
 LISTEN_PORT = 65514
 
+# How many ingest worker processes to run (0 for one per CPU)
+LISTEN_WORKERS = 1
+
+# Where each ingest worker serves its stats; worker n uses STATS_PORT + n
+STATS_INTERFACE = "127.0.0.1"
+STATS_PORT = 65515
+
+# How long (in seconds) a stopping worker waits for clients and queues to drain
+SHUTDOWN_TIMEOUT = 30
+
+# On-demand profiling of ingest workers: `kill -USR2 <pid>` (of a worker or the
+# supervisor) or touching profile.trigger in PROFILE_DIR samples stacks every
+# PROFILE_INTERVAL CPU seconds for PROFILE_DURATION seconds (see Profiler in
+# rsysparse.py); the trigger file may hold another duration
+PROFILE_DIR = '/var/log/paragun'
+PROFILE_INTERVAL = 0.005
+PROFILE_DURATION = 30
+
+# Where the native ingest service writes per-token log files, and where rsyslog
+# nodes ship their rotated ones (see ansible/templates/logrotate/paragun-logs);
+# search and purge read them from here
+OUTPUT_DIR = '/var/log/paragun'
+
+# Ingest pipeline tuning; queue sizes bound how much memory each stage can use
+PIPELINE_QUEUE_SIZE = 10000
+PIPELINE_BATCH_SIZE = 500
+PIPELINE_LINGER = 0.5
+
+# Records the parse stage handles between yields to the eventlet hub; parsing a
+# whole batch without yielding stops the listener reading for tens of ms
+PIPELINE_YIELD_EVERY = 50
+
+# Let the parsing engine skip, for each message family (its leading words), the
+# fields whose parsers matched none of the service's samples of that family (see
+# Service.get_families). Off by default: a message unlike every sample of its
+# family loses any field only it would have matched. Families are cached for
+# PARSER_FAMILIES_TTL seconds, or until the service's parsers change
+PARSER_FAMILIES = False
+PARSER_FAMILIES_TTL = 300
+
+# How many distinct templates to track per service when clustering unparsed events
+TEMPLATE_CAPACITY = 100
+
+# Write the native service's output as block-compressed, indexed archives;
+# records per block, and seconds a partial block may wait before being written.
+# Records waiting for their block are lost if a worker dies, so keep it short
+ARCHIVE_OUTPUT = True
+ARCHIVE_BLOCK_SIZE = 1000
+ARCHIVE_LINGER = 2
+
+# False positive rate of the per-block bloom filters used by log search
+SEARCH_BLOOM_ERROR = 0.01
+
+# Rows deleted per transaction when purging metrics past a token's retention
+PURGE_BATCH_SIZE = 5000
+
+# Node health series: the rsyslog queue to watch, the highwatermark at which it
+# starts spilling to disk (see rsyslog-00-consumer.conf), and how many hours of
+# per-minute samples to keep before only the hourly rollups remain
+NODE_QUEUE = 'pipeline-in'
+NODE_QUEUE_HIGHWATERMARK = 175000
+NODE_METRIC_RETENTION = 48
+
+# Standalone parsing script shared by rsyslog nodes and the native service
+PARSING_ENGINE = os.path.join(BASE_DIR, 'ansible', 'templates', 'rsyslog', 'rsysparse.py')
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/2.1/howto/deployment/checklist/
 
@@ -154,18 +219,19 @@ LDAP_SERVER = 'ldaps://ldap.corp.example.com'
 LDAP_BASE = 'ou=Users,dc=example,dc=com'
 LDAP_USERNAME = 'ldap'
 LDAP_PASSWORD = 'ldap_password123'
-
-try:
-    if LDAP_ENABLED:
-        # Ignore self signed cert errors
-        #ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_ALLOW)
-        LDAP_CONN = ldap.initialize(LDAP_SERVER)
-        LDAP_CONN.simple_bind_s("uid=%(username)s,%(ldap_base)s" % {'username': LDAP_USERNAME, 'ldap_base': LDAP_BASE}, LDAP_PASSWORD)
-        
-except Exception as e:
-    logger.error("LDAP_ENABLED is True, but there was a problem with the configuration.")
-    logger.error(e)
-    quit()
+LDAP_USER_FILTER = '(uid=%(username)s)'
+
+# Connections per worker, network timeout (seconds), how long an idle
+# connection is trusted before it is reopened, and how long user lookups are cached
+LDAP_POOL_SIZE = 4
+LDAP_TIMEOUT = 5
+LDAP_IDLE = 300
+LDAP_CACHE_TTL = 300
+
+# LDAP connections are opened on first login (see common.backends), not here
+AUTHENTICATION_BACKENDS = ['django.contrib.auth.backends.ModelBackend']
+if LDAP_ENABLED:
+    AUTHENTICATION_BACKENDS.append('common.backends.LDAPBackend')
 
 # Internationalization
 # https://docs.djangoproject.com/en/2.1/topics/i18n/
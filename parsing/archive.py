@@ -0,0 +1,306 @@
+from collections import namedtuple
+from contextlib import contextmanager
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+from time import time
+
+import fcntl
+import logging
+import math
+import os
+import zlib
+
+# One line of an archive's sidecar index
+Block = namedtuple('Block', ('offset', 'length', 'records', 'start', 'end'))
+
+
+def index_path(path):
+    return path + '.idx'
+
+
+def epoch(value):
+    """
+    Converts an RFC3339 timestamp (as written in ParagunJSON) to UNIX time.
+    
+    Returns:
+        epoch (float): Seconds since the epoch, or None if unparseable.
+    
+    """
+    try:
+        return parse_datetime(value).timestamp()
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def compress(data, level=6):
+    """
+    Compresses bytes into a single, self-contained gzip member.
+    
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def read_index(path):
+    """
+    Reads the sidecar index of an archive.
+    
+    Returns:
+        blocks (list): Block tuples in file order; empty if there is no index.
+    
+    """
+    blocks = []
+    try:
+        with open(index_path(path), 'r') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) != 5: continue
+                blocks.append(Block(int(parts[0]), int(parts[1]), int(parts[2]), float(parts[3]), float(parts[4])))
+    except FileNotFoundError:
+        pass
+    return blocks
+
+
+def write_index(path, blocks, mode='a'):
+    with open(index_path(path), mode) as f:
+        f.write(''.join('%s\t%s\t%s\t%d\t%d\n' % tuple(x) for x in blocks))
+
+
+@contextmanager
+def locked(path):
+    """
+    Opens an archive for appending, holding an exclusive lock on it, so that
+    processes sharing it (i.e. ingest workers, which share a node name and so
+    write the same archives) never come between a block and its index line.
+    
+    Yields:
+        f (file): The archive, positioned at its end.
+    
+    """
+    with open(path, 'ab') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            # It may have grown while we waited for the lock
+            f.seek(0, os.SEEK_END)
+            yield f
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_block(path, block, f=None):
+    """
+    Decompresses a single block of an archive.
+    
+    Kwargs:
+        f (file): Already-open archive, to avoid reopening it per block.
+    
+    Returns:
+        lines (list): Decoded lines of the block, without line endings.
+    
+    """
+    if f is None:
+        with open(path, 'rb') as f:
+            return read_block(path, block, f)
+    
+    f.seek(block.offset)
+    return zlib.decompress(f.read(block.length), 31).decode('utf-8').splitlines()
+
+
+def scan(path):
+    """
+    Rebuilds the block list of an archive by walking its gzip members, for
+    archives whose index is missing or behind (e.g. after a crash between
+    writing a block and indexing it).
+    
+    Returns:
+        blocks (list): Block tuples in file order.
+    
+    """
+    blocks = []
+    with open(path, 'rb') as f:
+        data = f.read()
+    
+    offset = 0
+    while offset < len(data):
+        decompressor = zlib.decompressobj(31)
+        try:
+            content = decompressor.decompress(data[offset:])
+        except zlib.error:
+            break
+        if not decompressor.eof:
+            # Truncated member; nothing after it can be trusted
+            break
+        
+        length = len(data) - offset - len(decompressor.unused_data)
+        lines = content.decode('utf-8', 'replace').splitlines()
+        stamps = [x for x in (record_timestamp(line) for line in lines) if x]
+        blocks.append(Block(offset, length, len(lines), *span(min(stamps), max(stamps)) if stamps else (0, 0)))
+        offset += length
+    
+    return blocks
+
+
+def span(first, last):
+    """
+    Returns:
+        span (tuple): Whole UNIX seconds covering two RFC3339 timestamps;
+            0 for either one that can't be parsed.
+    
+    """
+    start, end = epoch(first), epoch(last)
+    return (math.floor(start) if start is not None else 0, math.ceil(end) if end is not None else 0)
+
+
+def record_timestamp(line):
+    """
+    Pulls the `timestamp` field out of a ParagunJSON line without decoding
+    all of it; it is always the first field.
+    
+    """
+    start = line.find('"timestamp":"')
+    if start < 0: return None
+    start += 13
+    return line[start:line.find('"', start)]
+
+
+class ArchiveWriter(object):
+    """
+    Writes ParagunJSON lines to a gzip file as a series of independent gzip
+    members ("blocks") of up to `block_size` records, and appends one line
+    per block to a sidecar index:
+        
+        offset<TAB>length<TAB>records<TAB>first timestamp<TAB>last timestamp
+    
+    The result is still a valid .gz file that gzip/zcat read end to end, but
+    a reader can also use the index to seek to and decompress only the
+    blocks covering a time range.
+    
+    Lines are buffered until a block fills up or has been pending for
+    `linger` seconds; buffered lines are lost if the process dies. The index
+    is written after its block, so a crash can at worst leave a block
+    unindexed; it is picked up again the next time the archive is opened.
+    Both are written under a lock on the archive (see locked()), so several
+    processes can append to the same one.
+    
+    """
+    def __init__(self, path, *args, **kwargs):
+        """
+        Args:
+            path (str): Archive to append to.
+        
+        Kwargs:
+            block_size (int): Records per block.
+            linger (int): Seconds before a partial block is written anyway.
+            level (int): Compression level.
+        
+        """
+        self.path = path
+        self.block_size = kwargs.get('block_size', settings.ARCHIVE_BLOCK_SIZE)
+        self.linger = kwargs.get('linger', settings.ARCHIVE_LINGER)
+        self.level = kwargs.get('level', 6)
+        
+        self.lines = []
+        self.start = None
+        self.end = None
+        self.pending_since = None
+        
+        self.recover()
+    
+    def recover(self):
+        """
+        Indexes any blocks written after the last indexed one.
+        
+        """
+        logger = logging.getLogger(__name__)
+        
+        if not os.path.exists(self.path):
+            return
+        
+        with locked(self.path) as f:
+            blocks = read_index(self.path)
+            indexed = blocks[-1].offset + blocks[-1].length if blocks else 0
+            if indexed == f.tell():
+                return
+            
+            logger.warning('Index of %s is out of date; rebuilding it.' % self.path)
+            write_index(self.path, scan(self.path), mode='w')
+    
+    def write(self, lines):
+        """
+        Adds ParagunJSON lines (with line endings) to the archive.
+        
+        Returns:
+            written (int): Compressed bytes written to disk, if any.
+        
+        """
+        written = 0
+        lines = list(lines)
+        while lines:
+            room = self.block_size - len(self.lines)
+            chunk, lines = lines[:room], lines[room:]
+            
+            # Timestamps written by the pipeline are all UTC in the same
+            # format, so they order correctly as strings; only the first and
+            # last of each block need parsing
+            stamps = [x for x in map(record_timestamp, chunk) if x]
+            if self.start is not None: stamps.append(self.start)
+            if self.end is not None: stamps.append(self.end)
+            if stamps:
+                self.start, self.end = min(stamps), max(stamps)
+            
+            if not self.lines: self.pending_since = time()
+            self.lines.extend(chunk)
+            
+            if len(self.lines) >= self.block_size:
+                written += self.flush()
+        
+        if self.lines and time() - self.pending_since >= self.linger:
+            written += self.flush()
+        return written
+    
+    def flush(self):
+        """
+        Writes buffered lines out as a block.
+        
+        Returns:
+            written (int): Compressed bytes written.
+        
+        """
+        if not self.lines:
+            return 0
+        
+        data = compress(''.join(self.lines).encode('utf-8'), self.level)
+        
+        # Reopen per block so the file can be moved or deleted between blocks
+        start, end = span(self.start, self.end)
+        with locked(self.path) as f:
+            offset = f.tell()
+            f.write(data)
+            f.flush()
+            write_index(self.path, [Block(offset, len(data), len(self.lines), start, end)])
+        
+        self.lines = []
+        self.start = self.end = self.pending_since = None
+        return len(data)
+    
+    def close(self):
+        return self.flush()
+
+
+def iter_lines(path, start=None, end=None):
+    """
+    Yields the lines of an archive, decompressing only blocks that overlap
+    the given time range.
+    
+    Kwargs:
+        start (float): Earliest timestamp wanted, as UNIX time.
+        end (float): Latest timestamp wanted, as UNIX time.
+    
+    """
+    blocks = read_index(path)
+    with open(path, 'rb') as f:
+        for block in blocks:
+            if start is not None and block.end and block.end < start: continue
+            if end is not None and block.start and block.start > end: continue
+            for line in read_block(path, block, f):
+                yield line
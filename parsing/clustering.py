@@ -0,0 +1,107 @@
+# Keys the engine adds to every event; anything beyond these means a parser hit
+SIGNATURE_KEYS = frozenset(('punct', 'linecount'))
+
+
+def is_unparsed(data):
+    """
+    Returns:
+        unparsed (bool): Whether no parser extracted anything from the event.
+    
+    """
+    return not (set(data) - SIGNATURE_KEYS)
+
+
+class HeavyHitters(object):
+    """
+    Approximate top-k counter over an unbounded stream, in bounded memory.
+    
+    A variant of Space-Saving: up to 2 * capacity keys are tracked; when that
+    fills up the table is pruned back down to the `capacity` largest counts
+    and the largest count thrown away becomes the error floor. Keys seen for
+    the first time after that start at the floor, so for every tracked key
+    the true count is between `count - error` and `count`, and any key whose
+    true count exceeds the floor is guaranteed to be tracked.
+    
+    Each key also keeps the first example it was seen with.
+    
+    """
+    def __init__(self, capacity=100, *args, **kwargs):
+        self.capacity = capacity
+        self.floor = 0
+        self.total = 0
+        
+        # key: [count, error, example]
+        self.table = {}
+    
+    def __len__(self):
+        return len(self.table)
+    
+    def add(self, key, example=None, count=1):
+        self.total += count
+        
+        entry = self.table.get(key)
+        if entry:
+            entry[0] += count
+            return
+        
+        self.table[key] = [self.floor + count, self.floor, example]
+        if len(self.table) >= self.capacity * 2:
+            self.prune()
+    
+    def prune(self):
+        """
+        Drops all but the `capacity` largest entries.
+        
+        """
+        ranked = sorted(self.table.items(), key=lambda x: x[1][0], reverse=True)
+        for key, entry in ranked[self.capacity:]:
+            self.floor = max(self.floor, entry[0])
+            del self.table[key]
+    
+    def top(self, n=10):
+        """
+        Returns:
+            top (list): Up to n (key, count, error, example) tuples, largest
+                count first.
+        
+        """
+        ranked = sorted(self.table.items(), key=lambda x: x[1][0], reverse=True)[:n]
+        return [(key, count, error, example) for key, (count, error, example) in ranked]
+
+
+class TemplateTracker(object):
+    """
+    Keeps heavy-hitter counts of event templates (punct signatures) per
+    service, so parser authors can see which unparsed formats account for
+    the most volume.
+    
+    """
+    def __init__(self, capacity=100, *args, **kwargs):
+        self.capacity = capacity
+        self.services = {}
+    
+    def add(self, service, signature, message=None):
+        counter = self.services.get(service)
+        if counter is None:
+            counter = self.services[service] = HeavyHitters(self.capacity)
+        counter.add(signature, message)
+    
+    def top(self, service, n=10):
+        counter = self.services.get(service)
+        if counter is None:
+            return []
+        return counter.top(n)
+    
+    def summary(self, n=5):
+        """
+        Returns:
+            summary (dict): Service -> {total, templates: [[signature, count]]}
+                for the n largest templates of each service.
+        
+        """
+        return {
+            service: {
+                'total': counter.total,
+                'templates': [[key, count] for key, count, error, example in counter.top(n)],
+            } for service, counter in self.services.items()
+        }
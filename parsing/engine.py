@@ -0,0 +1,66 @@
+from django.conf import settings
+
+import importlib.util
+import logging
+
+_module = None
+
+
+def get_module(path=None):
+    """
+    Imports the standalone parsing script deployed to rsyslog nodes so other
+    processes can reuse its parsing logic without maintaining a second copy.
+    
+    Kwargs:
+        path (str): Location of the script. Defaults to PARSING_ENGINE.
+    
+    Returns:
+        module (module): The imported rsysparse module.
+    
+    """
+    global _module
+    if _module is not None and path is None:
+        return _module
+    
+    spec = importlib.util.spec_from_file_location('rsysparse', path or settings.PARSING_ENGINE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    
+    if path is None:
+        _module = module
+    return module
+
+
+def get_engine(parse_tree=None, *args, **kwargs):
+    """
+    Builds a ParsingEngine loaded with the given parse tree, or with the
+    current parser map from the database if none is provided.
+    
+    GeoIP databases are opened if available, along with the IPv4 GeoIP index
+    built from them (see rsysparse.GeoIndex); if not, enrichment lookups fail
+    (and are logged) but parsing carries on.
+    
+    Kwargs:
+        parse_tree (dict): Parser map as returned by Service.get_parser_map().
+    
+    Returns:
+        engine (ParsingEngine): Engine ready to parse messages.
+    
+    """
+    logger = logging.getLogger(__name__)
+    module = get_module()
+    
+    try:
+        module.open_databases()
+        module.open_index()
+    except Exception as e:
+        logger.warning("GeoIP databases unavailable; IP enrichment disabled.")
+        logger.warning(e)
+    
+    if parse_tree is None:
+        from parsing.models import Service
+        parse_tree = Service.get_parser_map()
+    
+    engine = module.ParsingEngine()
+    engine.load_parsers(parse_tree)
+    return engine
@@ -0,0 +1,32 @@
+from django.core.management import BaseCommand
+
+from common import partitions
+
+import logging
+
+#The class must be named Command, and subclass BaseCommand
+class Command(BaseCommand):
+    # Show this when the user types help
+    help = "Creates upcoming monthly partitions of the metrics table (PostgreSQL 11+ only)."
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=3, help="Months ahead of the current one to create partitions for.")
+        parser.add_argument('--convert', action='store_true', help="Convert the metrics table to a partitioned one first. Locks the table while rows are copied.")
+    
+    def handle(self, *args, **options):
+        logger = logging.getLogger(__name__)
+        
+        if not partitions.supported():
+            self.stdout.write('Partitioning needs PostgreSQL 11 or later; metrics stay in a single table.')
+            return
+        
+        if options['convert']:
+            count = partitions.convert(ahead=options['ahead'])
+            if count: logger.info('Converted metrics table into %s monthly partitions.' % count)
+        
+        if not partitions.partitioned():
+            self.stdout.write("The metrics table isn't partitioned yet; run with --convert once.")
+            return
+        
+        created = partitions.ensure(ahead=options['ahead'])
+        self.stdout.write('Created %s partitions; %s in total.' % (len(created), len(partitions.partitions())))
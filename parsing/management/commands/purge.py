@@ -0,0 +1,78 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.db.models import Max
+from django.utils import timezone
+
+from common import partitions
+from common.models import NodeMetric, Token
+from parsing.search import token_files
+
+import logging
+import os
+
+#The class must be named Command, and subclass BaseCommand
+class Command(BaseCommand):
+    # Show this when the user types help
+    help = "Deletes metrics and archived logs older than each token's retention period."
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.PURGE_BATCH_SIZE, help="Metrics rows to delete per transaction.")
+        parser.add_argument('--pause', type=float, default=0, help="Seconds to wait between batches.")
+        parser.add_argument('--path', default=settings.OUTPUT_DIR, help="Directory holding token logs.")
+        parser.add_argument('--dry-run', action='store_true', help="Report expired logs without deleting anything.")
+    
+    @staticmethod
+    def expired_files(token, path):
+        """
+        Rotated and archived logs of a token last written before its purge
+        date, with their search/archive indexes. Live logs (still being
+        appended to under their plain .log name) are never included.
+        
+        """
+        limit = token.purge_date.timestamp()
+        for filename in token_files(token.id, path):
+            if filename.endswith('.log'): continue
+            try:
+                if os.path.getmtime(filename) >= limit: continue
+            except OSError:
+                continue
+            yield filename
+            for sidecar in (filename + '.idx', filename + '.sidx'):
+                if os.path.exists(sidecar): yield sidecar
+    
+    def handle(self, *args, **options):
+        logger = logging.getLogger(__name__)
+        started = timezone.now()
+        
+        rows = files = reclaimed = 0
+        
+        # Months no token retains anything from are dropped whole; the rest is
+        # deleted per token below, touching only the partitions still in range
+        longest = Token.objects.aggregate(longest=Max('retain'))['longest']
+        if longest is not None and partitions.partitioned() and not options['dry_run']:
+            _, estimate, size = partitions.drop(timezone.now() - timedelta(days=longest))
+            rows += estimate
+            reclaimed += size
+        
+        for token in Token.objects.all().iterator():
+            if not options['dry_run']:
+                deleted = token.purge(batch_size=options['batch_size'], pause=options['pause'])
+                if deleted: logger.info('Purged %s metrics rows of %s.' % (deleted, token))
+                rows += deleted
+            
+            for filename in self.expired_files(token, options['path']):
+                try:
+                    size = os.path.getsize(filename)
+                    if not options['dry_run']: os.unlink(filename)
+                except OSError as e:
+                    logger.error('Could not purge %s: %s' % (filename, e))
+                    continue
+                logger.info('%s %s (%s bytes).' % ('Would purge' if options['dry_run'] else 'Purged', filename, size))
+                files += 1
+                reclaimed += size
+        
+        if not options['dry_run']:
+            rows += NodeMetric.prune()
+        
+        self.stdout.write('Purged %s rows and %s files (%s bytes) in %.1fs.' % (rows, files, reclaimed, (timezone.now() - started).total_seconds()))
@@ -0,0 +1,64 @@
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+from django.utils import timezone
+
+from parsing.search import build_index, search
+
+import glob
+import json
+import logging
+import os
+
+#The class must be named Command, and subclass BaseCommand
+class Command(BaseCommand):
+    # Show this when the user types help
+    help = "Searches a token's logs by time range and field=value, or builds the search indexes."
+    
+    def add_arguments(self, parser):
+        parser.add_argument('token', nargs='?', help="Token whose logs to search.")
+        parser.add_argument('--start', help="Earliest timestamp (ISO 8601; UTC if no offset given).")
+        parser.add_argument('--end', help="Latest timestamp (ISO 8601; UTC if no offset given).")
+        parser.add_argument('--where', nargs='*', default=[], help="field=value conditions, all of which must match.")
+        parser.add_argument('--limit', type=int, default=100, help="Maximum number of records to print.")
+        parser.add_argument('--index', action='store_true', help="Build or update the search index of every log in OUTPUT_DIR and exit.")
+    
+    @staticmethod
+    def timestamp(value):
+        if not value: return None
+        ts = parse_datetime(value)
+        if ts is None:
+            raise CommandError("Could not parse timestamp '%s'." % value)
+        if timezone.is_naive(ts):
+            ts = timezone.make_aware(ts, timezone.utc)
+        return ts.timestamp()
+    
+    def handle(self, *args, **options):
+        logger = logging.getLogger(__name__)
+        
+        if options['index']:
+            paths = glob.glob(os.path.join(settings.OUTPUT_DIR, '*_*.log*'))
+            for path in sorted(x for x in paths if not x.endswith(('.idx', '.sidx', '.tmp'))):
+                try:
+                    index = build_index(path)
+                    logger.info("Indexed %s (%s blocks)." % (path, len(index['blocks'])))
+                except Exception as e:
+                    logger.error("Could not index %s: %s" % (path, e))
+            return
+        
+        if not options['token']:
+            raise CommandError("A token is required unless --index is given.")
+        
+        where = {}
+        for condition in options['where']:
+            if '=' not in condition:
+                raise CommandError("Conditions must look like field=value, not '%s'." % condition)
+            key, value = condition.split('=', 1)
+            where[key.strip()] = value.strip()
+        
+        stats = {}
+        records = search(options['token'], self.timestamp(options['start']), self.timestamp(options['end']), where, options['limit'], stats=stats)
+        for record in records:
+            self.stdout.write(json.dumps(record, separators=(',', ':')))
+        
+        self.stderr.write("%s records; read %s of %s blocks in %s files." % (len(records), stats['blocks_read'], stats['blocks'], stats['files']))
@@ -2,7 +2,7 @@ from django.conf import settings
 from django.utils import timezone
 from django.core.management import BaseCommand
 
-from parsing.service import Service
+from parsing.service import Service, Supervisor
 
 import logging
 
@@ -10,10 +10,21 @@ import logging
 class Command(BaseCommand):
     # Show this when the user types help
     help = "Starts log ingestion service."
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.LISTEN_WORKERS, help="Number of worker processes sharing the port (0 for one per CPU).")
+        parser.add_argument('--interface', default=settings.LISTEN_INTERFACE, help="IP address of interface to listen to.")
+        parser.add_argument('--port', type=int, default=settings.LISTEN_PORT, help="TCP port to listen on.")
 
     # A command must define handle()
     def handle(self, *args, **options):
         logger = logging.getLogger(__name__)
         
-        self.service = Service()
-        self.service.listen()
\ No newline at end of file
+        kwargs = {'interface': options['interface'], 'port': options['port']}
+        
+        if options['workers'] == 1:
+            self.service = Service(stats_port=settings.STATS_PORT, **kwargs)
+            self.service.listen()
+        else:
+            self.supervisor = Supervisor(workers=options['workers'], **kwargs)
+            self.supervisor.run()
\ No newline at end of file
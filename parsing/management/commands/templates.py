@@ -0,0 +1,98 @@
+from django.conf import settings
+from django.core.management import BaseCommand
+
+from parsing.clustering import TemplateTracker, is_unparsed
+from parsing.engine import get_module
+from parsing.models import Sample, Service
+from parsing.pipeline import format_header, parse_header
+
+import glob
+import gzip
+import json
+import logging
+import os
+
+#The class must be named Command, and subclass BaseCommand
+class Command(BaseCommand):
+    # Show this when the user types help
+    help = "Reports the most frequent unparsed event templates per service."
+    
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help="Log files to read (ParagunJSON lines, optionally gzipped). Defaults to all logs in OUTPUT_DIR.")
+        parser.add_argument('--service', help="Only report on this service.")
+        parser.add_argument('--top', type=int, default=10, help="How many templates to report per service.")
+        parser.add_argument('--samples', type=int, default=3, help="How many matching Sample rows to show per template.")
+        parser.add_argument('--capacity', type=int, default=settings.TEMPLATE_CAPACITY, help="How many templates to track per service.")
+        parser.add_argument('--save', action='store_true', help="Create a Sample row from the example of each template that has none.")
+    
+    def records(self, paths):
+        """
+        Streams parsed records from log files, one at a time.
+        
+        """
+        logger = logging.getLogger(__name__)
+        
+        for path in paths:
+            opener = gzip.open if path.endswith('.gz') else open
+            try:
+                with opener(path, 'rt', encoding='utf-8', errors='replace') as f:
+                    for line in f:
+                        try: yield json.loads(line)
+                        except ValueError: continue
+            except OSError as e:
+                logger.error(e)
+    
+    def handle(self, *args, **options):
+        logger = logging.getLogger(__name__)
+        engine = get_module().ParsingEngine()
+        
+        paths = options['paths']
+        if not paths:
+            paths = sorted(glob.glob(os.path.join(settings.OUTPUT_DIR, '*.log')) + glob.glob(os.path.join(settings.OUTPUT_DIR, '*.log*.gz')))
+        
+        # Single pass over the logs; memory is bounded by the tracker capacity
+        tracker = TemplateTracker(options['capacity'])
+        for record in self.records(paths):
+            service = record.get('process', '')
+            message = record.get('msg', '')
+            if not service or not message: continue
+            if options['service'] and service != options['service']: continue
+            
+            data = record.get('data') or {}
+            if not isinstance(data, dict) or not is_unparsed(data): continue
+            
+            signature = data.get('punct')
+            if signature is None:
+                signature = engine.signature(message)[0]
+            # Keep the record; its example line is only built for the top ones
+            tracker.add(service, signature, record)
+        
+        for service in sorted(tracker.services, key=lambda x: tracker.services[x].total, reverse=True):
+            total = tracker.services[service].total
+            self.stdout.write('%s (%s unparsed events)' % (service, total))
+            
+            # Index this service's samples by the signature of their message body
+            samples = {}
+            for sample in Sample.objects.enabled().filter(service__key=service).order_by('-created'):
+                signature = engine.signature(parse_header(sample.value)['msg'])[0]
+                samples.setdefault(signature, []).append(sample)
+            
+            for rank, (signature, count, error, record) in enumerate(tracker.top(service, options['top']), 1):
+                # Samples are raw lines, read back through parse_header
+                example = format_header(record)
+                share = 100.0 * count / total if total else 0
+                self.stdout.write('  %2d. %s (~%.1f%%, +/-%s) %s' % (rank, count, share, error, signature))
+                self.stdout.write('      example: %s' % example)
+                
+                matches = samples.get(signature, [])
+                for sample in matches[:options['samples']]:
+                    self.stdout.write('      sample #%s: %s' % (sample.id, sample.value))
+                
+                if not matches and options['save']:
+                    obj = Service.objects.filter(key=service).first()
+                    if obj:
+                        sample = Sample.objects.create(service=obj, value=example)
+                        samples[signature] = [sample]
+                        self.stdout.write('      sample #%s: created' % sample.id)
+            
+            self.stdout.write('')
@@ -1,19 +1,30 @@
 from django.core.management import BaseCommand
 
-from parsing.models import Service
+from parsing.models import Assertion, Sample, Service
 
 import logging
+import os
+import time
 
 #The class must be named Command, and subclass BaseCommand
 class Command(BaseCommand):
     # Show this when the user types help
     help = "Performs validation on all service parsers."
-
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help="Worker processes to validate services in.")
+    
     # A command must define handle()
     def handle(self, *args, **options):
         logger = logging.getLogger(__name__)
         
-        services = Service.objects.enabled()
-        for service in services:
-            logger.info("Validating %s..." % service)
-            service.test()
\ No newline at end of file
+        started = time.perf_counter()
+        results = Service.validate(processes=options['processes'])
+        elapsed = time.perf_counter() - started
+        
+        for service in Service.objects.filter(pk__in=[k for k,v in results.items() if not v]):
+            logger.warning("%s failed validation." % service)
+        
+        samples = Sample.objects.enabled().filter(service__in=list(results)).count()
+        failed = Assertion.objects.filter(sample__service__in=list(results), status=False).count()
+        self.stdout.write("Validated %s services (%s samples) in %.2fs; %s failed, %s failing assertions." % (len(results), samples, elapsed, list(results.values()).count(False), failed))
@@ -1,9 +1,15 @@
 from common.models import AbstractBaseModel
+from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
 from django.db import models, transaction
+from functools import lru_cache
+from time import time
 
-import logging
+import copy
+import json
+import multiprocessing
+import os
 import re
 import timeit
 
@@ -32,18 +38,29 @@ class Service(AbstractBaseModel):
         
         Parsers that are disabled or in untested/failure states are excluded.
         
+        With PARSER_FAMILIES (or `families=True`), each service with samples
+        also gets a `_family_skip` entry mapping message families to the
+        fields that cannot apply to them (see `get_families()`).
+        
+        The top-level `_fields` entry lists every field's type and validator,
+        so values that JSON and key=value messages label with a field key can
+        be read without a regex, even for services with no parsers. Pass
+        `fields=False` to leave it out.
+        
         Returns:
             mapping (dict): {
                 service: {
                     fieldname: [validator, [parsers]],
                     fieldname2: [validator, [parsers]],
-                }
+                    '_family_skip': {family: [fieldnames]},
+                },
+                '_fields': {fieldname: {'type': type, 'validator': validator}},
             }
         
         """
         services = cls.objects.enabled()
         
-        return {
+        mapping = {
             service.key: {
                 parser.field.key: {
                     'validator': parser.field.validator,
@@ -53,42 +70,172 @@ class Service(AbstractBaseModel):
             } for service in services
         }
         
+        if kwargs.get('families', settings.PARSER_FAMILIES):
+            for service in services:
+                families = service.get_families(mapping)
+                if families: mapping[service.key]['_family_skip'] = families
+        
+        if kwargs.get('fields', True):
+            mapping['_fields'] = {
+                field.key: {'type': field.type, 'validator': field.validator}
+                for field in Field.objects.all()
+            }
+        
+        return mapping
+    
+    # {service id: (built, parsers, families)}; see get_families()
+    families_cache = {}
+    
+    def get_families(self, mapping, *args, **kwargs):
+        """
+        Groups this service's samples into message families and lists, for
+        each, the fields whose parsers matched none of its samples, so the
+        parsing engine can skip them for messages of that family.
+        
+        Results are cached for PARSER_FAMILIES_TTL seconds, and rebuilt as
+        soon as the service's parsers change.
+        
+        Args:
+            mapping (dict): Parser map as built by get_parser_map().
+        
+        Returns:
+            families (dict): {family: [fields]}; families with nothing to
+                skip are left out, and it is empty if there are no samples.
+        
+        """
+        from parsing.engine import get_module
+        from parsing.pipeline import parse_header
+        
+        if not mapping.get(self.key): return {}
+        parsers = json.dumps(mapping[self.key], sort_keys=True)
+        cached = self.families_cache.get(self.pk)
+        if cached and cached[1] == parsers and time() - cached[0] < settings.PARSER_FAMILIES_TTL:
+            return cached[2]
+        
+        families = {}
+        messages = [parse_header(x)['msg'] for x in self.samples.enabled().values_list('value', flat=True)]
+        if messages:
+            # The engine mutates the tree it loads, so give it its own copy
+            engine = get_module().ParsingEngine()
+            engine.load_parsers({self.key: copy.deepcopy(mapping[self.key])})
+            families = {family: fields for family, fields in engine.build_families(self.key, messages).items() if fields}
+        
+        self.families_cache[self.pk] = (time(), parsers, families)
+        return families
+        
     def test(self, *args, **kwargs):
-        # Get all valid log samples for this service
-        samples = self.samples.enabled()
+        return Service.validate(services=[self], processes=1)[self.pk]
+    
+    @classmethod
+    def validate(cls, services=None, processes=None, *args, **kwargs):
+        """
+        Runs every enabled parser against the enabled samples of the given
+        services, records which assertions and samples pass, and reports
+        which services passed.
+        
+        Parsers, samples and assertions are loaded in a fixed number of
+        queries, and the regexes are run in a pool of worker processes, one
+        service at a time. Workers only get plain data and never touch the
+        database. Statuses are written back with one UPDATE per model and
+        status.
+        
+        Kwargs:
+            services (iterable): Services to validate. Defaults to all enabled.
+            processes (int): Worker processes. Defaults to the CPU count; 1
+                validates in this process.
+        
+        Returns:
+            results (dict): {service id: passed (bool)}
         
+        """
+        ids = [x.pk for x in services] if services is not None else None
+        services = cls.objects.enabled() if ids is None else cls.objects.filter(pk__in=ids)
+        services = services.prefetch_related(
+            models.Prefetch('parsers', queryset=Parser.objects.enabled().order_by('priority')),
+            models.Prefetch('samples', queryset=Sample.objects.enabled()),
+            models.Prefetch('samples__assertions', queryset=Assertion.objects.enabled()),
+        )
+        
+        units = []
+        for service in services:
+            patterns = {}
+            for parser in service.parsers.all():
+                patterns.setdefault(parser.field_id, []).append(parser.value)
+            samples = [(sample.pk, sample.value, [(x.pk, x.key_id, x.value) for x in sample.assertions.all()]) for sample in service.samples.all()]
+            units.append((service.pk, patterns, samples))
+        
+        processes = processes or os.cpu_count() or 1
+        if processes > 1 and len(units) > 1:
+            with multiprocessing.Pool(min(processes, len(units))) as pool:
+                checked = pool.map(check_service, units, chunksize=1)
+        else:
+            checked = [check_service(x) for x in units]
+        
+        statuses = {Sample: {True: [], False: []}, Assertion: {True: [], False: []}}
+        results = {}
+        for service, samples, assertions in checked:
+            results[service] = all(samples.values())
+            for pk, status in samples.items(): statuses[Sample][status].append(pk)
+            for pk, status in assertions.items(): statuses[Assertion][status].append(pk)
+        
+        # Django 2.1 has no bulk_update; with only two possible values, an
+        # UPDATE per status (in chunks, for SQLite's variable limit) does it
         with transaction.atomic():
-            for sample in samples:
-                sample.status = True
-                
-                for assertion in sample.assertions.enabled():
-                    # Get parsers for this field for this service
-                    parsers = self.parsers.enabled().filter(field=assertion.key)
-                    
-                    # Run each against sample until a valid value is found
-                    value = None
-                    for parser in parsers:
-                        value = parser.parse(sample.value)
-                        if value: break
-                    
-                    try:
-                        assert value == assertion.value
-                        assertion.status = True
-                    except AssertionError:
-                        assertion.status = False
-                    
-                    assertion.save()
-                    
-                    if assertion.status == False:
-                        sample.status = False
-                    
-                sample.save()
-                
-        if self.samples.enabled().filter(status=False).exists():
-            return False
-        return True
-                
-                
+            for model, groups in statuses.items():
+                for status, pks in groups.items():
+                    for i in range(0, len(pks), 500):
+                        model.objects.filter(pk__in=pks[i:i+500]).update(status=status)
+        
+        return results
+
+
+def check_service(unit):
+    """
+    Validates one service's samples; the unit of work of Service.validate().
+    
+    Args:
+        unit (tuple): (service id, {field id: [patterns, by priority]},
+            [(sample id, sample, [(assertion id, field id, expected value)])])
+    
+    Returns:
+        results (tuple): (service id, {sample id: status}, {assertion id: status})
+    
+    """
+    service, patterns, samples = unit
+    patterns = {field: [compile_regex(x) for x in values] for field, values in patterns.items()}
+    
+    sample_status, assertion_status = {}, {}
+    for pk, value, assertions in samples:
+        sample_status[pk] = True
+        for assertion, field, expected in assertions:
+            # Run each parser against the sample until a value is found
+            found = None
+            for regex in patterns.get(field, ()):
+                found = first_group(regex, value)
+                if found: break
+            
+            assertion_status[assertion] = found == expected
+            if found != expected:
+                sample_status[pk] = False
+    
+    return service, sample_status, assertion_status
+
+
+@lru_cache(maxsize=4096)
+def compile_regex(pattern):
+    """
+    Compiles a parser's regex once per process, however many Parser
+    instances or validation runs use it.
+    
+    """
+    return re.compile(pattern)
+
+
+def first_group(regex, string):
+    try: return regex.search(string).group(1)
+    except: return ''
+
+
 class Parser(AbstractBaseModel):
     
     class Meta:
@@ -103,16 +250,13 @@ class Parser(AbstractBaseModel):
     
     @property
     def regex(self):
-        if not getattr(self, '_compiled', None):
-            self._compiled = re.compile(self.value)
-        return self._compiled
+        return compile_regex(self.value)
     
     def __str__(self):
         return '%s: %s (%s)' % (self.service.key, self.field.key, self.priority)
         
     def parse(self, string, *args, **kwargs):
-        try: return self.regex.search(string).group(1)
-        except: return ''
+        return first_group(self.regex, string)
     
     def save(self, *args, **kwargs):
         # Validate regex, make sure there are no obvious syntax errors
@@ -196,15 +340,3 @@ class Field(AbstractBaseModel):
             self.validator = self.DEFAULT_VALIDATOR
         
         super().save(*args, **kwargs)
-        
-try:
-    logger = logging.getLogger(__name__)
-    logger.info("Populating database with default fields...")
-    default_fields = ['action', 'additional_answer_count', 'affect_dest', 'answer', 'answer_count', 'app', 'array', 'authority_answer_count', 'availability', 'avg_executions', 'blocksize', 'body', 'buffer_cache_hit_ratio', 'bugtraq', 'bytes', 'bytes_in', 'bytes_out', 'cached', 'category', 'cert', 'change', 'change_type', 'channel', 'cluster', 'cm_enabled', 'cm_supported', 'command', 'comments', 'commits', 'committed_memory', 'compilation_time', 'cookie', 'cpu_cores', 'cpu_count', 'cpu_load_mhz', 'cpu_load_percent', 'cpu_mhz', 'cpu_time', 'cpu_time_enabled', 'cpu_time_supported', 'cpu_used', 'current_cpu_time', 'current_loaded', 'current_user_time', 'cursor', 'cve', 'cvss', 'daemon_thread_count', 'date', 'delay', 'description', 'dest', 'dest_bunit', 'dest_category', 'dest_dns', 'dest_interface', 'dest_ip', 'dest_mac', 'dest_nt_domain', 'dest_nt_host', 'dest_port', 'dest_priority', 'dest_requires_av', 'dest_should_timesync', 'dest_should_update', 'dest_translated_ip', 'dest_translated_port', 'dest_zone', 'direction', 'dlp_type', 'dns', 'dump_area_used', 'duration', 'dvc', 'dvc_bunit', 'dvc_category', 'dvc_ip', 'dvc_mac', 'dvc_priority', 'dvc_zone', 'elapsed_time', 'enabled', 'endpoint', 'endpoint_version', 'family', 'fd_max', 'file_access_time', 'file_acl', 'file_create_time', 'file_hash', 'file_modify_time', 'file_name', 'file_path', 'file_size', 'filter_action', 'filter_score', 'flow_id', 'free_bytes', 'free_physical_memory', 'free_swap', 'heap_committed', 'heap_initial', 'heap_max', 'heap_used', 'http_content_type', 'http_method', 'http_referrer', 'http_user_agent', 'http_user_agent_length', 'hypervisor', 'hypervisor_id', 'icmp_code', 'icmp_type', 'id', 'ids_type', 'incident', 'indexes_hit', 'inline_nat', 'instance_name', 'instance_reads', 'instance_version', 'instance_writes', 'interactive', 'interface', 'internal_message_id', 'ip', 'jvm_description', 'last_call_minute', 'latency', 'lb_method', 'lease_duration', 'lease_scope', 'lock_mode', 'lock_session_id', 'logical_reads', 'logon_time', 'mac', 'machine', 'max_file_descriptors', 'mem', 'mem_used', 'memory_sorts', 'message', 'message_consumed_time', 'message_correlation_id', 'message_delivered_time', 'message_delivery_mode', 'message_expiration_time', 'message_id', 'message_info', 'message_priority', 'message_properties', 'message_received_time', 'message_redelivered', 'message_reply_dest', 'message_type', 'mount', 'msft', 'mskb', 'name', 'node', 'node_port', 'non_heap_committed', 'non_heap_initial', 'non_heap_max', 'non_heap_used', 'number_of_users', 'obj_name', 'object', 'object_attrs', 'object_category', 'object_id', 'object_path', 'objects_pending', 'omu_supported', 'open_file_descriptors', 'orig_dest', 'orig_recipient', 'orig_src', 'os', 'os_architecture', 'os_pid', 'os_version', 'packets', 'packets_in', 'packets_out', 'parameters', 'parent', 'password', 'payload', 'payload_type', 'peak_thread_count', 'physical_memory', 'physical_reads', 'priority', 'problem', 'process', 'process_id', 'process_limit', 'process_name', 'processes', 'product_version', 'protocol', 'protocol_version', 'query', 'query_count', 'query_id', 'query_plan_hit', 'query_time', 'query_type', 'read_blocks', 'read_latency', 'read_ops', 'recipient', 'recipient_count', 'recipient_status', 'record_type', 'records_affected', 'reply_code', 'reply_code_id', 'request_payload', 'request_payload_type', 'request_sent_time', 'response_code', 'response_payload_type', 'response_received_time', 'response_time', 'result', 'result_id', 'retries', 'return_addr', 'return_message', 'rpc_protocol', 'rule', 'seconds_in_wait', 'sender', 'serial', 'serial_num', 'service', 'service_id', 'session_id', 'session_limit', 'session_status', 'sessions', 'severity', 'severity_id', 'sga_buffer_cache_size', 'sga_buffer_hit_limit', 'sga_data_dict_hit_ratio', 'sga_fixed_area_size', 'sga_free_memory', 'sga_library_cache_size', 'sga_redo_log_buffer_size', 'sga_shared_pool_size', 'sga_sql_area_size', 'shell', 'signature', 'signature_extra', 'signature_id', 'signature_version', 'site', 'size', 'snapshot', 'src', 'src_bunit', 'src_category', 'src_dns', 'src_interface', 'src_ip', 'src_mac', 'src_nt_domain', 'src_nt_host', 'src_port', 'src_priority', 'src_translated_ip', 'src_translated_port', 'src_user', 'src_user_bunit', 'src_user_category', 'src_user_priority', 'src_zone', 'ssid', 'ssl_end_time', 'ssl_engine', 'ssl_hash', 'ssl_is_valid', 'ssl_issuer', 'ssl_issuer_common_name', 'ssl_issuer_email', 'ssl_issuer_locality', 'ssl_issuer_organization', 'ssl_issuer_state', 'ssl_issuer_street', 'ssl_issuer_unit', 'ssl_name', 'ssl_policies', 'ssl_publickey', 'ssl_publickey_algorithm', 'ssl_serial', 'ssl_session_id', 'ssl_signature_algorithm', 'ssl_start_time', 'ssl_subject', 'ssl_subject_common_name', 'ssl_subject_email', 'ssl_subject_locality', 'ssl_subject_organization', 'ssl_subject_state', 'ssl_subject_street', 'ssl_subject_unit', 'ssl_validity_window', 'ssl_version', 'start_mode', 'start_time', 'status', 'status_code', 'storage', 'stored_procedures_called', 'subject', 'swap_space', 'synch_supported', 'system_load', 'table_scans', 'tables_hit', 'tablespace_name', 'tablespace_reads', 'tablespace_status', 'tablespace_used', 'tablespace_writes', 'tag', 'tcp_flag', 'thread_count', 'threads_started', 'ticket_id', 'time', 'time_submitted', 'tos', 'total_loaded', 'total_processors', 'total_unloaded', 'transaction_id', 'transport', 'transport_dest_port', 'ttl', 'type', 'uptime', 'uri_path', 'uri_query', 'url', 'url_length', 'user', 'user_bunit', 'user_category', 'user_id', 'user_priority', 'vendor_product', 'version', 'vip_port', 'vlan', 'wait_state', 'wait_time', 'wifi', 'write_blocks', 'write_latency', 'write_ops', 'xdelay', 'xref']
-    
-    for field in default_fields:
-        Field.objects.create(key=field)
-        
-except Exception as e:
-    logger.warn("Failed to populate default fields.")
-    logger.warn(e)
\ No newline at end of file
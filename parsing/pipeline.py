@@ -0,0 +1,558 @@
+from collections import defaultdict
+from datetime import datetime
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from eventlet import queue, tpool
+from parsing.archive import ArchiveWriter
+from parsing.clustering import TemplateTracker, is_unparsed
+from time import time
+
+import eventlet
+import json
+import logging
+import os
+import re
+import socket
+
+# Same token format rsyslog enforces on ingest (UUID4 + app suffix)
+TOKEN_REGEX = re.compile('([a-fA-F0-9]{8}-[a-fA-F0-9]{4}-4[a-fA-F0-9]{3}-[89aAbB][a-fA-F0-9]{3}-[a-fA-F0-9]{12}@P4R4GN)')
+
+# RFC3164-ish header: <PRI>Mmm dd hh:mm:ss host tag[pid]: message
+HEADER_REGEX = re.compile('^(?:<(?P<pri>\d{1,3})>)?(?:(?P<ts>[A-Z][a-z]{2} [ \d]\d \d{2}:\d{2}:\d{2}) (?P<host>\S+) )?(?P<tag>[^\s:\[]+)(?:\[\d+\])?: ?(?P<msg>.*)$', re.S)
+
+FACILITIES = ('kern', 'user', 'mail', 'daemon', 'auth', 'syslog', 'lpr', 'news', 'uucp', 'cron', 'authpriv', 'ftp', 'ntp', 'audit', 'alert', 'clock', 'local0', 'local1', 'local2', 'local3', 'local4', 'local5', 'local6', 'local7')
+SEVERITIES = ('emerg', 'alert', 'crit', 'err', 'warning', 'notice', 'info', 'debug')
+
+
+def parse_header(line):
+    """
+    Splits a raw syslog line into its header attributes and message body.
+    
+    Lines without a recognizable header are treated as a bare message.
+    
+    Args:
+        line (str): Raw line as received from the wire.
+    
+    Returns:
+        header (dict): Keys are pri, ts, host, tag and msg; missing parts are
+            empty strings.
+    
+    """
+    match = HEADER_REGEX.match(line)
+    if not match:
+        return {'pri': '', 'ts': '', 'host': '', 'tag': '', 'msg': line}
+    return {k: v or '' for k,v in match.groupdict().items()}
+
+
+def format_header(record):
+    """
+    Rebuilds a raw syslog line from a ParagunJSON record, so parse_header()
+    gives back its process and message (e.g. to store it as a Sample).
+    
+    Args:
+        record (dict): Record with at least process and msg.
+    
+    Returns:
+        line (str): `Mmm dd hh:mm:ss host tag: msg`, or `tag: msg` if the
+            record has no usable timestamp or host.
+    
+    """
+    line = '%s: %s' % (record['process'], record['msg'])
+    
+    try: reported = parse_datetime(record.get('timestamp') or '')
+    except ValueError: reported = None
+    host = record.get('host') or ''
+    if reported and host and not re.search('\s', host):
+        line = '%s %2d %s %s %s' % (reported.strftime('%b'), reported.day, reported.strftime('%H:%M:%S'), host, line)
+    
+    return line
+
+
+def rfc3339(timestamp):
+    """
+    Formats a UNIX timestamp the way rsyslog's `dateFormat="rfc3339"` does.
+    
+    """
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat()
+
+
+class Stage(object):
+    """
+    A single step of the ingest pipeline.
+    
+    Each stage owns a bounded inbox; items are pulled off in batches of up to
+    `batch_size`, waiting no longer than `linger` seconds for a batch to fill,
+    handed to `process()` and whatever it returns is pushed to the next
+    stage's inbox. Because every inbox is bounded, a slow stage blocks the
+    ones before it instead of letting memory grow.
+    
+    """
+    def __init__(self, *args, **kwargs):
+        """
+        Kwargs:
+            queue_size (int): Maximum number of items waiting in the inbox.
+            batch_size (int): Maximum number of items processed at once.
+            linger (float): Seconds to wait for a batch to fill up.
+        
+        """
+        self.name = kwargs.get('name', self.__class__.__name__)
+        self.queue_size = kwargs.get('queue_size', settings.PIPELINE_QUEUE_SIZE)
+        self.batch_size = kwargs.get('batch_size', settings.PIPELINE_BATCH_SIZE)
+        self.linger = kwargs.get('linger', settings.PIPELINE_LINGER)
+        
+        self.inbox = queue.LightQueue(self.queue_size)
+        self.downstream = None
+        
+        self.started = time()
+        self.counters = {
+            'received': 0,
+            'emitted': 0,
+            'dropped': 0,
+            'errors': 0,
+            'batches': 0,
+        }
+    
+    def __str__(self):
+        return self.name
+    
+    def batch(self):
+        """
+        Blocks until at least one item is available, then collects more until
+        the batch is full or the linger time runs out.
+        
+        Returns:
+            items (list): Between 1 and `batch_size` items.
+        
+        """
+        items = [self.inbox.get()]
+        deadline = time() + self.linger
+        
+        while len(items) < self.batch_size:
+            # Take whatever is already waiting without yielding
+            try:
+                items.append(self.inbox.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            
+            remaining = deadline - time()
+            if remaining <= 0: break
+            
+            try: items.append(self.inbox.get(timeout=remaining))
+            except queue.Empty: break
+        
+        return items
+    
+    def process(self, items):
+        """
+        Does the actual work of the stage. Override this.
+        
+        Args:
+            items (list): Batch of items pulled from the inbox.
+        
+        Returns:
+            items (list): Items to pass on to the next stage.
+        
+        """
+        return items
+    
+    def run(self):
+        """
+        Stage event loop; runs until the greenthread is killed.
+        
+        """
+        logger = logging.getLogger(__name__)
+        
+        while True:
+            items = self.batch()
+            self.counters['received'] += len(items)
+            self.counters['batches'] += 1
+            
+            try:
+                results = self.process(items)
+            except Exception as e:
+                logger.error("%s failed processing a batch of %s items." % (self, len(items)))
+                logger.error(e, exc_info=True)
+                self.counters['errors'] += len(items)
+                continue
+            
+            self.counters['dropped'] += len(items) - len(results)
+            
+            if self.downstream:
+                for result in results:
+                    self.downstream.inbox.put(result)
+            
+            self.counters['emitted'] += len(results)
+    
+    def tick(self):
+        """
+        Called about once a second while the pipeline runs, for stages with
+        periodic housekeeping. Override this.
+        
+        """
+        pass
+    
+    def close(self):
+        """
+        Called once the pipeline has stopped. Override this to release
+        resources or write out anything still buffered.
+        
+        """
+        pass
+    
+    def throughput(self):
+        """
+        Returns:
+            stats (dict): Counters, current queue depth and events per second
+                since the stage started.
+        
+        """
+        elapsed = max(time() - self.started, 1e-6)
+        stats = dict(self.counters)
+        stats['queued'] = self.inbox.qsize()
+        stats['eps'] = round(self.counters['emitted'] / elapsed, 2)
+        return stats
+
+
+class ParseStage(Stage):
+    """
+    Turns raw lines into ParagunJSON-shaped records, mirroring what the
+    rsyslog `pipeline-in` ruleset does before and after calling rsysparse.
+    
+    """
+    def __init__(self, engine, *args, **kwargs):
+        """
+        Args:
+            engine (ParsingEngine): Engine used to extract fields.
+        
+        Kwargs:
+            refresh (int): How often (in seconds) to reload the list of valid
+                tokens.
+            tokens (iterable): Fixed set of valid tokens to use instead of
+                querying the database.
+            yield_every (int): Records to build or parse between yields to
+                the hub, so the listener keeps reading sockets while a batch
+                is worked on.
+        
+        """
+        super().__init__(*args, **kwargs)
+        self.engine = engine
+        self.node = kwargs.get('node', socket.gethostname())
+        self.refresh = kwargs.get('refresh', 300)
+        self.yield_every = kwargs.get('yield_every', settings.PIPELINE_YIELD_EVERY)
+        self.counters['rejected'] = 0
+        self.counters['unparsed'] = 0
+        
+        # Public addresses found, and distinct ones looked up (see parse_batch)
+        self.counters['geoip_requested'] = 0
+        self.counters['geoip_lookups'] = 0
+        
+        # Most frequent signatures among events no parser matched
+        self.templates = TemplateTracker(settings.TEMPLATE_CAPACITY)
+        
+        self._tokens = None
+        self._tokens_loaded = 0
+        
+        if kwargs.get('tokens') is not None:
+            self._tokens = set(str(x).lower() for x in kwargs['tokens'])
+            self._tokens_loaded = float('inf')
+    
+    @property
+    def tokens(self):
+        """
+        Set of currently valid token strings, cached for `refresh` seconds.
+        
+        Only the first load happens here; tick() refreshes the set after
+        that, without blocking the parsing greenthread.
+        
+        """
+        if self._tokens is None:
+            self._tokens = self.load_tokens()
+            self._tokens_loaded = time()
+        return self._tokens
+    
+    @staticmethod
+    def load_tokens():
+        from common.models import Token
+        return set(str(x).lower() for x in Token.objects.filter(enabled=True, expires__gt=timezone.now()).values_list('id', flat=True))
+    
+    def tick(self):
+        """
+        Reloads the valid tokens once they are `refresh` seconds old.
+        
+        """
+        if self._tokens is None or time() - self._tokens_loaded <= self.refresh: return
+        
+        # Nothing monkey patches the database driver, so the query runs in a
+        # native thread; batches keep being parsed against the old set
+        try:
+            self._tokens = tpool.execute(self.load_tokens)
+        except Exception as e:
+            logging.getLogger(__name__).error('Could not refresh tokens: %s' % e)
+        self._tokens_loaded = time()
+    
+    def build(self, obj):
+        """
+        Builds a single record from an item placed on the outbox by
+        `Service.handle()`.
+        
+        Returns:
+            record (dict): Record in ParagunJSON field order, or None if the
+                message did not carry a valid token.
+        
+        """
+        header = parse_header(obj['msg'])
+        body = header['msg']
+        
+        # Check for token; reject if none found or not valid
+        match = TOKEN_REGEX.search(body)
+        if not match: return None
+        token_raw = match.group(1)
+        token = token_raw.replace('@P4R4GN', '').lower()
+        if token not in self.tokens: return None
+        
+        received = obj.get('received', time())
+        timestamp = received
+        if header['ts']:
+            try:
+                reported = datetime.strptime('%s %s' % (datetime.utcfromtimestamp(received).year, header['ts']), '%Y %b %d %H:%M:%S')
+                timestamp = reported.replace(tzinfo=timezone.utc).timestamp()
+            except ValueError:
+                pass
+        
+        facility = severity = ''
+        if header['pri']:
+            pri = int(header['pri'])
+            if pri // 8 < len(FACILITIES): facility = FACILITIES[pri // 8]
+            severity = SEVERITIES[pri % 8]
+        
+        host_ip = obj.get('host_ip', '').strip().lower()
+        
+        return {
+            'timestamp': rfc3339(timestamp),
+            'timestamp_rec': rfc3339(received),
+            'node': self.node,
+            'protocol': 'native',
+            'host': header['host'].strip().lower() or host_ip,
+            'host_dns': host_ip,
+            'host_ip': host_ip,
+            'process': header['tag'].strip().lower().replace(' ', '-'),
+            'facility': facility,
+            'severity': severity,
+            'msg': body.replace(token_raw, '').strip(),
+            'msg_bytes': str(len(body)),
+            'token': token,
+            'data': {},
+        }
+    
+    def process(self, items):
+        logger = logging.getLogger(__name__)
+        records = []
+        
+        for i, obj in enumerate(items, 1):
+            record = self.build(obj)
+            if i % self.yield_every == 0: eventlet.sleep(0)
+            if not record:
+                self.counters['rejected'] += 1
+                continue
+            records.append(record)
+        
+        # Parse the whole batch at once, so each distinct public address in it
+        # is only geolocated once
+        parsable = [x for x in records if x['process'] and x['msg']]
+        try:
+            parsed = self.engine.parse_batch([(x['process'], x['msg']) for x in parsable], counters=self.counters, pause=eventlet.sleep, pause_every=self.yield_every)
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            parsed = [{} for x in parsable]
+        
+        for record, data in zip(parsable, parsed):
+            record['data'] = data
+            if is_unparsed(data) and 'punct' in data:
+                self.counters['unparsed'] += 1
+                self.templates.add(record['process'], data['punct'], record['msg'])
+        
+        return records
+    
+    def throughput(self):
+        stats = super().throughput()
+        stats['templates'] = self.templates.summary()
+        
+        # How many events share each lookup
+        lookups = self.counters['geoip_lookups']
+        stats['geoip_dedup'] = round(self.counters['geoip_requested'] / lookups, 2) if lookups else None
+        return stats
+
+
+class WriteStage(Stage):
+    """
+    Appends records to per-token log files using the same naming scheme and
+    line layout as the rsyslog `ParagunTemplate`/`ParagunJSON` templates.
+    
+    When archiving, records go straight to block-compressed, indexed
+    archives (see parsing.archive) named `<token>_<node>-<date>.log.gz`,
+    one per UTC day, instead of plain logs that logrotate has to read back
+    and compress.
+    
+    """
+    def __init__(self, *args, **kwargs):
+        """
+        Kwargs:
+            path (str): Directory to write log files to.
+            archive (bool): Write compressed archives instead of plain logs.
+                Defaults to ARCHIVE_OUTPUT.
+        
+        """
+        super().__init__(*args, **kwargs)
+        self.path = kwargs.get('path', settings.OUTPUT_DIR)
+        self.archive = kwargs.get('archive', settings.ARCHIVE_OUTPUT)
+        self.writers = {}
+        self.counters['bytes'] = 0
+        self.counters['compressed'] = 0
+    
+    @staticmethod
+    def serialize(record):
+        """
+        Renders a record as a single ParagunJSON line.
+        
+        rsyslog lowercases the whole `data` property, so we do the same.
+        
+        """
+        data = json.dumps(record['data'], separators=(',', ':')).lower()
+        fields = json.dumps({k: v for k,v in record.items() if k != 'data'}, separators=(',', ':'))
+        return '%s,"data":%s}\n' % (fields[:-1], data)
+    
+    def filename(self, record, date=None):
+        if self.archive:
+            date = date or datetime.utcnow().strftime('%Y-%m-%d')
+            return os.path.join(self.path, '%s_%s-%s.log.gz' % (record['token'], record['node'], date))
+        return os.path.join(self.path, '%s_%s.log' % (record['token'], record['node']))
+    
+    def process(self, items):
+        # Group records by destination so each file is opened once per batch
+        date = datetime.utcnow().strftime('%Y-%m-%d')
+        files = defaultdict(list)
+        for record in items:
+            files[self.filename(record, date)].append(self.serialize(record))
+        
+        for filename, lines in files.items():
+            self.counters['bytes'] += sum(len(x) for x in lines)
+            
+            if self.archive:
+                writer = self.writers.get(filename)
+                if writer is None:
+                    writer = self.writers[filename] = ArchiveWriter(filename)
+                self.counters['compressed'] += writer.write(lines)
+                continue
+            
+            with open(filename, 'a') as f:
+                f.write(''.join(lines))
+        
+        return items
+    
+    def tick(self):
+        """
+        Writes out archive blocks that have lingered long enough, and closes
+        archives from previous days.
+        
+        """
+        suffix = '-%s.log.gz' % datetime.utcnow().strftime('%Y-%m-%d')
+        for filename, writer in list(self.writers.items()):
+            if not filename.endswith(suffix):
+                self.counters['compressed'] += writer.close()
+                del self.writers[filename]
+            elif writer.lines and time() - writer.pending_since >= writer.linger:
+                self.counters['compressed'] += writer.flush()
+    
+    def close(self):
+        for writer in self.writers.values():
+            self.counters['compressed'] += writer.close()
+        self.writers = {}
+
+
+class Pipeline(object):
+    """
+    Chains the parse and write stages behind a single bounded inbox.
+    
+    """
+    def __init__(self, engine=None, *args, **kwargs):
+        """
+        Args:
+            engine (ParsingEngine): Engine to parse with. Built from the
+                current parser map if not provided.
+        
+        Kwargs:
+            Passed through to each stage (queue_size, batch_size, linger).
+        
+        """
+        if engine is None:
+            from parsing.engine import get_engine
+            engine = get_engine()
+        
+        self.parser = ParseStage(engine, **kwargs)
+        self.writer = WriteStage(**kwargs)
+        self.parser.downstream = self.writer
+        
+        self.stages = (self.parser, self.writer)
+        self._threads = []
+    
+    @property
+    def inbox(self):
+        return self.parser.inbox
+    
+    def start(self):
+        """
+        Spawns a greenthread for each stage.
+        
+        """
+        self._threads = [eventlet.spawn(stage.run) for stage in self.stages]
+        self._threads.append(eventlet.spawn(self.tick))
+    
+    def tick(self):
+        while True:
+            eventlet.sleep(1)
+            for stage in self.stages:
+                stage.tick()
+    
+    @property
+    def idle(self):
+        """
+        True once every item received has left every stage.
+        
+        """
+        for stage in self.stages:
+            counters = stage.counters
+            if stage.inbox.qsize(): return False
+            if counters['received'] != counters['emitted'] + counters['dropped'] + counters['errors']: return False
+        return True
+    
+    def drain(self, timeout=30):
+        """
+        Waits (cooperatively) for queued items to make it through the pipeline.
+        
+        Returns:
+            drained (bool): Whether the pipeline emptied within the timeout.
+        
+        """
+        deadline = time() + timeout
+        while time() < deadline:
+            if self.idle: return True
+            eventlet.sleep(0.05)
+        return self.idle
+    
+    def stop(self):
+        for thread in self._threads:
+            thread.kill()
+        self._threads = []
+        
+        for stage in self.stages:
+            stage.close()
+    
+    def throughput(self):
+        """
+        Returns:
+            stats (dict): Throughput counters keyed by stage name.
+        
+        """
+        return {str(stage): stage.throughput() for stage in self.stages}
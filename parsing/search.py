@@ -0,0 +1,338 @@
+from django.conf import settings
+from parsing.archive import Block, epoch, read_block, read_index
+
+import base64
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import math
+import os
+
+INDEX_VERSION = 1
+
+
+class Bloom(object):
+    """
+    Bloom filter over strings, using double hashing of a single blake2b
+    digest to derive its k bit positions.
+    
+    """
+    def __init__(self, capacity=1000, error=0.01, bits=None, hashes=None, *args, **kwargs):
+        capacity = max(capacity, 1)
+        self.size = bits or max(64, int(-capacity * math.log(error) / math.log(2) ** 2))
+        self.hashes = hashes or max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+    
+    def positions(self, value):
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        a = int.from_bytes(digest[:8], 'little')
+        b = int.from_bytes(digest[8:], 'little') | 1
+        return ((a + i * b) % self.size for i in range(self.hashes))
+    
+    def add(self, value):
+        for position in self.positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+    
+    def __contains__(self, value):
+        return all(self.bits[x >> 3] & (1 << (x & 7)) for x in self.positions(value))
+    
+    def dumps(self):
+        return {'m': self.size, 'k': self.hashes, 'bits': base64.b64encode(bytes(self.bits)).decode('ascii')}
+    
+    @classmethod
+    def loads(cls, obj):
+        bloom = cls(bits=obj['m'], hashes=obj['k'])
+        bloom.bits = bytearray(base64.b64decode(obj['bits']))
+        return bloom
+
+
+def terms(record):
+    """
+    Returns:
+        terms (set): `field=value` strings for the record's parsed data
+            (lowercased, as rsyslog writes it), plus its host and process.
+    
+    """
+    found = set()
+    data = record.get('data')
+    if isinstance(data, dict):
+        for key, value in data.items():
+            found.add(('%s=%s' % (key, value)).lower())
+    for key in ('host', 'host_ip', 'process'):
+        if record.get(key):
+            found.add(('%s=%s' % (key, record[key])).lower())
+    return found
+
+
+def index_path(path):
+    return path + '.sidx'
+
+
+def kind(path):
+    """
+    How blocks of a log file are read:
+    
+    * archive: block-compressed archive with its own .idx (see
+      parsing.archive); blocks are seeked to and decompressed on their own.
+    * raw: plain log; blocks are byte ranges.
+    * stream: gzipped as a single stream, as logrotate does; blocks are
+      ranges of the uncompressed data, so reaching one means decompressing
+      (but not parsing) everything before it.
+    
+    """
+    if not path.endswith('.gz'): return 'raw'
+    if os.path.exists(path + '.idx'): return 'archive'
+    return 'stream'
+
+
+def summarize(lines):
+    """
+    Returns:
+        block (dict): Record count, time span and bloom filter of the terms
+            of a block of ParagunJSON lines.
+    
+    """
+    records = []
+    for line in lines:
+        try: records.append(json.loads(line))
+        except ValueError: continue
+    
+    found = set()
+    first = last = None
+    for record in records:
+        found |= terms(record)
+        ts = epoch(record.get('timestamp'))
+        if ts is None: continue
+        first = ts if first is None else min(first, ts)
+        last = ts if last is None else max(last, ts)
+    
+    bloom = Bloom(len(found) or 1, settings.SEARCH_BLOOM_ERROR)
+    for term in found:
+        bloom.add(term)
+    
+    return {
+        'records': len(records),
+        'start': math.floor(first) if first is not None else 0,
+        'end': math.ceil(last) if last is not None else 0,
+        'bloom': bloom.dumps(),
+    }
+
+
+def blocks(path, kind, offset=0, block_size=None):
+    """
+    Splits a log file into blocks to index, starting at `offset`.
+    
+    Yields:
+        (offset, length, lines) for each block.
+    
+    """
+    block_size = block_size or settings.ARCHIVE_BLOCK_SIZE
+    
+    if kind == 'archive':
+        with open(path, 'rb') as f:
+            for block in read_index(path):
+                if block.offset < offset: continue
+                yield block.offset, block.length, read_block(path, block, f)
+        return
+    
+    opener = gzip.open if kind == 'stream' else open
+    with opener(path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            lines = []
+            start = offset
+            for line in f:
+                lines.append(line)
+                offset += len(line)
+                if len(lines) >= block_size: break
+            
+            # Leave a partially written last line of a live log for next time
+            if lines and not lines[-1].endswith(b'\n'):
+                offset -= len(lines.pop())
+            
+            if not lines: return
+            yield start, offset - start, [x.decode('utf-8', 'replace') for x in lines]
+            if len(lines) < block_size: return
+
+
+def build_index(path, block_size=None):
+    """
+    Builds or brings up to date the search index of a log file, stored
+    next to it as `<file>.sidx`.
+    
+    Plain logs that have only grown are indexed incrementally; the last
+    block is redone if it was partial. Anything else that changed is
+    reindexed from scratch.
+    
+    Returns:
+        index (dict): The index.
+    
+    """
+    logger = logging.getLogger(__name__)
+    size = os.path.getsize(path)
+    mode = kind(path)
+    
+    index = load_index(path)
+    if index and index['size'] == size:
+        return index
+    
+    offset = 0
+    existing = []
+    block_size = block_size or settings.ARCHIVE_BLOCK_SIZE
+    if index and mode in ('raw', 'archive') and index['kind'] == mode and index['size'] < size:
+        existing = index['blocks']
+        if mode == 'raw' and existing and existing[-1]['records'] < block_size:
+            existing = existing[:-1]
+        if existing:
+            offset = existing[-1]['offset'] + existing[-1]['length']
+    
+    logger.debug('Indexing %s from offset %s.' % (path, offset))
+    for start, length, lines in blocks(path, mode, offset, block_size):
+        block = summarize(lines)
+        block.update({'offset': start, 'length': length})
+        existing.append(block)
+    
+    index = {'version': INDEX_VERSION, 'kind': mode, 'size': size, 'blocks': existing}
+    with open(index_path(path) + '.tmp', 'w') as f:
+        json.dump(index, f, separators=(',', ':'))
+    os.replace(index_path(path) + '.tmp', index_path(path))
+    return index
+
+
+def load_index(path):
+    try:
+        with open(index_path(path), 'r') as f:
+            index = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if index.get('version') != INDEX_VERSION: return None
+    return index
+
+
+def current_index(path):
+    """
+    Returns:
+        index (dict): The search index of a log file, without building or
+            updating anything; an index of a plain log or archive that has
+            since grown still covers what it indexed. None if the file has
+            no index, or it no longer matches the file.
+    
+    """
+    index = load_index(path)
+    if index is None: return None
+    
+    size = os.path.getsize(path)
+    if index['size'] == size: return index
+    if index['kind'] in ('raw', 'archive') and index['kind'] == kind(path) and index['size'] < size: return index
+    return None
+
+
+def token_files(token, path=None):
+    """
+    Returns:
+        paths (list): Logs (current, rotated and archived) of a token.
+    
+    """
+    path = path or settings.OUTPUT_DIR
+    found = glob.glob(os.path.join(path, '%s_*.log*' % str(token).lower()))
+    return sorted(x for x in found if not x.endswith(('.idx', '.sidx', '.tmp')))
+
+
+def read_lines(path, index, wanted):
+    """
+    Reads the lines of the selected blocks of a log file.
+    
+    """
+    mode = index['kind']
+    if mode == 'archive':
+        with open(path, 'rb') as f:
+            for block in wanted:
+                for line in read_block(path, Block(block['offset'], block['length'], block['records'], block['start'], block['end']), f):
+                    yield line
+        return
+    
+    opener = gzip.open if mode == 'stream' else open
+    with opener(path, 'rb') as f:
+        for block in wanted:
+            f.seek(block['offset'])
+            for line in f.read(block['length']).decode('utf-8', 'replace').splitlines():
+                yield line
+
+
+def search(token, start=None, end=None, where=None, limit=100, path=None, stats=None, build=True):
+    """
+    Finds records sent under a token, optionally within a time range and
+    matching field=value conditions.
+    
+    Only blocks whose time span overlaps the range and whose bloom filter
+    may contain every condition are read and decoded.
+    
+    Args:
+        token (str): Token whose logs to search.
+    
+    Kwargs:
+        start (float): Earliest timestamp, as UNIX time.
+        end (float): Latest timestamp, as UNIX time.
+        where (dict): Field -> value conditions, matched against parsed
+            `data` fields and the host, host_ip and process of each record.
+        limit (int): Maximum number of records to return.
+        path (str): Directory holding the logs. Defaults to OUTPUT_DIR.
+        stats (dict): If given, filled in with files, blocks, blocks_read
+            and unindexed.
+        build (bool): Build or update the index of every file searched. If
+            not, only what is already indexed (see current_index()) is
+            searched, and files without an index are skipped and counted as
+            unindexed.
+    
+    Returns:
+        records (list): Matching records, oldest file first.
+    
+    """
+    logger = logging.getLogger(__name__)
+    wanted_terms = [('%s=%s' % (k, v)).lower() for k,v in (where or {}).items()]
+    stats = stats if stats is not None else {}
+    stats.update({'files': 0, 'blocks': 0, 'blocks_read': 0, 'unindexed': 0})
+    
+    results = []
+    for filename in token_files(token, path):
+        try:
+            index = build_index(filename) if build else current_index(filename)
+        except (OSError, EOFError) as e:
+            logger.error('Could not index %s: %s' % (filename, e))
+            continue
+        
+        if index is None:
+            stats['unindexed'] += 1
+            continue
+        
+        stats['files'] += 1
+        stats['blocks'] += len(index['blocks'])
+        
+        wanted = []
+        for block in index['blocks']:
+            if start is not None and block['end'] and block['end'] < start: continue
+            if end is not None and block['start'] and block['start'] > end: continue
+            if wanted_terms:
+                bloom = Bloom.loads(block['bloom'])
+                if not all(x in bloom for x in wanted_terms): continue
+            wanted.append(block)
+        
+        stats['blocks_read'] += len(wanted)
+        for line in read_lines(filename, index, wanted):
+            try: record = json.loads(line)
+            except ValueError: continue
+            
+            if start is not None or end is not None:
+                ts = epoch(record.get('timestamp'))
+                if ts is None: continue
+                if start is not None and ts < start: continue
+                if end is not None and ts > end: continue
+            
+            if wanted_terms and not set(wanted_terms) <= terms(record): continue
+            
+            results.append(record)
+            if len(results) >= limit: return results
+    
+    return results
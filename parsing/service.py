@@ -1,7 +1,15 @@
 from django.conf import settings
+from django.db import connections
+from parsing.engine import get_module
+from parsing.pipeline import Pipeline
+from time import sleep, time
+
 import eventlet
+import json
 import logging
-import re
+import os
+import signal
+import socket
 
 
 class Service(object):
@@ -16,21 +24,39 @@ class Service(object):
         Kwargs:
             interface (str): IP address of interface to listen to.
             port (str): TCP port to listen on.
+            reuse_port (bool): Bind with SO_REUSEPORT so several processes
+                can share the same interface and port (eventlet enables it
+                by default where supported).
+            stats_port (int): If set, serve throughput stats as JSON on this
+                port (on STATS_INTERFACE).
+            pipeline (Pipeline): Consumer pipeline for the outbox. Any other
+                kwargs are passed to the default Pipeline (queue_size,
+                batch_size, linger).
             
         """
         logger = logging.getLogger(__name__)
         
         # Get interface
-        interface = kwargs.get('interface', self.interface)
+        self.interface = kwargs.pop('interface', self.interface)
         
         # Get port
-        port = kwargs.get('port', self.port)
+        self.port = kwargs.pop('port', self.port)
         
         logger.info("Starting service; listening to %s:%s..." % (self.interface, self.port))
         
-        self._server = eventlet.listen((self.interface, self.port))
+        reuse_port = kwargs.pop('reuse_port', None)
+        self.stats_port = kwargs.pop('stats_port', None)
+        
+        self._server = eventlet.listen((self.interface, self.port), reuse_port=reuse_port)
         self._pool = eventlet.GreenPool()
-        self.outbox = eventlet.queue.LightQueue()
+        self.running = False
+        self.started = time()
+        self.connections = 0
+        self.profiler = get_module().Profiler('service', settings.PROFILE_DIR, settings.PROFILE_INTERVAL, settings.PROFILE_DURATION)
+        
+        # Outbox is the bounded inbox of the parse/write pipeline
+        self.pipeline = kwargs.pop('pipeline', None) or Pipeline(**kwargs)
+        self.outbox = self.pipeline.inbox
         
         logger.info("...service started.")
         
@@ -44,25 +70,109 @@ class Service(object):
         logger = logging.getLogger(__name__)
         logger.info("Waiting for messages... (%s:%s)" % (self.interface, self.port))
         
+        # Start consuming the outbox
+        self.pipeline.start()
+        
+        # Start serving stats, if requested
+        if self.stats_port:
+            eventlet.spawn_n(self.serve_stats)
+        
+        # Stop gracefully on SIGTERM; the accept timeout lets us notice
+        signal.signal(signal.SIGTERM, self.shutdown)
+        self._server.settimeout(1)
+        self.running = True
+        
+        # Profile on SIGUSR2 or when the trigger file is touched
+        self.profiler.install()
+        
         # Start event loop
-        while True:
+        while self.running:
+            self.profiler.poll()
             try:
                 # Get raw socket data and sender address
                 new_sock, address = self._server.accept()
+                self.connections += 1
                 
                 # Handle the socket data
-                self._pool.spawn_n(self.handle, new_sock.makefile('r'))
+                self._pool.spawn_n(self.handle, new_sock.makefile('r'), address)
                 
+            except socket.timeout:
+                continue
+            
             except (SystemExit, KeyboardInterrupt):
                 break
             
+        # Stop accepting, let open connections finish and flush what's queued
+        self._server.close()
+        with eventlet.Timeout(settings.SHUTDOWN_TIMEOUT, False):
+            self._pool.waitall()
+        if not self.pipeline.drain(settings.SHUTDOWN_TIMEOUT):
+            logger.warning("Pipeline did not drain before shutdown; queued events were lost.")
+        self.pipeline.stop()
+        self.profiler.stop()
         logger.info("Listener for %s:%s stopped." % (self.interface, self.port))
+    
+    
+    def shutdown(self, *args, **kwargs):
+        """
+        Signal handler; asks the event loop to stop after the current accept.
         
+        """
+        self.running = False
+    
+    
+    def stats(self):
+        """
+        Returns:
+            stats (dict): Process-level counters plus per-stage pipeline
+                throughput.
         
-    def handle(self, fd):
+        """
+        return {
+            'pid': os.getpid(),
+            'interface': self.interface,
+            'port': self.port,
+            'uptime': round(time() - self.started, 2),
+            'connections': self.connections,
+            'active': self._pool.running(),
+            'profiling': self.profiler.active,
+            'pipeline': self.pipeline.throughput(),
+        }
+    
+    
+    def serve_stats(self):
+        """
+        Minimal HTTP endpoint that answers every request with `stats()` as
+        JSON, i.e. `curl localhost:<stats_port>`.
+        
+        """
+        logger = logging.getLogger(__name__)
+        server = eventlet.listen((settings.STATS_INTERFACE, self.stats_port))
+        logger.info("Serving stats on %s:%s." % (settings.STATS_INTERFACE, self.stats_port))
+        
+        while True:
+            sock, address = server.accept()
+            try:
+                sock.recv(1024)
+                body = json.dumps(self.stats()).encode('utf-8')
+                sock.sendall(b'HTTP/1.0 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n' % len(body) + body)
+            except Exception as e:
+                logger.error(e)
+            finally:
+                sock.close()
+        
+        
+    def handle(self, fd, address=None):
         """
         Where the magic happens. Performs actions on incoming messages.
         
+        Putting onto the outbox blocks when the pipeline is full, which stops
+        us reading from the socket and pushes back on the sender.
+        
+        Args:
+            fd (file): File-like object wrapping the client socket.
+            address (tuple): (host, port) of the sender.
+        
         """
         logger = logging.getLogger(__name__)
         
@@ -77,10 +187,125 @@ class Service(object):
             #obj = self.parse(msg)
             obj = {
                 'msg': msg,
-                'pattern': ''.join(re.findall('([^a-zA-Z0-9\s]+)', msg))
+                'host_ip': address[0] if address else '',
+                'received': time(),
             }
             
             # Add it to queue
             self.outbox.put(obj)
             
-            logger.info(obj)
\ No newline at end of file
+            logger.debug(obj)
+
+
+class Supervisor(object):
+    """
+    Forks a number of Service workers that all bind the same interface and
+    port with SO_REUSEPORT, letting the kernel spread connections across
+    them (and across cores).
+    
+    Workers that die unexpectedly are restarted; SIGTERM/SIGINT are passed on
+    to the workers, which drain their pipelines before exiting, and SIGUSR2
+    is passed on so every worker profiles itself.
+    
+    """
+    def __init__(self, workers=None, **kwargs):
+        """
+        Args:
+            workers (int): Number of worker processes. Defaults to the number
+                of CPUs.
+        
+        Kwargs:
+            stats_port (int): Base stats port; each worker serves its stats
+                on this port plus its slot number. Defaults to STATS_PORT.
+            
+            Anything else is passed to each worker's Service.
+        
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.stats_port = kwargs.pop('stats_port', settings.STATS_PORT)
+        self.kwargs = kwargs
+        self.children = {}
+        self.running = False
+    
+    def spawn(self, slot):
+        """
+        Forks a single worker for the given slot.
+        
+        Returns:
+            pid (int): Process ID of the new worker.
+        
+        """
+        pid = os.fork()
+        if pid:
+            self.children[pid] = (slot, time())
+            return pid
+        
+        # In the child from here on; never share the parent's DB connections
+        logger = logging.getLogger(__name__)
+        connections.close_all()
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+        status = 0
+        try:
+            Service(reuse_port=True, stats_port=self.stats_port + slot, **self.kwargs).listen()
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            status = 1
+        finally:
+            os._exit(status)
+    
+    def stop(self, *args, **kwargs):
+        """
+        Signal handler; stops restarting workers and asks them to exit.
+        
+        """
+        self.running = False
+        for pid in self.children.keys():
+            try: os.kill(pid, signal.SIGTERM)
+            except OSError: pass
+    
+    def profile(self, *args, **kwargs):
+        """
+        Signal handler; asks every worker to profile itself.
+        
+        """
+        for pid in self.children.keys():
+            try: os.kill(pid, signal.SIGUSR2)
+            except OSError: pass
+    
+    def run(self):
+        """
+        Starts all workers and babysits them until told to stop.
+        
+        """
+        logger = logging.getLogger(__name__)
+        logger.info("Starting %s workers..." % self.workers)
+        
+        self.running = True
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGUSR2, self.profile)
+        
+        for slot in range(self.workers):
+            self.spawn(slot)
+        
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            
+            slot, started = self.children.pop(pid, (None, None))
+            if slot is None or not self.running:
+                continue
+            
+            logger.error("Worker %s (pid %s) exited with status %s; restarting." % (slot, pid, status))
+            
+            # Don't spin if the worker dies on startup
+            if time() - started < 1: sleep(1)
+            if self.running: self.spawn(slot)
+        
+        logger.info("All workers stopped.")
\ No newline at end of file
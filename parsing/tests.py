@@ -57,4 +57,413 @@ class ParsingTest(TestCase):
     def test_get_parser_map(self):
         from pprint import PrettyPrinter
         pp = PrettyPrinter(indent=4)
-        pp.pprint(Service.get_parser_map())
\ No newline at end of file
+        pp.pprint(Service.get_parser_map())
+    
+    def test_parser_map_families(self):
+        "With families on, services with samples should publish which fields each family can skip."
+        self.assertNotIn('_family_skip', Service.get_parser_map()['ssh'])
+        
+        Service.families_cache.clear()
+        Sample.objects.create(service=self.service, value='Aug  1 18:27:50 knight sshd[20325]: Connection closed by 218.49.183.17 port 48849 [preauth]')
+        mapping = Service.get_parser_map(families=True)
+        self.assertEqual(mapping['ssh']['_family_skip'], {'connection closed': ['src_ip', 'user']})
+        self.assertNotIn('_family_skip', mapping['ufw'])
+        
+        # Cached until the service's parsers change
+        self.service.samples.all().delete()
+        self.assertIn('_family_skip', Service.get_parser_map(families=True)['ssh'])
+        Parser.objects.create(enabled=True, service=self.service, field=Field.objects.get(key='user'), value='by ([a-z]+)', priority=110)
+        self.assertNotIn('_family_skip', Service.get_parser_map(families=True)['ssh'])
+    
+    def test_structured_messages(self):
+        "Known field keys of JSON and key=value messages should be read for any service."
+        from parsing.engine import get_module
+        
+        mapping = Service.get_parser_map()
+        self.assertEqual(mapping['_fields']['user'], {'type': 'str', 'validator': '(.*)'})
+        self.assertNotIn('_fields', Service.get_parser_map(fields=False))
+        
+        engine = get_module().ParsingEngine()
+        engine.load_parsers(mapping)
+        data = engine.parse('ssh', 'action=login user=bob msg="Failed password for illegal user test from 218.49.183.17"')
+        self.assertEqual((data['user'], data['src_ip']), ('bob', '218.49.183.17'))
+        data = engine.parse('web', '{"user": "alice", "http": {"method": "GET"}, "unknown": 1}')
+        self.assertEqual((data['user'], data['http_method']), ('alice', 'GET'))
+        self.assertNotIn('unknown', data)
+    
+    def test_validate(self):
+        "Validation should load everything up front and record every status."
+        sample = Sample.objects.create(service=self.service2, value='Aug  1 18:27:46 knight kernel: [UFW BLOCK] from 10.0.0.1 to 10.0.0.2')
+        sample.assertions.create(key=Field.objects.get(key='src_ip'), value='10.0.0.1')
+        sample.assertions.create(key=Field.objects.get(key='dst_ip'), value='10.0.0.3')
+        
+        # 4 queries to load, 2 updates each for samples and assertions, and
+        # the transaction's savepoint
+        with self.assertNumQueries(10):
+            results = Service.validate(processes=1)
+        self.assertEqual(results, {self.service.pk: True, self.service2.pk: False})
+        self.assertEqual(Service.validate(processes=2), results)
+        
+        self.assertFalse(Sample.objects.get(pk=sample.pk).status)
+        self.assertEqual(sorted(sample.assertions.values_list('key__key', 'status')), [('dst_ip', False), ('src_ip', True)])
+        self.assertTrue(self.service.test())
+
+class PipelineTest(TestCase):
+    
+    def setUp(self):
+        from common.models import Token
+        from django.contrib.auth import get_user_model
+        import tempfile
+        
+        user = get_user_model().objects.create_user('Chevy Chase', 'chevy@chase.com', 'chevyspassword')
+        self.token = Token.objects.create(id='3f125cd7-fd46-4e37-a88e-610db52c1562', user=user)
+        
+        service = Service.objects.create(key='sshd')
+        field = Field.objects.get_or_create(key='user')[0]
+        Parser.objects.create(enabled=True, service=service, field=field, value='user ([a-zA-Z0-9\.\-]+) from')
+        
+        self.path = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.path)
+    
+    def test_parse_header(self):
+        from parsing.pipeline import parse_header
+        
+        header = parse_header('<38>Aug  1 18:27:46 knight sshd[20325]: Failed password for illegal user test')
+        self.assertEqual(header['pri'], '38')
+        self.assertEqual(header['host'], 'knight')
+        self.assertEqual(header['tag'], 'sshd')
+        self.assertEqual(header['msg'], 'Failed password for illegal user test')
+        
+        header = parse_header('no header here')
+        self.assertEqual(header['tag'], '')
+        self.assertEqual(header['msg'], 'no header here')
+    
+    def test_soak(self):
+        "Sustained input through the pipeline should never exceed queue bounds."
+        from parsing.pipeline import Pipeline
+        import eventlet
+        import json
+        import os
+        
+        pipeline = Pipeline(path=self.path, queue_size=50, batch_size=20, linger=0.01, archive=False)
+        pipeline.start()
+        
+        total = 2000
+        peak = {'depth': 0}
+        
+        def produce():
+            for i in range(total):
+                pipeline.inbox.put({
+                    'msg': '<38>Aug  1 18:27:46 knight sshd[%s]: Failed password for illegal user test%s from 218.49.183.17 port 48849 ssh2 %s@P4R4GN' % (i, i, self.token.id),
+                    'host_ip': '218.49.183.17',
+                })
+                peak['depth'] = max(peak['depth'], *(stage.inbox.qsize() for stage in pipeline.stages))
+            # One message without a token, which must be rejected
+            pipeline.inbox.put({'msg': 'sshd[1]: no token here'})
+        
+        producer = eventlet.spawn(produce)
+        producer.wait()
+        
+        with eventlet.Timeout(10):
+            while pipeline.writer.counters['emitted'] < total:
+                eventlet.sleep(0.01)
+            while pipeline.parser.counters['rejected'] < 1:
+                eventlet.sleep(0.01)
+        pipeline.stop()
+        
+        self.assertLessEqual(peak['depth'], 50)
+        
+        stats = pipeline.throughput()
+        self.assertEqual(stats['ParseStage']['rejected'], 1)
+        self.assertEqual(stats['WriteStage']['errors'], 0)
+        
+        with open(os.path.join(self.path, '%s_%s.log' % (self.token.id, pipeline.parser.node))) as f:
+            lines = f.readlines()
+        self.assertEqual(len(lines), total)
+        
+        record = json.loads(lines[0])
+        self.assertEqual(list(record.keys()), ['timestamp', 'timestamp_rec', 'node', 'protocol', 'host', 'host_dns', 'host_ip', 'process', 'facility', 'severity', 'msg', 'msg_bytes', 'token', 'data'])
+        self.assertEqual(record['process'], 'sshd')
+        self.assertEqual(record['severity'], 'info')
+        self.assertEqual(record['data']['user'], 'test0')
+        self.assertNotIn('P4R4GN', record['msg'])
+    
+    def test_archive(self):
+        "Archives should be valid gzip files whose index allows reading single blocks."
+        from parsing.archive import ArchiveWriter, iter_lines, read_index, write_index
+        from parsing.pipeline import rfc3339
+        import gzip
+        import os
+        
+        path = os.path.join(self.path, 'test.log.gz')
+        lines = ['{"timestamp":"%s","msg":"event %s","data":{}}\n' % (rfc3339(1000000 + i), i) for i in range(2500)]
+        
+        writer = ArchiveWriter(path, block_size=1000, linger=3600)
+        writer.write(lines[:1500])
+        writer.write(lines[1500:])
+        self.assertEqual(len(read_index(path)), 2)
+        writer.close()
+        
+        blocks = read_index(path)
+        self.assertEqual([x.records for x in blocks], [1000, 1000, 500])
+        self.assertEqual((blocks[1].start, blocks[1].end), (1001000, 1001999))
+        
+        with gzip.open(path, 'rt') as f:
+            self.assertEqual(f.readlines(), lines)
+        
+        # Only the block covering the range should be read
+        found = list(iter_lines(path, start=1001500, end=1001510))
+        self.assertEqual(len(found), 1000)
+        self.assertIn('event 1500', found[500])
+        
+        # A block written but never indexed is recovered on reopen
+        write_index(path, blocks[:1], mode='w')
+        ArchiveWriter(path)
+        self.assertEqual(read_index(path), blocks)
+    
+    def test_archive_shared(self):
+        "Workers appending to the same archive should never leave its index pointing at the wrong bytes."
+        from parsing.archive import ArchiveWriter, read_index, scan
+        import multiprocessing
+        import os
+        
+        path = os.path.join(self.path, 'shared.log.gz')
+        def work(worker):
+            writer = ArchiveWriter(path, block_size=5, linger=3600)
+            for i in range(300):
+                writer.write(['{"timestamp":"2019-01-01T00:00:%02d.000000+00:00","msg":"worker %s event %s","data":{}}\n' % (i % 60, worker, i)])
+            writer.close()
+        
+        workers = [multiprocessing.Process(target=work, args=(x,)) for x in range(4)]
+        for x in workers: x.start()
+        for x in workers: x.join()
+        
+        self.assertEqual(read_index(path), scan(path))
+        self.assertEqual(sum(x.records for x in read_index(path)), 1200)
+    
+    def test_archive_pipeline(self):
+        "The write stage should archive records per token, node and day."
+        from parsing.pipeline import Pipeline
+        import eventlet
+        import glob
+        import gzip
+        import json
+        import os
+        
+        pipeline = Pipeline(path=self.path, batch_size=20, linger=0.01, archive=True)
+        pipeline.start()
+        for i in range(50):
+            pipeline.inbox.put({'msg': '<38>Aug  1 18:27:46 knight sshd[%s]: Failed password for illegal user test%s from 218.49.183.17 port 48849 ssh2 %s@P4R4GN' % (i, i, self.token.id)})
+        
+        with eventlet.Timeout(10):
+            while pipeline.writer.counters['emitted'] < 50:
+                eventlet.sleep(0.01)
+        pipeline.stop()
+        
+        paths = glob.glob(os.path.join(self.path, '%s_%s-*.log.gz' % (self.token.id, pipeline.parser.node)))
+        self.assertEqual(len(paths), 1)
+        with gzip.open(paths[0], 'rt') as f:
+            records = [json.loads(x) for x in f]
+        self.assertEqual(len(records), 50)
+        self.assertEqual(records[0]['data']['user'], 'test0')
+        self.assertGreater(pipeline.writer.counters['compressed'], 0)
+    
+    def test_parse_yields(self):
+        "The parse stage should let other greenthreads run while it works through a batch."
+        from parsing.pipeline import Pipeline
+        import eventlet
+        
+        pipeline = Pipeline(path=self.path, tokens=[self.token.id], yield_every=10)
+        items = [{'msg': '<38>Aug  1 18:27:46 knight sshd[%s]: Failed password for illegal user test%s from 10.0.0.1 port 48849 ssh2 %s@P4R4GN' % (i, i, self.token.id)} for i in range(100)]
+        
+        turns = []
+        def listener():
+            while True:
+                turns.append(1)
+                eventlet.sleep(0)
+        thread = eventlet.spawn(listener)
+        eventlet.sleep(0)
+        del turns[:]
+        
+        records = pipeline.parser.process(items)
+        thread.kill()
+        
+        self.assertEqual(len(records), 100)
+        self.assertEqual(records[-1]['data']['user'], 'test99')
+        self.assertGreaterEqual(len(turns), 19)
+    
+    def test_stats_endpoint(self):
+        "Each worker should report its pipeline throughput as JSON."
+        from parsing.pipeline import Pipeline
+        from parsing.service import Service
+        import eventlet
+        import json
+        import socket
+        
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        stats_port = sock.getsockname()[1]
+        sock.close()
+        
+        service = Service(interface='127.0.0.1', port=0, stats_port=stats_port, pipeline=Pipeline(path=self.path, tokens=[self.token.id]))
+        server = eventlet.spawn(service.serve_stats)
+        eventlet.sleep(0.1)
+        
+        client = eventlet.connect(('127.0.0.1', stats_port))
+        client.sendall(b'GET / HTTP/1.0\r\n\r\n')
+        response = b''
+        while True:
+            chunk = client.recv(4096)
+            if not chunk: break
+            response += chunk
+        server.kill()
+        service._server.close()
+        
+        stats = json.loads(response.split(b'\r\n\r\n', 1)[1].decode('utf-8'))
+        self.assertEqual(stats['connections'], 0)
+        self.assertFalse(stats['profiling'])
+        self.assertIn('ParseStage', stats['pipeline'])
+        self.assertIn('eps', stats['pipeline']['WriteStage'])
+
+
+class ClusteringTest(TestCase):
+    
+    def test_heavy_hitters(self):
+        "The most frequent keys should survive pruning with exact-ish counts."
+        from parsing.clustering import HeavyHitters
+        import random
+        
+        rand = random.Random(0)
+        counter = HeavyHitters(capacity=10)
+        
+        stream = ['big'] * 5000 + ['medium'] * 2000 + ['long-tail-%s' % i for i in range(10000)]
+        rand.shuffle(stream)
+        for key in stream:
+            counter.add(key, example=key)
+        
+        self.assertLessEqual(len(counter), 20)
+        top = counter.top(2)
+        self.assertEqual([x[0] for x in top], ['big', 'medium'])
+        
+        for key, count, error, example in top:
+            true_count = stream.count(key)
+            self.assertTrue(count - error <= true_count <= count)
+            self.assertEqual(example, key)
+    
+    def test_templates_command(self):
+        "Unparsed events should be grouped by template and matched to samples."
+        from django.core.management import call_command
+        from io import StringIO
+        from parsing.pipeline import parse_header
+        import json
+        import os
+        import tempfile
+        
+        service = Service.objects.create(key='sshd')
+        Sample.objects.create(service=service, value='Aug  1 18:27:46 knight sshd[20325]: Connection closed by 10.0.0.1 port 22 [preauth]')
+        
+        handle, path = tempfile.mkstemp(suffix='.log')
+        with os.fdopen(handle, 'w') as f:
+            for i in range(30):
+                f.write(json.dumps({'process': 'sshd', 'msg': 'Connection closed by 10.0.0.%s port 22 [preauth]' % i, 'data': {'linecount': 1}}) + '\n')
+            for i in range(5):
+                f.write(json.dumps({'process': 'sshd', 'msg': 'Accepted publickey for root from 10.0.0.%s' % i, 'data': {'linecount': 1}}) + '\n')
+            # Parsed events are not templates we need to work on
+            f.write(json.dumps({'process': 'sshd', 'msg': 'Failed password for root', 'data': {'user': 'root', 'punct': '___', 'linecount': 1}}) + '\n')
+        
+        out = StringIO()
+        call_command('templates', path, stdout=out)
+        os.remove(path)
+        
+        output = out.getvalue()
+        self.assertIn('sshd (35 unparsed events)', output)
+        self.assertIn(' 1. 30 ', output)
+        self.assertIn('sample #', output)
+        self.assertNotIn('Failed password', output)
+        
+        # Saved samples keep a header, so bodies that look like one survive
+        handle, path = tempfile.mkstemp(suffix='.log')
+        with os.fdopen(handle, 'w') as f:
+            f.write(json.dumps({'timestamp': '2019-08-01T08:27:46+00:00', 'host': 'knight', 'process': 'sshd', 'msg': 'pam_unix(sshd:session): session opened for user root by (uid=0)', 'data': {'linecount': 1}}) + '\n')
+        for i in range(2):
+            out = StringIO()
+            call_command('templates', path, save=True, stdout=out)
+        os.remove(path)
+        
+        sample = Sample.objects.get(value__contains='pam_unix')
+        self.assertEqual(sample.value, 'Aug  1 08:27:46 knight sshd: pam_unix(sshd:session): session opened for user root by (uid=0)')
+        self.assertEqual(parse_header(sample.value)['msg'], 'pam_unix(sshd:session): session opened for user root by (uid=0)')
+        self.assertIn('sample #%s: %s' % (sample.id, sample.value), out.getvalue())
+
+
+class SearchTest(TestCase):
+    
+    def setUp(self):
+        import tempfile
+        self.path = tempfile.mkdtemp()
+        self.token = '3f125cd7-fd46-4e37-a88e-610db52c1562'
+    
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.path)
+    
+    def lines(self, count, offset=0):
+        from parsing.pipeline import WriteStage, rfc3339
+        return [WriteStage.serialize({
+            'timestamp': rfc3339(1000000 + i),
+            'host': 'web%s' % (i % 3),
+            'process': 'sshd',
+            'msg': 'event %s' % i,
+            'token': self.token,
+            'data': {'user': 'user%s' % i, 'src_ip': '10.0.0.%s' % (i % 250)},
+        }) for i in range(offset, offset + count)]
+    
+    def test_search(self):
+        "Searches should only read blocks that can contain matches."
+        from django.test import override_settings
+        from parsing.archive import ArchiveWriter
+        from parsing.search import build_index, search
+        import gzip
+        import os
+        
+        # A plain (live) log, a logrotated gzip and a block archive
+        plain = os.path.join(self.path, '%s_node1.log' % self.token)
+        with open(plain, 'w') as f:
+            f.write(''.join(self.lines(3000)))
+        with gzip.open(os.path.join(self.path, '%s_node1.log-2019-01-01.gz' % self.token), 'wt') as f:
+            f.write(''.join(self.lines(3000, 3000)))
+        writer = ArchiveWriter(os.path.join(self.path, '%s_node2-2019-01-01.log.gz' % self.token), block_size=1000, linger=3600)
+        writer.write(self.lines(3000, 6000))
+        writer.close()
+        
+        with override_settings(OUTPUT_DIR=self.path, ARCHIVE_BLOCK_SIZE=1000):
+            stats = {}
+            records = search(self.token, where={'user': 'USER4321'}, stats=stats)
+            self.assertEqual([x['msg'] for x in records], ['event 4321'])
+            self.assertEqual(stats['blocks'], 9)
+            self.assertLess(stats['blocks_read'], 3)
+            
+            records = search(self.token, start=1007500, end=1007504, stats=stats)
+            self.assertEqual([x['msg'] for x in records], ['event %s' % i for i in range(7500, 7505)])
+            self.assertEqual(stats['blocks_read'], 1)
+            
+            records = search(self.token, start=1000010, end=1002999, where={'host': 'web1', 'src_ip': '10.0.0.11'}, limit=5)
+            self.assertEqual([x['msg'] for x in records], ['event %s' % i for i in range(10, 3000) if i % 3 == 1 and i % 250 == 11])
+            
+            # The live log grows; only the new block gets indexed
+            with open(plain, 'a') as f:
+                f.write(''.join(self.lines(500, 9000)))
+            self.assertEqual(len(search(self.token, where={'user': 'user9100'}, build=False)), 0)
+            index = build_index(plain)
+            self.assertEqual([x['records'] for x in index['blocks']], [1000, 1000, 1000, 500])
+            self.assertEqual(len(search(self.token, where={'user': 'user9100'})), 1)
+            
+            # Without building, files that were never indexed are skipped
+            with gzip.open(os.path.join(self.path, '%s_node1.log-2019-01-02.gz' % self.token), 'wt') as f:
+                f.write(''.join(self.lines(10, 9500)))
+            records = search(self.token, where={'user': 'user9505'}, stats=stats, build=False)
+            self.assertEqual((records, stats['files'], stats['unindexed']), ([], 3, 1))
+            self.assertEqual(len(search(self.token, where={'user': 'user9505'})), 1)